@@ -0,0 +1,288 @@
+"""
+Microbenchmarks of the per-message framework costs. Results are printed as JSON, so runs before and after
+a change can be compared:
+
+    python benchmarks/framework_benchmarks.py --output before.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import traceback
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils', 'python'))
+os.environ.setdefault('CONF_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'configuration'))
+os.environ.setdefault('FLOW_NAME', 'benchmarks')
+os.environ.setdefault('SERVICE_NAME', 'benchmark')
+
+import pika_utils
+from base_service import BaseService, RmqInputInfo, RmqOutputInfo, BasicProperties
+from state import State, Journal
+
+LOCAL_PROFILE = {'host': 'benchmarks_local', 'port': None, 'username': 'guest', 'password': 'guest'}
+
+
+def measure(name, func, number, repeat=5, **params):
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    best = min(timings) / number
+    return {
+        'name': name,
+        'params': params,
+        'number': number,
+        'repeat': repeat,
+        'best_us': best * 1e6,
+        'mean_us': sum(timings) / len(timings) / number * 1e6,
+        'ops_per_sec': 1 / best if best > 0 else None,
+    }
+
+
+def nested_payload(width, depth):
+    if depth == 0:
+        return {f'field_{i}': i * 1.5 for i in range(width)}
+    return {f'level_{depth}_{i}': [nested_payload(width, depth - 1), 'value', depth] for i in range(width)}
+
+
+def large_state_value(entries):
+    return {f'data_{i}': '0123456789abcdef' * 4 for i in range(entries)}
+
+
+class _Method:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class _Channel:
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        pass
+
+
+class _NoopService(BaseService):
+    def _handle_message(self, message, headers):
+        pass
+
+
+def _create_service(state_path, state_entries, outputs=()):
+    service = _NoopService(input=RmqInputInfo('benchmarks_input'), outputs=list(outputs))
+    service.local_rmq_profile = LOCAL_PROFILE
+    service.state = State(state_path)
+    service.state.data_state = large_state_value(state_entries)
+    service.journal = Journal(state_path + '/journal')
+    service._connect_to_output_queues()
+    return service
+
+
+def bench_state(work_dir):
+    results = []
+    for entries in (10, 10000):
+        state = State(f'{work_dir}/state_dump_{entries}')
+        state.data_state = large_state_value(entries)
+        state.counter = 1
+        number = 20 if entries > 1000 else 500
+        results.append(measure('State.dump', lambda: state.dump(keys={'data_state', 'counter'}), number=number,
+            entries=entries, keys='all'))
+
+        def dump_changed_counter():
+            state.counter += 1
+            state.dump()
+        results.append(measure('State.dump', dump_changed_counter, number=number, entries=entries, keys='dirty'))
+    return results
+
+
+def bench_handle_message_wrapper(work_dir):
+    results = []
+    properties = BasicProperties(headers={})
+    body = json.dumps(nested_payload(5, 1)).encode('utf8')
+    for entries in (10, 10000):
+        service = _create_service(f'{work_dir}/wrapper_{entries}', entries)
+        channel = _Channel()
+        method = _Method(1)
+        results.append(measure('BaseService._handle_message_wrapper',
+            lambda: service._handle_message_wrapper(channel, method, properties, body),
+            number=20 if entries > 1000 else 500, state_entries=entries))
+        service.journal.close()
+    return results
+
+
+def bench_send(work_dir):
+    pika_utils.connection_manager.transport = pika_utils.MEMORY_TRANSPORT
+    service = _create_service(f'{work_dir}/send', 0, outputs=[RmqOutputInfo('benchmarks_output_1'),
+        RmqOutputInfo('benchmarks_output_2', confirm_window=0)])
+    output_properties = service.outputs[0].properties
+    message = json.dumps(nested_payload(5, 1))
+    headers = {'tag': 'benchmark'}
+
+    results = [
+        measure('BaseService._merge_properties', lambda: service._merge_properties(output_properties),
+            number=100000, headers=False),
+        measure('BaseService._merge_properties', lambda: service._merge_properties(output_properties, headers),
+            number=100000, headers=True),
+        measure('BaseService._send', lambda: service._send(message, headers), number=5000, payload='text'),
+        measure('BaseService._send', lambda: service._send(nested_payload(5, 1), headers), number=5000,
+            payload='object'),
+    ]
+    # sent messages are not consumed and would pile up in the in-memory queues otherwise
+    from memory_broker import InMemoryBroker
+    InMemoryBroker.reset()
+    return results
+
+
+def bench_get_full_hash(work_dir):
+    import hashing
+    from difffinder_service import DiffFinderService
+    results = []
+    for width, depth in ((5, 1), (10, 2), (10, 3)):
+        payload = nested_payload(width, depth)
+        number = max(1, 20000 // (width ** depth))
+        results.append(measure('DiffFinderService.get_full_hash', lambda: DiffFinderService.get_full_hash(payload),
+            number=number, width=width, depth=depth))
+        results.append(measure('hashing.digest', lambda: hashing.digest(payload), number=number, width=width,
+            depth=depth))
+        batch = [payload] * 100
+        results.append(measure('hashing.digest_many', lambda: hashing.digest_many(batch),
+            number=max(1, number // 100), width=width, depth=depth, documents=len(batch)))
+    return results
+
+
+def bench_sql_builders(work_dir):
+    import db_saver_utils
+    row = {'id': 1, 'name': 'benchmark', 'value': 1.5, 'updated_dttm': '2020-01-01 00:00:00',
+        'meta': {'source': 'benchmark'}, 'tags': [{'a': 1}, {'b': 2}]}
+    key_slice = ['id']
+    return [
+        measure('db_saver_utils.get_insert_sql_and_args',
+            lambda: db_saver_utils.get_insert_sql_and_args('schema.table', dict(row), returning='id'), number=20000),
+        measure('db_saver_utils.get_update_sql_and_args',
+            lambda: db_saver_utils.get_update_sql_and_args('schema.table', dict(row), key_slice), number=20000),
+        measure('db_saver_utils.get_insert_on_conflict_sql_and_args',
+            lambda: db_saver_utils.get_insert_on_conflict_sql_and_args('schema.table', dict(row), key_slice),
+            number=20000),
+        measure('db_saver_utils.insert_on_new_data',
+            lambda: db_saver_utils.insert_on_new_data('schema.table', dict(row), key_slice, ['updated_dttm']),
+            number=20000),
+    ]
+
+
+class _StubCursor:
+    def mogrify(self, template, args):
+        from psycopg2.extensions import adapt
+        return (template % tuple(adapt(arg).getquoted().decode('utf8') for arg in args)).encode('utf8')
+
+    def execute(self, sql, args=None):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _StubConnection:
+    closed = 0
+
+    def cursor(self, name=None, cursor_factory=None):
+        return _StubCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def bench_insert_batch(work_dir):
+    from db_base import PostgresDbConnection
+    # without a pool nothing is connected until a query is run
+    connection = PostgresDbConnection(conn_str='dbname=benchmarks', rc_times=1, with_pool=False,
+        service_name='benchmark')
+    connection._connect = lambda: _StubConnection()
+    results = []
+    for rows in (100, 5000):
+        args_list = [(i, f'name_{i}', i * 0.5, '2020-01-01') for i in range(rows)]
+        results.append(measure('PostgresDbConnection.insert_batch',
+            lambda: connection.insert_batch('schema.table', '%s, %s, %s, %s', args_list),
+            number=max(1, 20000 // rows), rows=rows))
+    return results
+
+
+def bench_publish_error(work_dir):
+    errors_dir = f'{work_dir}/errors/'
+    os.makedirs(errors_dir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        from errors_manager import ErrorsManager
+        manager = ErrorsManager()
+    finally:
+        os.chdir(cwd)
+    manager.ERRORS_STORAGE_PATH = errors_dir
+    error = {'pipeline': 'benchmarks', 'service': 'benchmark', 'text': 'Traceback ...\n' * 20, 'cause': 'benchmark',
+        'timestamp': str(datetime.now())}
+
+    def publish():
+        manager.publish_error(error)
+        manager._errors_by_sender.clear()
+
+    return [measure('ErrorsManager.publish_error', publish, number=500)]
+
+
+BENCHMARKS = {
+    'state': bench_state,
+    'handle_message_wrapper': bench_handle_message_wrapper,
+    'send': bench_send,
+    'get_full_hash': bench_get_full_hash,
+    'sql_builders': bench_sql_builders,
+    'insert_batch': bench_insert_batch,
+    'publish_error': bench_publish_error,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the framework hot paths')
+    parser.add_argument('--output', help='file to write JSON results to, stdout by default')
+    parser.add_argument('--only', nargs='*', choices=sorted(BENCHMARKS), help='benchmark groups to run')
+    args = parser.parse_args()
+
+    report = {'timestamp': str(datetime.now()), 'python': platform.python_version(), 'platform': platform.platform(),
+        'results': [], 'skipped': {}, 'errors': {}}
+    work_dir = tempfile.mkdtemp(prefix='pipeline_benchmarks_')
+    try:
+        # services print their progress, it must not get mixed with JSON results
+        with contextlib.redirect_stdout(sys.stderr):
+            for name in args.only or BENCHMARKS:
+                started = time.time()
+                try:
+                    report['results'].extend(BENCHMARKS[name](work_dir))
+                except ImportError as ex:
+                    report['skipped'][name] = f'Missing dependency: {ex}'
+                except Exception as ex:
+                    # one broken group must not lose results of the others
+                    report['errors'][name] = traceback.format_exc()
+                    print(f'{name} failed: {ex!r}')
+                print(f'{name} finished in {time.time() - started:.1f}s')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
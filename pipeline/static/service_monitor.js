@@ -168,13 +168,32 @@ function compile_graph(services, rabbitmq_url) {
         predecessors.forEach(predecessor => {
             edges.push([predecessor, service_name, {
                 labelType: 'html',
-                label: '<a style="background: rgba(255, 255, 255, 0.8)" href="http://' + rabbitmq_url + '/#/queues/%2F/' + input_queue_name + '" target="_blank">' + input_queue_name + '</a>'
+                label: '<a style="background: rgba(255, 255, 255, 0.8)" href="http://' + rabbitmq_url + '/#/queues/%2F/' + input_queue_name + '" target="_blank">' + input_queue_name + '</a>' +
+                    '<br><span class="edge-latency" data-source="' + predecessor + '" data-target="' + service_name + '"></span>'
             }]);
         });
     });
     return [vertices, edges];
 }
 
+function format_latency(edge_latency) {
+    if (!edge_latency || !edge_latency.processing_ms) {
+        return '';
+    }
+    let queue_wait = edge_latency.queue_wait_ms;
+    let processing = edge_latency.processing_ms;
+    return 'wait ' + queue_wait.p50 + ' / ' + queue_wait.p90 + ' / ' + queue_wait.p99 + ' ms, ' +
+        'handle ' + processing.p50 + ' / ' + processing.p90 + ' / ' + processing.p99 + ' ms';
+}
+
+function update_edges_latency(svg, pipeline_latency) {
+    svg.selectAll('span.edge-latency').each(function () {
+        let edges = pipeline_latency[this.dataset.target] || {};
+        this.textContent = format_latency(edges[this.dataset.source]);
+        this.title = 'p50 / p90 / p99 of queue wait and handling time';
+    });
+}
+
 function render_graph(render, parent, nodes, edgeList, pipeline_name, states) {
     let svg = parent.append('svg');
     let inner = svg.append('g');
@@ -231,6 +250,7 @@ function fill_services_list() {
             let graph = compile_graph(info[pipeline].services, info[pipeline].rabbitmq_url);
             let render = new dagreD3.render();
             render_graph(render, d3.select('#' + pipeline + '_graph_area'), graph[0], graph[1], pipeline, state[pipeline]);
+            update_edges_latency(d3.select('#' + pipeline + '_graph_area'), response.latency[pipeline]);
         });
     });
 }
@@ -255,6 +275,7 @@ function update_statuses() {
                     svg.selectAll('g.node').classed(status, false);
                     svg.selectAll('g.node').filter(service => state[pipeline][service].pipeline_state === status).classed(status, true);
                 });
+                update_edges_latency(svg, response.latency[pipeline]);
             });
         },
         onerror = (event) => toastr['error']('Can\'t connect to the hive.', 'Connection lost 😱')
@@ -6,12 +6,14 @@ from typing import Dict
 from pipeline_info import PipelineInfo
 from service_info import ServiceInfo
 from service_state import ServiceState
+from tracing import EdgeLatency
 
 
 class AppState:
     def __init__(self):
         self.pipelines_info = self._read_pipelines()
         self.pipelines_state = self._init_pipelines_state(self.pipelines_info)
+        self.edges_latency = self._init_edges_latency(self.pipelines_info)
         self.lock = RLock()
 
     @staticmethod
@@ -38,5 +40,18 @@ class AppState:
             for service in pipeline.services.values()}
             for pipeline in pipelines_configuration.values()}
 
+    @staticmethod
+    def _init_edges_latency(pipelines_configuration: Dict[str, PipelineInfo]) -> Dict[str, Dict[str, Dict]]:
+        # pipeline -> service -> predecessor -> EdgeLatency
+        return {pipeline.name: {service.name: {} for service in pipeline.services.values()}
+            for pipeline in pipelines_configuration.values()}
+
+    def add_latency_samples(self, pipeline: str, service: str, samples: Dict[str, Dict]):
+        edges = self.edges_latency[pipeline][service]
+        for predecessor, edge_samples in samples.items():
+            if predecessor not in edges:
+                edges[predecessor] = EdgeLatency()
+            edges[predecessor].add(edge_samples)
+
 
 app_state = AppState()
@@ -0,0 +1,246 @@
+import asyncio
+
+from base_service import *
+
+
+class AsyncProcessorService(BaseService):
+    """
+    Processor handling up to `prefetch_count` messages concurrently on a single asyncio event loop
+    """
+    RECONNECT_DELAY = 10
+    HEARTBEAT_INTERVAL = 5
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.input is not None and (self.input.batch_mode or self.input.workers > 0):
+            raise ValueError('batch_mode and workers are not supported by AsyncProcessorService')
+        self._loop = None
+        self._terminated_event = None
+        self._local_connection = None
+        self._local_ready = False
+        self._global_connection = None
+        self._global_ready = False
+        self.input_channel = None
+        self._input_queue_name = None
+        self._consumer_tag = None
+        self._output_channel = None
+        self._global_channel = None
+        self._tasks = set()
+
+    def establish_rmq_connections(self):
+        # connections are opened on the event loop in _run
+        self.global_rmq_profile = dict(self.config.get_property_group('global_rmq'))
+        self.local_rmq_profile = dict(self.config.get_property_group('local_rmq'))
+
+    async def _handle_message(self, message, headers):
+        raise NotImplementedError()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._terminated_event = asyncio.Event()
+        try:
+            self._loop.run_until_complete(self.__main())
+        finally:
+            self._loop.close()
+
+    async def __main(self):
+        await self.__connect_to_global_rmq()
+        await self.__connect_to_local_rmq()
+        heartbeats_task = self._loop.create_task(self.__send_heartbeats())
+        self.suspended = False
+        self.__start_consuming()
+
+        await self._terminated_event.wait()
+        print('Shutting down')
+        heartbeats_task.cancel()
+        if len(self._tasks) > 0:
+            await asyncio.wait(self._tasks)
+        for connection in (self._local_connection, self._global_connection):
+            if connection is not None and connection.is_open:
+                connection.close()
+
+    @staticmethod
+    async def __connect(profile, on_close_callback):
+        return await pika_utils.Asyncio.create_connection(profile['host'], profile['port'], profile['username'],
+            profile['password'], on_close_callback=on_close_callback)
+
+    @staticmethod
+    def __close_unready(connection):
+        if connection is not None and connection.is_open:
+            connection.close()
+
+    async def __connect_to_local_rmq(self):
+        while True:
+            try:
+                self._local_connection = await self.__connect(self.local_rmq_profile, self.__on_local_rmq_closed)
+                if self.input is not None:
+                    self.input_channel = await pika_utils.Asyncio.channel(self._local_connection)
+                    self._input_queue_name = await self.input.declare(self.input_channel)
+                self._output_channel = await pika_utils.Asyncio.channel(self._local_connection)
+                for output in self.outputs:
+                    await output.declare(self._output_channel)
+                self._local_ready = True
+                print('Successfully set up connection to local RabbitMQ')
+                return
+            except (AMQPError, AMQPConnectorException, asyncio.TimeoutError, OSError):
+                self.__close_unready(self._local_connection)
+                print(f'Unable to connect to local RabbitMQ. Next attempt in {self.RECONNECT_DELAY} seconds')
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+    async def __connect_to_global_rmq(self):
+        commands_queue = self.flow_name + '.' + self.service_name
+        while True:
+            try:
+                self._global_connection = await self.__connect(self.global_rmq_profile, self.__on_global_rmq_closed)
+                self._global_channel = await pika_utils.Asyncio.channel(self._global_connection)
+                await pika_utils.Asyncio.queue(self._global_channel, 'heartbeats')
+                await pika_utils.Asyncio.queue(self._global_channel, 'errors')
+                await pika_utils.Asyncio.queue(self._global_channel, commands_queue, exchange_name='commands',
+                    routing_key=commands_queue, exchange_type=pika_utils.TOPIC)
+                self._global_channel.basic_consume(queue=commands_queue, on_message_callback=self.__on_command)
+                self._global_ready = True
+                print('Successfully set up connection to global RabbitMQ')
+                return
+            except (AMQPError, AMQPConnectorException, asyncio.TimeoutError, OSError):
+                self.__close_unready(self._global_connection)
+                print(f'Unable to connect to global RabbitMQ. Next attempt in {self.RECONNECT_DELAY} seconds')
+                await asyncio.sleep(self.RECONNECT_DELAY)
+
+    def __on_local_rmq_closed(self, connection, reason):
+        if connection is not self._local_connection or not self._local_ready:
+            return
+        self._local_ready = False
+        self._consumer_tag = None
+        if self.terminated:
+            return
+        print(f'Local RabbitMQ connection closed: {reason}. Reconnecting in {self.RECONNECT_DELAY} seconds')
+        self._loop.create_task(self.__reconnect_to_local_rmq())
+
+    async def __reconnect_to_local_rmq(self):
+        await asyncio.sleep(self.RECONNECT_DELAY)
+        await self.__connect_to_local_rmq()
+        if not self.suspended:
+            self.__start_consuming()
+
+    def __on_global_rmq_closed(self, connection, reason):
+        if connection is not self._global_connection or not self._global_ready:
+            return
+        self._global_ready = False
+        if self.terminated:
+            return
+        print(f'Global RabbitMQ connection closed: {reason}. Reconnecting in {self.RECONNECT_DELAY} seconds')
+        self._loop.create_task(self.__reconnect_to_global_rmq())
+
+    async def __reconnect_to_global_rmq(self):
+        await asyncio.sleep(self.RECONNECT_DELAY)
+        await self.__connect_to_global_rmq()
+
+    def __start_consuming(self):
+        if self.input_channel is None or not self._local_ready or self._consumer_tag is not None:
+            return
+        self._consumer_tag = self.input_channel.basic_consume(queue=self._input_queue_name,
+            on_message_callback=self.__on_message)
+
+    def __stop_consuming(self):
+        if self._consumer_tag is None:
+            return
+        if self._local_ready:
+            self.input_channel.basic_cancel(self._consumer_tag)
+        self._consumer_tag = None
+
+    def __on_message(self, channel, method, properties, body):
+        task = self._loop.create_task(self.__handle_delivery(channel, method, properties, body))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def __handle_delivery(self, channel, method, properties, body):
+        trace = tracing.Trace.received(properties.headers)
+        message = self._decode_body(body, properties)
+        self.state._last_received_message_datetime = str(datetime.now())
+        with tracing.handling(trace, self._edges_latency):
+            try:
+                if self._is_foreign_tagged(properties.headers):
+                    self._send(message, properties.headers)
+                else:
+                    await self._handle_message(message, properties.headers)
+            except (AMQPError, AMQPConnectorException):
+                print('Message handling interrupted by local RabbitMQ disconnect. It will be redelivered')
+                return
+            except Exception:
+                self._report_error(traceback.format_exc(), cause=message)
+
+        if channel.is_open:
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+        with self.state.write_lock:
+            self.state.dump(force=False)
+
+    def __on_command(self, channel, method, properties, body):
+        try:
+            message = json.loads(body)
+            with self.state.write_lock:
+                command = message.get('command')
+                args = [] if message.get('args') is None else message.get('args')
+                self._handle_command(command, args)
+        except Exception:
+            print(traceback.format_exc())
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _send(self, message, headers=None):
+        """
+        Publishing does not wait for the broker, so it can be called from coroutines directly.
+        Raises AMQPError if local RabbitMQ is disconnected
+        """
+        if not self._local_ready or not self._output_channel.is_open:
+            raise AMQPError('Local RabbitMQ connection is not established')
+        headers = tracing.outgoing_headers(headers, self.service_name)
+        encoded_bodies = {}
+        for output in self.outputs:
+            body, properties = self._encode_message(message, output, encoded_bodies)
+            properties = self._merge_properties(properties, headers)
+            self._output_channel.basic_publish(exchange=output.exchange, routing_key=output.routing_key, body=body,
+                properties=properties)
+        self.state._last_sent_message_datetime = str(datetime.now())
+
+    def _suspend(self, args):
+        if self.suspended:
+            return
+        super()._suspend(args)
+        self.__stop_consuming()
+        self.state.dump()
+
+    def _resume(self, args):
+        if not self.suspended:
+            return
+        self.state.load()
+        super()._resume(args)
+        self.__start_consuming()
+
+    def _hard_shutdown(self, args):
+        super()._hard_shutdown(args)
+        self._terminated_event.set()
+
+    async def __send_heartbeats(self):
+        while True:
+            try:
+                if self._global_ready:
+                    self._global_channel.basic_publish(exchange='', routing_key='heartbeats',
+                        body=json.dumps(self._create_heartbeat_message()))
+            except (AMQPError, AMQPConnectorException):
+                print('Global RabbitMQ connection closed. Unable to send heartbeat')
+            except Exception:
+                print(traceback.format_exc())
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+
+    def _report_error(self, error_message, cause='Unknown'):
+        print('ERROR', error_message)
+        try:
+            if not self._global_ready:
+                print(f'Global RabbitMQ connection closed. Error message can\'t be reported: {error_message}')
+                return
+            body = self._create_error_report(error_message, cause)
+            self._global_channel.basic_publish(exchange='', routing_key='errors', body=json.dumps(body))
+        except (AMQPError, AMQPConnectorException):
+            print(f'Global RabbitMQ connection closed. Error message can\'t be reported: {error_message}')
+        except Exception:
+            print(traceback.format_exc())
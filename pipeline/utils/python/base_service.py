@@ -1,8 +1,14 @@
+import contextlib
+import functools
+import importlib
 import json
 import os
+import sys
 import threading
 import time
 import traceback
+import zlib
+from collections import deque
 from datetime import datetime
 from typing import Union, List, Dict, Optional
 
@@ -12,38 +18,167 @@ from pika.adapters.utils.connection_workflow import AMQPConnectorException
 from pika import BasicProperties
 
 import pika_utils
+import tracing
 from config import Config
-from state import State
+from state import State, SqliteState, Journal
+from worker_pool import KeyedWorkerPool
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class MessageCodec:
+    # the codec and the compression are passed in content_type and content_encoding properties
+    JSON_CONTENT_TYPE = 'application/json'
+    MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+    def __init__(self, codec: str = 'json', compression: str = None):
+        if codec == 'json':
+            self.content_type = self.JSON_CONTENT_TYPE
+            self._encode = MessageCodec.__encode_json
+        elif codec == 'orjson':
+            if orjson is None:
+                raise ValueError('orjson codec requires orjson package')
+            self.content_type = self.JSON_CONTENT_TYPE
+            self._encode = orjson.dumps
+        elif codec == 'msgpack':
+            if msgpack is None:
+                raise ValueError('msgpack codec requires msgpack package')
+            self.content_type = self.MSGPACK_CONTENT_TYPE
+            self._encode = MessageCodec.__encode_msgpack
+        else:
+            raise ValueError(f'Unknown codec {codec}')
+        if compression not in (None, 'zlib', 'zstd'):
+            raise ValueError(f'Unknown compression {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires zstandard package')
+        self.codec = codec
+        self.compression = compression
+
+    def encode(self, message) -> bytes:
+        return MessageCodec.compress(self._encode(message), self.compression)
+
+    @staticmethod
+    def __encode_json(message):
+        return json.dumps(message).encode('utf8')
+
+    @staticmethod
+    def __encode_msgpack(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def compress(body: bytes, compression: str = None) -> bytes:
+        if compression == 'zlib':
+            return zlib.compress(body)
+        if compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(body)
+        return body
+
+    @staticmethod
+    def decompress(body: bytes, compression: str = None) -> bytes:
+        if compression is None:
+            return body
+        if compression == 'zlib':
+            return zlib.decompress(body)
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd compression requires zstandard package')
+            return zstandard.ZstdDecompressor().decompress(body)
+        raise ValueError(f'Unknown compression {compression}')
+
+    @staticmethod
+    def decode(body: bytes, content_type: str = None, content_encoding: str = None, to_object: bool = True):
+        # without to_object the message text is returned, as it was received before codecs were introduced
+        body = MessageCodec.decompress(body, content_encoding)
+        if content_type == MessageCodec.MSGPACK_CONTENT_TYPE:
+            if msgpack is None:
+                raise ValueError('msgpack codec requires msgpack package')
+            message = msgpack.unpackb(body, raw=False)
+            return message if to_object else json.dumps(message)
+        if not to_object:
+            return body.decode('utf8')
+        if content_type == MessageCodec.JSON_CONTENT_TYPE:
+            return orjson.loads(body) if orjson is not None else json.loads(body)
+        # messages sent as strings have no content type and are decoded as JSON when possible
+        text = body.decode('utf8')
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
 
 
 class RmqInputInfo:
-    def __init__(self, queue_name, exchange_name=None, prefetch_count: int = 100, durable=True):
+    def __init__(self, queue_name, exchange_name=None, prefetch_count: int = 100, durable=True, batch_mode=False,
+            batch_timeout_ms: int = 1000, workers: int = 0, decode_messages: bool = False):
+        # in batch mode deliveries are handled by batches of up to prefetch_count and acked once the batch is
+        # handled, batches which failed are requeued. Workers handle messages with equal message keys in order,
+        # their messages are acked once handled and their outputs confirmed instead of being journaled
+        if batch_mode and prefetch_count <= 0:
+            raise ValueError('prefetch_count must be positive in batch mode')
+        if batch_mode and workers > 0:
+            raise ValueError('batch_mode and workers can not be used together')
         self.queue_name = queue_name
         self.exchange_name = exchange_name
         self.prefetch_count = prefetch_count
         self.durable = durable
+        self.batch_mode = batch_mode
+        self.batch_timeout_ms = batch_timeout_ms
+        self.workers = workers
+        self.decode_messages = decode_messages
 
-    def create_channel(self, profile, callback):
+    def create_channel(self, profile, callback, scope=None):
         if self.exchange_name is None:
             print(f'Creating input connection to queue {self.queue_name}')
             return pika_utils.Blocking.queue(queue_name=self.queue_name, callback=callback, host=profile['host'],
                 port=profile['port'], username=profile['username'], password=profile['password'],
-                prefetch_count=self.prefetch_count, durable=self.durable)
+                prefetch_count=self.prefetch_count, durable=self.durable, scope=scope)
         else:
             print(f'Creating input connection to exchange {self.exchange_name} through {self.queue_name}')
             queue_name = self.exchange_name + '.' + self.queue_name
             return pika_utils.Blocking.queue(queue_name=queue_name, callback=callback, exchange_name=self.exchange_name,
                 exchange_type=pika_utils.FANOUT, host=profile['host'], port=profile['port'],
                 username=profile['username'], password=profile['password'],
-                prefetch_count=self.prefetch_count, durable=self.durable)
+                prefetch_count=self.prefetch_count, durable=self.durable, scope=scope)
+
+    async def declare(self, channel) -> str:
+        """
+        Declares the input topology on an asyncio channel and returns the queue to consume from
+        """
+        if self.exchange_name is None:
+            await pika_utils.Asyncio.queue(channel, self.queue_name, prefetch_count=self.prefetch_count,
+                durable=self.durable)
+            return self.queue_name
+        queue_name = self.exchange_name + '.' + self.queue_name
+        await pika_utils.Asyncio.queue(channel, queue_name, exchange_name=self.exchange_name,
+            exchange_type=pika_utils.FANOUT, prefetch_count=self.prefetch_count, durable=self.durable)
+        return queue_name
 
 
 class RmqOutputInfo:
-    def __init__(self, name=None, is_exchange=False, durable=True):
+    def __init__(self, name=None, is_exchange=False, durable=True, confirm_window: int = 100, codec: str = 'json',
+            compression: str = None):
+        # confirm_window is the max number of unconfirmed messages, 0 disables publisher confirms
         self.name = name
         self.is_exchange = is_exchange
         self.durable = durable
+        self.confirm_window = confirm_window
         self.properties = RmqOutputInfo.__create_publishing_properties(durable)
+        self.codec = MessageCodec(codec, compression)
+        self.encoded_properties = RmqOutputInfo.__create_publishing_properties(durable)
+        self.encoded_properties.content_type = self.codec.content_type
+        self.encoded_properties.content_encoding = compression
+        self.exchange = name if is_exchange else ''
+        self.routing_key = '' if is_exchange else name
 
     @staticmethod
     def __create_publishing_properties(durable: bool):
@@ -52,22 +187,45 @@ class RmqOutputInfo:
             result.delivery_mode = 2
         return result
 
-    def create_channel(self, profile):
+    def create_channel(self, profile, scope=None):
         if self.is_exchange:
             print(f'Creating output connection to exchange {self.name}')
             return pika_utils.Blocking.exchange(name=self.name, exchange_type=pika_utils.FANOUT, host=profile['host'],
-                port=profile['port'], username=profile['username'], password=profile['password'], durable=self.durable)
+                port=profile['port'], username=profile['username'], password=profile['password'], durable=self.durable,
+                scope=scope)
         else:
             print(f'Creating output connection to queue {self.name}')
             return pika_utils.Blocking.queue(queue_name=self.name, host=profile['host'], port=profile['port'],
                 username=profile['username'], password=profile['password'],
+                durable=self.durable, scope=scope)
+
+    def create_publisher(self, channel):
+        return pika_utils.ConfirmedPublisher(channel, self.confirm_window)
+
+    async def declare(self, channel):
+        """
+        Declares the output topology on an asyncio channel
+        """
+        if self.is_exchange:
+            await pika_utils.Asyncio.exchange(channel, self.name, exchange_type=pika_utils.FANOUT,
                 durable=self.durable)
+        else:
+            await pika_utils.Asyncio.queue(channel, self.name, durable=self.durable)
 
 
 class BaseService:
+    # services whose handlers lock the state they mutate, other services can't have more than one input worker
+    CONCURRENT_HANDLERS = False
+    STATE_BACKENDS = ('json', 'sqlite')
+    CONFIRMS_POLL_INTERVAL = 0.1
+    # large mapping keys of the state, kept as lazily loaded views by the sqlite backend
+    STATE_MAPPING_KEYS = ()
+
     def __init__(self, input: Union[RmqInputInfo, str] = None,
             outputs: Union[RmqOutputInfo, List[str], List[RmqOutputInfo], str] = None,
-            state_dump_interval = 1, subscription_tags: Union[str, List[str]] = None):
+            state_dump_interval = 1, subscription_tags: Union[str, List[str]] = None,
+            state_dump_period: float = None, state_backend: str = 'json', state_checkpointing: bool = False,
+            state_snapshot_format: str = 'json'):
         self.flow_name = os.environ.get('FLOW_NAME')
         self.service_name = os.environ.get('SERVICE_NAME')
         self.input = None if input is None else RmqInputInfo(input) if type(input) == str else input
@@ -75,7 +233,16 @@ class BaseService:
             else [RmqOutputInfo(outputs)] if type(outputs) == str \
             else [outputs] if type(outputs) == RmqOutputInfo \
             else [RmqOutputInfo(output) if type(output) == str else output for output in outputs]
+        if self.input is not None and self.input.workers > 1 and not self.CONCURRENT_HANDLERS:
+            raise ValueError(f'{type(self).__name__} handlers are run under the state lock one at a time, '
+                             f'{self.input.workers} input workers require CONCURRENT_HANDLERS')
         self.state_dump_interval = state_dump_interval
+        self.state_dump_period = state_dump_period
+        if state_backend not in self.STATE_BACKENDS:
+            raise ValueError(f'Unknown state backend {state_backend}, expected one of {self.STATE_BACKENDS}')
+        self.state_backend = state_backend
+        self.state_checkpointing = state_checkpointing
+        self.state_snapshot_format = state_snapshot_format
         self.subscription_tags = [subscription_tags] if isinstance(subscription_tags, str) \
             else subscription_tags if isinstance(subscription_tags, list) \
             else []
@@ -83,6 +250,18 @@ class BaseService:
         self.suspended = True
         self.terminated = False
         self.config = Config(None, None)
+        self.state_root = 'state'
+
+        self._batch = []
+        self._batch_timer = None
+        self._worker_pool = None
+        self._send_lock = threading.RLock()
+        self.output_publishers = []
+        # (numbers of the messages published by outputs, action) run once the messages are confirmed
+        self._pending_commits = deque()
+        self._confirms_timer = None
+        self._hive_lock = threading.RLock()
+        self._edges_latency = tracing.EdgeLatencyCollector()
 
     def set_config(self, config):
         self.config = config
@@ -100,26 +279,54 @@ class BaseService:
         self.__connect_to_errors_queue()
 
     def load_state(self):
-        self.state_path = 'state/' + self.service_name
-        self.state = State(self.state_path, self.state_dump_interval)
+        self.state_path = self.state_root + '/' + self.service_name
+        if self.state_backend == 'sqlite':
+            self.state = SqliteState(self.state_path, self.state_dump_interval, self.state_dump_period,
+                mapping_keys=self.STATE_MAPPING_KEYS, snapshot_format=self.state_snapshot_format)
+        else:
+            self.state = State(self.state_path, self.state_dump_interval, self.state_dump_period,
+                snapshot_format=self.state_snapshot_format)
+        if self.state_checkpointing:
+            self.state.start_checkpointer()
         self._init_state()
         self.state.load()
+        self.journal = Journal(self.state_path + '/journal')
+        if self.state._current_message is not None:
+            # message interrupted before the journal was introduced
+            self.journal.begin(self.state._current_message, self.state._current_headers)
+            self.state._current_message = None
+            self.state._current_headers = None
+            self.state.dump(keys={'_current_message', '_current_headers'})
+
+    def _connection_scope(self, purpose):
+        # channels are opened by the main thread and used by others, so connections are shared by purpose
+        # rather than by thread. Heartbeats and errors share the hive connection under _hive_lock
+        return f'{self.flow_name}.{self.service_name}.{purpose}'
 
     def _connect_to_input_queue(self):
         if self.input is not None:
-            self.input_channel = self.input.create_channel(self.local_rmq_profile, self._handle_message_wrapper)
+            self.input_channel = self.input.create_channel(self.local_rmq_profile, self._handle_message_wrapper,
+                scope=self._connection_scope('input'))
             print('Successfully set up input connection to local RabbitMQ')
 
     def _connect_to_output_queues(self):
+        previous_publishers = self.output_publishers
         self.output_channels = []
+        self.output_publishers = []
         for output in self.outputs:
-            self.output_channels.append(output.create_channel(self.local_rmq_profile))
+            channel = output.create_channel(self.local_rmq_profile, scope=self._connection_scope('outputs'))
+            self.output_channels.append(channel)
+            self.output_publishers.append(output.create_publisher(channel))
             print('Successfully set up output connection to local RabbitMQ')
+        for publisher, previous in zip(self.output_publishers, previous_publishers):
+            if len(previous.unconfirmed_messages) > 0:
+                print(f'Publishing again {len(previous.unconfirmed_messages)} unconfirmed messages')
+            publisher.take_over(previous)
 
     def __connect_to_heartbeats_queue(self):
         self.hive_heartbeats_channel = pika_utils.Blocking.queue('heartbeats', host=self.global_rmq_profile['host'],
             port=self.global_rmq_profile['port'], username=self.global_rmq_profile['username'],
-            password=self.global_rmq_profile['password'])
+            password=self.global_rmq_profile['password'], scope=self._connection_scope('hive'))
         self.hive_heartbeats_thread = threading.Thread(target=self.__send_heartbeats, daemon=True)
 
     def __connect_to_commands_queue(self):
@@ -127,12 +334,13 @@ class BaseService:
             exchange_name='commands', routing_key=self.flow_name + '.' + self.service_name,
             exchange_type=pika_utils.TOPIC, callback=self.__handle_command_wrapper,
             host=self.global_rmq_profile['host'], port=self.global_rmq_profile['port'],
-            username=self.global_rmq_profile['username'], password=self.global_rmq_profile['password'])
+            username=self.global_rmq_profile['username'], password=self.global_rmq_profile['password'],
+            scope=self._connection_scope('commands'))
 
     def __connect_to_errors_queue(self):
         self.hive_errors_channel = pika_utils.Blocking.queue('errors', host=self.global_rmq_profile['host'],
             port=self.global_rmq_profile['port'], username=self.global_rmq_profile['username'],
-            password=self.global_rmq_profile['password'])
+            password=self.global_rmq_profile['password'], scope=self._connection_scope('hive'))
 
     def _init_state(self):
         pass
@@ -140,29 +348,148 @@ class BaseService:
     def _handle_message(self, message, headers):
         raise NotImplementedError()
 
+    def _handle_batch(self, messages: List[str], headers_list: List[Optional[Dict[str, object]]]):
+        for message, headers in zip(messages, headers_list):
+            try:
+                self._handle_message(message, headers)
+            except Exception:
+                self._report_error(traceback.format_exc(), cause=message)
+
+    def _get_message_key(self, message, headers):
+        # messages with equal keys are handled in order by the same worker, None means any worker
+        return None
+
+    def _is_foreign_tagged(self, headers):
+        return headers and 'tag' in headers and headers['tag'] not in self.subscription_tags
+
     def _handle_message_wrapper(self, channel, method, properties, body):
-        message = body.decode('utf8')
+        if self.input.batch_mode:
+            self._collect_batch_message(channel, method, properties, body)
+            return
+        if self._worker_pool is not None:
+            self._submit_to_worker(channel, method, properties, body)
+            return
+
+        message = self._decode_body(body, properties)
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
+        trace = tracing.Trace.received(properties.headers)
         with self.state.write_lock:
             self.state._last_received_message_datetime = str(datetime.now())
-            self.state._current_message = message
-            self.state._current_headers = properties.headers
-            self.state.dump(keys={'_last_received_message_datetime', '_current_message', '_current_headers'})
             try:
-                if properties.headers and 'tag' in properties.headers \
-                        and properties.headers['tag'] not in self.subscription_tags:
-                    self._send(message, properties.headers)
+                record_id = self.journal.begin(message, properties.headers)
+            except Exception:
+                # the message is handled even if it can't be journaled
+                self._report_error(traceback.format_exc(), cause=message)
+                record_id = None
+            with tracing.handling(trace, self._edges_latency):
+                try:
+                    if self._is_foreign_tagged(properties.headers):
+                        self._send(message, properties.headers)
+                    else:
+                        self._handle_message(message, properties.headers)
+                except Exception:
+                    self._report_error(traceback.format_exc(), cause=message)
+            self._after_confirms(functools.partial(self.journal.commit, record_id))
+            self.state.dump(force=False)
+
+    def _decode_body(self, body: bytes, properties: BasicProperties):
+        try:
+            return MessageCodec.decode(body, properties.content_type, properties.content_encoding,
+                to_object=self.input.decode_messages)
+        except Exception:
+            self._report_error(traceback.format_exc(), cause=f'Undecodable message of type {properties.content_type}')
+            return body.decode('utf8', errors='replace')
+
+    def _collect_batch_message(self, channel, method, properties, body):
+        self._batch.append((method.delivery_tag, method.redelivered, self._decode_body(body, properties),
+            properties.headers, tracing.Trace.received(properties.headers)))
+        if len(self._batch) >= self.input.prefetch_count:
+            self._flush_batch(channel)
+        elif self._batch_timer is None:
+            self._batch_timer = channel.connection.call_later(self.input.batch_timeout_ms / 1000,
+                lambda: self._flush_batch(channel))
+
+    def _flush_batch(self, channel):
+        if self._batch_timer is not None:
+            channel.connection.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        if len(self._batch) == 0:
+            return
+        batch, self._batch = self._batch, []
+
+        with self.state.write_lock:
+            self.state._last_received_message_datetime = str(datetime.now())
+            handled = []
+            for delivery_tag, redelivered, message, headers, trace in batch:
+                if self._is_foreign_tagged(headers):
+                    with tracing.handling(trace, self._edges_latency):
+                        try:
+                            self._send(message, headers)
+                        except Exception:
+                            self._report_error(traceback.format_exc(), cause=message)
                 else:
-                    self._handle_message(message, properties.headers)
+                    handled.append((delivery_tag, redelivered, message, headers, trace))
+            # messages of a batch are sent without trace context, so they start new traces
+            requeued = []
+            try:
+                if len(handled) > 0:
+                    self._handle_batch([item[2] for item in handled], [item[3] for item in handled])
+            except Exception:
+                self._report_error(traceback.format_exc(), cause=f'Batch of {len(handled)} messages')
+                # messages of the failed batch are requeued once, redelivered ones are handled one by one,
+                # so a message failing every batch is not redelivered forever
+                requeued = [item[0] for item in handled if not item[1]]
+                redelivered = [item for item in handled if item[1]]
+                BaseService._handle_batch(self, [item[2] for item in redelivered], [item[3] for item in redelivered])
+            handled_time = time.time()
+            for item in handled:
+                self._edges_latency.record(item[4], handled_time)
+            self.state.dump(force=False)
+        self._wait_for_confirms()
+        if len(requeued) == 0:
+            channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+            return
+        requeued = set(requeued)
+        for delivery_tag, *_ in batch:
+            if delivery_tag in requeued:
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            else:
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _submit_to_worker(self, channel, method, properties, body):
+        message = self._decode_body(body, properties)
+        try:
+            key = self._get_message_key(message, properties.headers)
+        except Exception:
+            self._report_error(traceback.format_exc(), cause=message)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        self._worker_pool.submit(key, channel, method.delivery_tag, message, properties.headers,
+            tracing.Trace.received(properties.headers))
+
+    def _handle_message_in_worker(self, channel, delivery_tag, message, headers, trace):
+        with self.state.write_lock:
+            self.state._last_received_message_datetime = str(datetime.now())
+        with tracing.handling(trace, self._edges_latency), \
+                contextlib.nullcontext() if self.CONCURRENT_HANDLERS else self.state.write_lock:
+            try:
+                if self._is_foreign_tagged(headers):
+                    self._send(message, headers)
+                else:
+                    self._handle_message(message, headers)
             except Exception:
                 self._report_error(traceback.format_exc(), cause=message)
-            self.state._current_message = None
-            self.state._current_headers = None
+        self._after_confirms(functools.partial(channel.connection.add_callback_threadsafe,
+            functools.partial(channel.basic_ack, delivery_tag=delivery_tag)))
+        with self.state.write_lock:
             self.state.dump(force=False)
 
     def _hard_shutdown(self, args):
+        self._wait_for_confirms()
         self.state.dump()
+        self.state.flush()
+        self.journal.sync()
         self.terminated = True
         self._suspend({})
 
@@ -195,47 +522,121 @@ class BaseService:
         channel.basic_ack(delivery_tag=method.delivery_tag)
 
     def _send(self, message, headers=None):
+        headers = tracing.outgoing_headers(headers, self.service_name)
+        with self._send_lock:
+            self.__send_locked(message, headers)
+        # the state lock is not taken under the send lock, handlers holding it send messages
+        with self.state.write_lock:
+            self.state._last_sent_message_datetime = str(datetime.now())
+
+    def __send_locked(self, message, headers=None):
+        published_outputs = 0
+        encoded_bodies = {}
         while True:
             try:
-                for output, output_channel in zip(self.outputs, self.output_channels):
-                    properties = self.__merge_properties(output.properties, headers)
-                    if output.is_exchange:
-                        output_channel.basic_publish(exchange=output.name, routing_key='', body=message,
-                                                     properties=properties)
-                    else:
-                        output_channel.basic_publish(exchange='', routing_key=output.name, body=message,
-                                                     properties=properties)
-                self.state._last_sent_message_datetime = str(datetime.now())
+                while published_outputs < len(self.outputs):
+                    output = self.outputs[published_outputs]
+                    body, properties = self._encode_message(message, output, encoded_bodies)
+                    properties = self._merge_properties(properties, headers)
+                    self.output_publishers[published_outputs].publish(output.exchange, output.routing_key, body,
+                        properties)
+                    published_outputs += 1
                 break
             except (AMQPError, AMQPConnectorException):
-                print('Sending failed due to local RMQ disconnect and is blocked until connection restored. '
-                      'Reconnecting in 10 seconds')
-                while True:
-                    try:
-                        time.sleep(10)
-                        self._connect_to_output_queues()
-                        break
-                    except (AMQPError, AMQPConnectorException):
-                        print('Unable to reconnect to output queues. Next attempt in 10 seconds')
+                self.__reconnect_to_output_queues()
 
-    def __merge_properties(self, output_properties: BasicProperties,
-            additional_headers: Optional[Dict[str, object]] = None):
-        result = BasicProperties(
-            delivery_mode=output_properties.delivery_mode,
-            headers={},
-        )
-
-        result.headers.update(output_properties.headers or {})
-        additional_headers = additional_headers or {}
-        keys_intersection = set(result.headers.keys()) & set(additional_headers.keys())
-        if len(keys_intersection) > 0:
-            self._report_error(f'Warning: header key violation. Keys {keys_intersection} found in both '
-                    f'{result.headers} and {additional_headers}')
-        result.headers.update(additional_headers)
+    def __reconnect_to_output_queues(self):
+        print('Sending failed due to local RMQ disconnect and is blocked until connection restored. '
+              'Reconnecting in 10 seconds')
+        while True:
+            try:
+                time.sleep(10)
+                self._connect_to_output_queues()
+                break
+            except (AMQPError, AMQPConnectorException):
+                print('Unable to reconnect to output queues. Next attempt in 10 seconds')
 
-        return result
+    def _wait_for_confirms(self):
+        # blocks until all published messages are confirmed by the broker
+        with self._send_lock:
+            while True:
+                try:
+                    for publisher in self.output_publishers:
+                        publisher.wait_for_confirms()
+                    break
+                except (AMQPError, AMQPConnectorException):
+                    self.__reconnect_to_output_queues()
+            self.__run_confirmed()
+
+    def _after_confirms(self, action):
+        # the message is committed or acked once the messages it caused are confirmed, so they are not lost
+        # by a crash after the commit
+        with self._send_lock:
+            self._pending_commits.append((tuple(publisher.published for publisher in self.output_publishers),
+                action))
+            self.__run_confirmed()
+
+    def __run_confirmed(self):
+        with self._send_lock:
+            if len(self._pending_commits) == 0:
+                return
+            try:
+                for publisher in self.output_publishers:
+                    publisher.process_confirms()
+            except (AMQPError, AMQPConnectorException):
+                self.__reconnect_to_output_queues()
+            while len(self._pending_commits) > 0 and all(publisher.confirmed >= number
+                    for publisher, number in zip(self.output_publishers, self._pending_commits[0][0])):
+                _, action = self._pending_commits.popleft()
+                try:
+                    action()
+                except Exception:
+                    print('Exception in committing a message:', traceback.format_exc())
+            if len(self._pending_commits) > 0 and self._confirms_timer is None:
+                # confirms are not received while nothing is published
+                self._confirms_timer = threading.Timer(self.CONFIRMS_POLL_INTERVAL, self.__poll_confirms)
+                self._confirms_timer.daemon = True
+                self._confirms_timer.start()
+
+    def __poll_confirms(self):
+        with self._send_lock:
+            self._confirms_timer = None
+            self.__run_confirmed()
+
+    @staticmethod
+    def _encode_message(message, output: RmqOutputInfo, encoded_bodies: dict):
+        # encoded_bodies keeps bodies already encoded for other outputs by codec and compression
+        if isinstance(message, (str, bytes)):
+            return message, output.properties
+        key = (output.codec.codec, output.codec.compression)
+        body = encoded_bodies.get(key)
+        if body is None:
+            body = output.codec.encode(message)
+            encoded_bodies[key] = body
+        return body, output.encoded_properties
+
+    def _merge_properties(self, output_properties: BasicProperties,
+            additional_headers: Optional[Dict[str, object]] = None):
+        # trace headers are added to every message, so properties are built per message without copying
+        # the empty headers of outputs
+        headers = output_properties.headers
+        if not headers:
+            headers = dict(additional_headers) if additional_headers else {}
+        else:
+            keys_intersection = headers.keys() & additional_headers.keys() if additional_headers else ()
+            if len(keys_intersection) > 0:
+                self._report_error(f'Warning: header key violation. Keys {keys_intersection} found in both '
+                        f'{headers} and {additional_headers}')
+            headers = dict(headers)
+            headers.update(additional_headers or {})
+        return BasicProperties(delivery_mode=output_properties.delivery_mode,
+            content_type=output_properties.content_type, content_encoding=output_properties.content_encoding,
+            headers=headers)
 
     def _run(self):
+        if self.input is not None and self.input.workers > 0:
+            self._worker_pool = KeyedWorkerPool(self.input.workers, self._handle_message_in_worker)
+            self._worker_pool.start()
         self.hive_commands_thread.start()
         self.hive_heartbeats_thread.start()
         self.suspended = False
@@ -258,38 +659,53 @@ class BaseService:
                 print(traceback.format_exc())
                 time.sleep(0.1)
 
+    def _create_heartbeat_message(self):
+        return {
+            'pipeline': self.flow_name,
+            'service': self.service_name,
+            'state': 'suspended' if self.suspended else 'ok',
+            'last_heartbeat_datetime': time.time(),
+            'last_received_message_datetime': self.state._last_received_message_datetime,
+            'last_sent_message_datetime': self.state._last_sent_message_datetime,
+            'latency': self._edges_latency.drain(),
+            'checkpoint': self.state.checkpoint_metrics()}
+
+    def _create_error_report(self, error_message, cause='Unknown'):
+        return {'pipeline': self.flow_name, 'service': self.service_name, 'text': error_message, 'cause': cause,
+            'timestamp': str(datetime.now())}
+
     def __send_heartbeats(self):
         while True:
-            try:
-                heartbeat_message = {
-                    'pipeline': self.flow_name,
-                    'service': self.service_name,
-                    'state': 'suspended' if self.suspended else 'ok',
-                    'last_heartbeat_datetime': time.time(),
-                    'last_received_message_datetime': self.state._last_received_message_datetime,
-                    'last_sent_message_datetime': self.state._last_sent_message_datetime}
-                self.hive_heartbeats_channel.basic_publish(exchange='', routing_key='heartbeats',
-                    body=json.dumps(heartbeat_message))
-            except (AMQPError, AMQPConnectorException):
-                print('Global RabbitMQ connection closed. Unable to send heartbeat. Reconnecting in 10 seconds')
-                while True:
-                    try:
-                        time.sleep(10)
-                        self.__connect_to_heartbeats_queue()
-                        break
-                    except (AMQPError, AMQPConnectorException, gaierror):
-                        print('Unable to reconnect to heartbeats queue. Next attempt in 10 seconds')
-            except Exception:
-                print(traceback.format_exc())
-                time.sleep(0.1)
+            with self._hive_lock:
+                self.__send_heartbeat()
             # print('heartbeat sent')
             time.sleep(5)
 
+    def __send_heartbeat(self):
+        try:
+            self.hive_heartbeats_channel.basic_publish(exchange='', routing_key='heartbeats',
+                body=json.dumps(self._create_heartbeat_message()))
+        except (AMQPError, AMQPConnectorException):
+            print('Global RabbitMQ connection closed. Unable to send heartbeat. Reconnecting in 10 seconds')
+            while True:
+                try:
+                    time.sleep(10)
+                    self.__connect_to_heartbeats_queue()
+                    break
+                except (AMQPError, AMQPConnectorException, gaierror):
+                    print('Unable to reconnect to heartbeats queue. Next attempt in 10 seconds')
+        except Exception:
+            print(traceback.format_exc())
+            time.sleep(0.1)
+
     def _report_error(self, error_message, cause='Unknown'):
+        with self._hive_lock:
+            self.__report_error_locked(error_message, cause)
+
+    def __report_error_locked(self, error_message, cause='Unknown'):
         try:
             print('ERROR', error_message)
-            body = {'pipeline': self.flow_name, 'service': self.service_name, 'text': error_message, 'cause': cause,
-                'timestamp': str(datetime.now())}
+            body = self._create_error_report(error_message, cause)
             self.hive_errors_channel.basic_publish(exchange='', routing_key='errors', body=json.dumps(body))
         except (AMQPError, AMQPConnectorException):
             print(f'Global RabbitMQ connection closed. Error message can\'t be reported: {error_message}. ' +
@@ -311,14 +727,70 @@ class BaseService:
 
 
 class ServiceUtils:
+    _imported_services = []
+
     @staticmethod
     def start_service(service: BaseService, name: str, config_files=('rmq_connection_details', 'common')):
         if name == "__main__":
             try:
                 config = Config(os.environ['CONF_PATH'], config_files)
+                ServiceUtils.set_transport(config)
                 service.set_config(config)
                 service.establish_rmq_connections()
                 service.load_state()
                 service._run()
             except:
                 print('Error occurred during startup:', traceback.format_exc())
+        else:
+            ServiceUtils._imported_services.append(service)
+
+    @staticmethod
+    def set_transport(config: Config):
+        # `type` of `transport` group: amqp (default) or memory
+        if config.has_property('transport', 'type'):
+            pika_utils.connection_manager.transport = config.get_property('transport', 'type')
+
+    @staticmethod
+    def start_pipeline(pipeline_name: str = None, config_files=('rmq_connection_details', 'common')) \
+            -> List[threading.Thread]:
+        """
+        Starts services of pipelines.json in threads of the current process, all pipelines by default
+        """
+        conf_path = os.environ['CONF_PATH']
+        config = Config(conf_path, config_files)
+        ServiceUtils.set_transport(config)
+        with open(conf_path + '/pipelines.json') as pipelines_file:
+            pipelines = json.load(pipelines_file)
+
+        threads = []
+        for flow_name, pipeline_info in pipelines.items():
+            if pipeline_name is not None and flow_name != pipeline_name:
+                continue
+            for service_name in pipeline_info['services']:
+                os.environ['FLOW_NAME'] = flow_name
+                os.environ['SERVICE_NAME'] = service_name
+                try:
+                    del ServiceUtils._imported_services[:]
+                    # modules of services used by several pipelines are run again for every one of them
+                    if service_name in sys.modules:
+                        importlib.reload(sys.modules[service_name])
+                    else:
+                        importlib.import_module(service_name)
+                    if len(ServiceUtils._imported_services) == 0:
+                        print(f'Module {service_name} does not start any service')
+                        continue
+                    service = ServiceUtils._imported_services[-1]
+                    service.flow_name = flow_name
+                    service.service_name = service_name
+                    # services of different pipelines may have the same name
+                    service.state_root = 'state/' + flow_name
+                    service.set_config(config)
+                    service.establish_rmq_connections()
+                    service.load_state()
+                    thread = threading.Thread(target=service._run, name=f'{flow_name}.{service_name}', daemon=True)
+                    thread.start()
+                    threads.append(thread)
+                    print(f'Service {flow_name}.{service_name} started')
+                except Exception:
+                    print(f'Error occurred during startup of {service_name}:', traceback.format_exc())
+        return threads
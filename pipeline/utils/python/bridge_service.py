@@ -36,13 +36,16 @@ class DbBridgeService(ProcessorService):
         """
         return self._db_service.execute_and_fetch(sql, args, with_columns, with_commit)
 
-    def _insert_from_df(self, table_name: str, df: DataFrame):
+    def _insert_from_df(self, table_name: str, df: Union[DataFrame, Iterable], columns: List[str] = None,
+            chunk_size: int = None):
         """
-        Insert data from pandas DataFrame
+        Insert data from pandas DataFrame by streaming COPY
         :param table_name: [schema_name].[table_name]
-        :param df: Columns names must be same as in DB
+        :param df: Columns names must be same as in DB. Iterables of row tuples or of record batches are also accepted
+        :param columns: names of the columns of the table, required for row tuples not covering all of the columns
+        :param chunk_size: rows encoded at once
         """
-        self._db_service.insert_data_from_df(table_name, df)
+        self._db_service.insert_data_from_df(table_name, df, columns, chunk_size)
 
     def _get_df_from_query(self, sql, args=None):
         if not args:
@@ -16,6 +16,9 @@ class Config:
             self._config.add_section(property_group)
         self._config.set(property_group, property_name, value)
 
+    def has_property(self, property_group: str, property_name: str):
+        return self._config.has_option(property_group, property_name)
+
     def get_property_group(self, property_group: str):
         return dict(self._config[property_group])
 
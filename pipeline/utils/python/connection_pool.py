@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of DB connections, `acquire` blocks up to `timeout` when `max_size` connections are in use
+    """
+    def __init__(self, connect: Callable[[], object], min_size: int = 1, max_size: int = 3, timeout: float = 30,
+            max_lifetime: float = 3600, health_check_interval: float = 30):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f'Invalid pool size: min_size={min_size}, max_size={max_size}')
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.closed = False
+        self._condition = threading.Condition()
+        # idle connections as (connection, created, last used), the most recently used ones at the right
+        self._idle = deque()
+        self._created = {}
+        self._size = 0
+        self._broken = 0
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_time_ms': 0.0, 'max_wait_ms': 0.0, 'timeouts': 0,
+            'connections_created': 0, 'reconnects': 0, 'health_check_failures': 0, 'expired': 0}
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append(self.__open())
+
+    def __open(self):
+        # the slot of the connection is reserved by the caller
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        now = time.monotonic()
+        with self._condition:
+            self._created[id(conn)] = now
+            self._stats['connections_created'] += 1
+            if self._broken > 0:
+                self._broken -= 1
+                self._stats['reconnects'] += 1
+        return conn, now, now
+
+    def __drop(self, conn, broken: bool):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._created.pop(id(conn), None)
+            self._size -= 1
+            if broken:
+                self._broken += 1
+            self._condition.notify()
+
+    def __is_healthy(self, conn, last_used: float) -> bool:
+        if conn.closed != 0:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout: float = None):
+        """
+        :param timeout: max seconds to wait for a free connection, `timeout` of the pool by default
+        :raise PoolTimeout: no connection was returned to the pool in time
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waited = None
+        while True:
+            with self._condition:
+                if self.closed:
+                    raise psycopg2.pool.PoolError('Connection pool is closed')
+                entry = None
+                if len(self._idle) > 0:
+                    entry = self._idle.pop()
+                elif self._size >= self.max_size:
+                    if waited is None:
+                        waited = time.monotonic()
+                        self._stats['waits'] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f'No DB connection available in {timeout} seconds, '
+                                          f'all {self.max_size} connections are in use')
+                    self._condition.wait(remaining)
+                    continue
+                else:
+                    self._size += 1
+
+            if entry is None:
+                entry = self.__open()
+            elif time.monotonic() - entry[1] > self.max_lifetime:
+                with self._condition:
+                    self._stats['expired'] += 1
+                self.__drop(entry[0], broken=False)
+                continue
+            elif not self.__is_healthy(entry[0], entry[2]):
+                with self._condition:
+                    self._stats['health_check_failures'] += 1
+                self.__drop(entry[0], broken=True)
+                continue
+
+            with self._condition:
+                self._stats['checkouts'] += 1
+                if waited is not None:
+                    wait_ms = (time.monotonic() - waited) * 1000
+                    self._stats['wait_time_ms'] += wait_ms
+                    self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+            return entry[0]
+
+    def release(self, conn, discard: bool = False):
+        """
+        Returns the connection to the pool. Open transactions are rolled back
+        :param discard: close the connection, e.g. after it was lost
+        """
+        with self._condition:
+            created = self._created.get(id(conn))
+        if created is None:
+            # connection of another pool or already dropped
+            conn.close()
+            return
+        if discard or conn.closed != 0:
+            self.__drop(conn, broken=True)
+            return
+        if self.closed:
+            self.__drop(conn, broken=False)
+            return
+        if time.monotonic() - created > self.max_lifetime:
+            with self._condition:
+                self._stats['expired'] += 1
+            self.__drop(conn, broken=False)
+            return
+        try:
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self.__drop(conn, broken=True)
+            return
+        with self._condition:
+            self._idle.append((conn, created, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """
+        Connection returned to the pool when the block exits, even if it raises
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except psycopg2.OperationalError:
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        self.release(conn)
+
+    def discard_idle(self, broken: bool = True):
+        """
+        Closes idle connections, e.g. after the server was restarted and all of them were lost
+        """
+        with self._condition:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _, _ in idle:
+            self.__drop(conn, broken)
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._condition.notify_all()
+        for conn, _, _ in idle:
+            self.__drop(conn, broken=False)
+
+    def stats(self) -> dict:
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update({'size': self._size, 'idle': len(self._idle), 'in_use': self._size - len(self._idle),
+                'min_size': self.min_size, 'max_size': self.max_size})
+        stats['wait_time_ms'] = round(stats['wait_time_ms'], 3)
+        stats['max_wait_ms'] = round(stats['max_wait_ms'], 3)
+        return stats
@@ -1,20 +1,47 @@
+import csv
+import functools
+import itertools
+import json
+import re
 import sys
+import threading
 import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from io import StringIO
 from os import environ
-from typing import Iterable, Union, List
+from typing import Iterable, Iterator, Optional, Union, List
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 import psycopg2.pool
+from psycopg2 import sql as pg_sql
 from pandas import DataFrame
 
 from config import Config
+from connection_pool import ConnectionPool, PoolTimeout
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = OrderedDict()
+        self.prepared_names = itertools.count()
 
 
 class PostgresDbConnection:
+    COPY_CHUNK_ROWS = 10000
+    STREAM_ITERSIZE = 2000
+    PREPARED_STATEMENTS_LIMIT = 256
+
     def __init__(self, conn_str: str = None, config: Config = None, dbname: str = None, user: str = None,
             password: str = None, host: str = None, port: Union[str, int] = None, rc_times=5, with_pool=True,
-            db_property_group: str = 'db', service_name=None):
+            db_property_group: str = 'db', service_name=None, pool_min_size: int = None, pool_max_size: int = None,
+            pool_timeout: float = None, pool_max_lifetime: float = None, pool_health_check_interval: float = None):
+        # pool settings not passed are taken from the same keys of the DB property group
+        db_conf = {}
         if conn_str is not None:
             self.connection_string = conn_str
         elif config is not None:
@@ -39,37 +66,111 @@ class PostgresDbConnection:
         self.connection_string += f' application_name={service_name}'
         self.rc_times = rc_times
         self.with_pool = with_pool
-        self.conn_pool = psycopg2.pool.ThreadedConnectionPool(1, 3, self.connection_string)
+        pool_settings = {}
+        for key, value, value_type in [('min_size', pool_min_size, int), ('max_size', pool_max_size, int),
+                ('timeout', pool_timeout, float), ('max_lifetime', pool_max_lifetime, float),
+                ('health_check_interval', pool_health_check_interval, float)]:
+            if value is None and db_conf.get('pool_' + key):
+                value = value_type(db_conf['pool_' + key])
+            if value is not None:
+                pool_settings[key] = value
+        self.conn_pool = ConnectionPool(self._connect, **pool_settings) if with_pool else None
+        self._local = threading.local()
+        self._unpreparable = set()
 
     def __reload_connection(self):
+        # the server has likely dropped other idle connections as well
         if self.with_pool:
-            self.conn_pool = psycopg2.pool.ThreadedConnectionPool(1, 3, self.connection_string)
+            self.conn_pool.discard_idle()
+
+    def _connect(self):
+        return psycopg2.connect(self.connection_string, connection_factory=PreparingConnection)
 
     def _get_connection(self):
         if not self.with_pool:
-            return psycopg2.connect(self.connection_string)
-        for _ in range(5):
+            return self._connect()
+        return self.conn_pool.acquire()
+
+    def _put_connection(self, conn, close=False):
+        if self.with_pool:
+            self.conn_pool.release(conn, discard=close)
+        else:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self._get_connection()
+        try:
+            yield conn
+        except psycopg2.OperationalError:
+            self._put_connection(conn, close=True)
+            raise
+        except BaseException:
+            self._put_connection(conn)
+            raise
+        self._put_connection(conn)
+
+    def pool_stats(self) -> Optional[dict]:
+        return self.conn_pool.stats() if self.with_pool else None
+
+    @contextmanager
+    def transaction(self):
+        # queries of the block are committed once at the end, nested blocks join the outer one
+        if getattr(self._local, 'connection', None) is not None:
+            yield self._local.connection
+            return
+        conn = self._get_connection()
+        self._local.connection = conn
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            if conn.closed == 0:
+                conn.rollback()
+            raise
+        finally:
+            self._local.connection = None
+            self._put_connection(conn)
+
+    def _run(self, work, with_commit: bool, description: str, cursor_factory=None):
+        # inside `transaction` the transaction connection is used and nothing is committed
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            with conn.cursor(cursor_factory=cursor_factory) as curs:
+                return work(curs)
+
+        for _ in range(self.rc_times):
+            conn = None
             try:
-                conn = self.conn_pool.getconn()
-                return conn
-            except psycopg2.pool.PoolError:
-                print('Connection pool is exhausted, trying to reconnect')
+                conn = self._get_connection()
+                with conn.cursor(cursor_factory=cursor_factory) as curs:
+                    result = work(curs)
+                if with_commit:
+                    conn.commit()
+                self._put_connection(conn)
+                return result
+
+            except psycopg2.OperationalError:
+                if conn is not None:
+                    self._put_connection(conn, close=True)
+                print('Connection lost, trying to reconnect..')
                 time.sleep(1)
                 self.__reload_connection()
+            except Exception:
+                if conn is not None:
+                    if conn.closed == 0:
+                        conn.rollback()
+                    self._put_connection(conn)
+                raise
 
-    def _put_connection(self, conn):
-        if self.with_pool and self.conn_pool:
-            self.conn_pool.putconn(conn)
+        raise ReconnectError(f'Reconnect in {description} failed {self.rc_times} times')
 
     def get_list_of_dict_from_query(self, sql: str, args: tuple = None) -> list:
-        data, columns = self.execute_and_fetch(sql, args, with_columns=True, with_commit=False)
-        result = []
-        for row in data:
-            row_result = {}
-            for i in range(len(row)):
-                row_result[columns[i]] = row[i]
-            result.append(row_result)
-        return result
+        def work(curs):
+            curs.execute(sql, args or None)
+            return curs.fetchall()
+
+        return self._run(work, False, sql, cursor_factory=psycopg2.extras.RealDictCursor)
 
     def get_df_from_query(self, sql: str, args: tuple = None) -> DataFrame:
         data, columns = self.execute_and_fetch(sql, args, with_columns=True, with_commit=False)
@@ -82,121 +183,176 @@ class PostgresDbConnection:
 
         return data
 
-    def execute_and_fetch(self, sql: str, args: tuple, with_columns, with_commit):
-        for _ in range(self.rc_times):
-            try:
-                conn = self._get_connection()
-                curs = conn.cursor()
-                if args:
-                    curs.execute(sql, args)
+    def _stream(self, sql: str, args: tuple, itersize: int, cursor_factory=None, chunked=False):
+        # the connection is held until the generator is exhausted or closed
+        conn = getattr(self._local, 'connection', None)
+        own_connection = conn is None
+        if own_connection:
+            conn = self._get_connection()
+        broken = False
+        try:
+            with conn.cursor(name=f'stream_{uuid.uuid4().hex}', cursor_factory=cursor_factory) as curs:
+                curs.itersize = itersize
+                curs.execute(sql, args or None)
+                if not chunked:
+                    yield from curs
                 else:
-                    curs.execute(sql)
-                # print(curs.query)
-                result = curs.fetchall()
-                if with_commit:
-                    conn.commit()
-                columns = [desc[0] for desc in curs.description] if with_columns else None
-                curs.close()
-                self._put_connection(conn)
-                if with_columns:
-                    return result, columns
-                return result
-
-            except psycopg2.OperationalError as ex:
-                print('Connection lost, trying to reconnect..')
-                time.sleep(1)
-                self.__reload_connection()
+                    while True:
+                        rows = curs.fetchmany(itersize)
+                        if len(rows) == 0:
+                            break
+                        yield rows, [desc[0] for desc in curs.description]
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        finally:
+            if own_connection:
+                self._put_connection(conn, close=broken)
+
+    def iter_rows(self, sql: str, args: tuple = None, itersize: int = None) -> Iterator[tuple]:
+        return self._stream(sql, args, itersize or self.STREAM_ITERSIZE)
+
+    def iter_dicts(self, sql: str, args: tuple = None, itersize: int = None) -> Iterator[dict]:
+        return self._stream(sql, args, itersize or self.STREAM_ITERSIZE, psycopg2.extras.RealDictCursor)
+
+    def iter_df_chunks(self, sql: str, args: tuple = None, itersize: int = None) -> Iterator[DataFrame]:
+        for rows, columns in self._stream(sql, args, itersize or self.STREAM_ITERSIZE, chunked=True):
+            yield DataFrame.from_records(rows, columns=columns)
 
-        raise ReconnectError(f'Reconnect in {sql} failed {self.rc_times} times')
+    def execute_and_fetch(self, sql: str, args: tuple, with_columns, with_commit):
+        def work(curs):
+            if args:
+                curs.execute(sql, args)
+            else:
+                curs.execute(sql)
+            # print(curs.query)
+            result = curs.fetchall()
+            if with_columns:
+                return result, [desc[0] for desc in curs.description]
+            return result
+
+        return self._run(work, with_commit, sql)
+
+    def execute_prepared(self, sql: str, args: tuple, with_fetch: bool = False, with_columns: bool = False,
+            with_commit: bool = True):
+        # statements with %% or named placeholders are executed as usual
+        def work(curs):
+            prepared = _prepared_form(sql)
+            name = self.__prepare(curs, sql, prepared[0]) if prepared is not None else None
+            if name is None:
+                curs.execute(sql, args or None)
+            else:
+                curs.execute(f'EXECUTE {name}{prepared[1]}', args or None)
+            if not with_fetch:
+                return None
+            result = curs.fetchall()
+            if with_columns:
+                return result, [desc[0] for desc in curs.description]
+            return result
+
+        return self._run(work, with_commit, sql)
+
+    def __prepare(self, curs, sql: str, body: str) -> Optional[str]:
+        statements = getattr(curs.connection, 'prepared_statements', None)
+        if statements is None or sql in self._unpreparable:
+            return None
+        name = statements.get(sql)
+        if name is not None:
+            statements.move_to_end(sql)
+            return name
+        name = f'pipeline_statement_{next(curs.connection.prepared_names)}'
+        try:
+            # the savepoint keeps the transaction usable if types of the parameters can't be inferred
+            curs.execute(f'SAVEPOINT pipeline_prepare; PREPARE {name} AS {body}; RELEASE SAVEPOINT pipeline_prepare')
+        except psycopg2.OperationalError:
+            raise
+        except psycopg2.Error as ex:
+            curs.execute('ROLLBACK TO SAVEPOINT pipeline_prepare')
+            print(f'Statement is executed without PREPARE: {str(ex).strip()}')
+            if len(self._unpreparable) >= self.PREPARED_STATEMENTS_LIMIT:
+                self._unpreparable.clear()
+            self._unpreparable.add(sql)
+            return None
+        statements[sql] = name
+        while len(statements) > self.PREPARED_STATEMENTS_LIMIT:
+            _, evicted = statements.popitem(last=False)
+            curs.execute(f'DEALLOCATE {evicted}')
+        return name
 
     def execute_many(self, sql_list: List[str], args_list: List[tuple]):
         if len(sql_list) != len(args_list):
             raise ValueError('len of lists must be equal')
 
-        for _ in range(self.rc_times):
-            try:
-                conn = self._get_connection()
-                curs = conn.cursor()
-                result = []
-                for sql, args in zip(sql_list, args_list):
-                    curs.execute(sql, args)
-                    result.append(curs.fetchall() if curs.description else None)
-                conn.commit()
-                curs.close()
-                self._put_connection(conn)
-                return result
-
-            except psycopg2.OperationalError as ex:
-                print('Connection lost, trying to reconnect..')
-                time.sleep(1)
-                self.__reload_connection()
+        def work(curs):
+            result = []
+            for sql, args in zip(sql_list, args_list):
+                curs.execute(sql, args)
+                result.append(curs.fetchall() if curs.description else None)
+            return result
 
-        raise ReconnectError(f'Reconnect in {sql_list} failed {self.rc_times} times')
+        return self._run(work, True, str(sql_list))
 
     def execute(self, sql: str, args: tuple):
-        for _ in range(self.rc_times):
-            try:
-                conn = self._get_connection()
-                curs = conn.cursor()
-                if args:
-                    curs.execute(sql, args)
-                else:
-                    curs.execute(sql)
-                conn.commit()
-                curs.close()
-                self._put_connection(conn)
-                return
+        def work(curs):
+            if args:
+                curs.execute(sql, args)
+            else:
+                curs.execute(sql)
 
-            except psycopg2.OperationalError:
-                print('Connection lost, trying to reconnect..')
-                time.sleep(1)
-                self.__reload_connection()
-
-        raise ReconnectError(f'Reconnect in {sql} failed {self.rc_times} times')
+        self._run(work, True, sql)
 
     def insert_batch(self, table_name: str, args_template: str, args_list: Iterable[tuple]):
-        for _ in range(self.rc_times):
-            try:
-                conn = self._get_connection()
-                curs = conn.cursor()
-                args_str = ','.join(curs.mogrify(f"({args_template})", args).decode("utf-8") for args in args_list)
-                curs.execute(f"INSERT INTO {table_name} VALUES " + args_str)
-                conn.commit()
-                curs.close()
-                self._put_connection(conn)
-                return
-
-            except psycopg2.OperationalError:
-                print('Connection lost, trying to reconnect..')
-                time.sleep(1)
-                self.__reload_connection()
+        args_list = list(args_list)
 
-        raise ReconnectError(f'Reconnect in insert_batch to {table_name} failed {self.rc_times} times')
+        def work(curs):
+            args_str = ','.join(curs.mogrify(f"({args_template})", args).decode("utf-8") for args in args_list)
+            curs.execute(f"INSERT INTO {table_name} VALUES " + args_str)
 
-    def insert_data_from_df(self, table_name, data: DataFrame):
-        sio = StringIO()
-        sio.write(data.to_csv(index=None, header=None, sep=';', escapechar='\\', doublequote=False))
-        sio.seek(0)
+        self._run(work, True, f'insert_batch to {table_name}')
 
-        for _ in range(self.rc_times):
-            try:
-                conn = self._get_connection()
-                with conn.cursor() as c:
-                    c.copy_from(sio, table_name, columns=data.columns, sep=';', null="")
-                    conn.commit()
-                return
-
-            except psycopg2.OperationalError:
-                self.__reload_connection()
-            except psycopg2.pool.PoolError:
-                self.__reload_connection()
+    def insert_data_from_df(self, table_name, data: Union[DataFrame, Iterable], columns: List[str] = None,
+            chunk_size: int = None):
+        # rows are encoded to CSV by chunks while COPY reads them, iterators are not retried
+        chunk_size = chunk_size or self.COPY_CHUNK_ROWS
+        if isinstance(data, DataFrame):
+            batches = [data]
+        else:
+            first, data = self._peek(data)
+            batches = data if isinstance(first, DataFrame) or hasattr(first, 'to_pandas') else None
+            if columns is None and batches is not None:
+                columns = list(_to_frame(first).columns)
+        if columns is None and isinstance(data, DataFrame):
+            columns = list(data.columns)
+
+        target = pg_sql.SQL(table_name)
+        if columns:
+            target = pg_sql.SQL('{} ({})').format(target, pg_sql.SQL(', ').join(map(pg_sql.Identifier, columns)))
+        query = pg_sql.SQL('COPY {} FROM STDIN WITH (FORMAT csv)').format(target)
+        one_shot = iter(data) is data
+        attempts = [0]
+
+        def work(curs):
+            if attempts[0] > 0 and one_shot:
+                raise ReconnectError(f'Connection lost in insert to {table_name}, data iterator can not be re-read')
+            attempts[0] += 1
+            chunks = _encode_frames(batches, chunk_size) if batches is not None else _encode_rows(data, chunk_size)
+            curs.copy_expert(query.as_string(curs), _CopyStream(chunks))
+
+        self._run(work, True, f'insert DF to {table_name}')
 
-        raise ReconnectError(f'Reconnect in insert DF to {table_name} failed {self.rc_times} times')
+    @staticmethod
+    def _peek(data: Iterable):
+        if iter(data) is not data:
+            return next(iter(data), None), data
+        first = next(data, None)
+        if first is None:
+            return None, iter(())
+        return first, _chain_first(first, data)
 
     def close(self):
         try:
-            if self.with_pool and self.conn_pool:
-                self.conn_pool.closeall()
+            if self.with_pool:
+                self.conn_pool.discard_idle(broken=False)
         except Exception as ex:
             print(f'Exception while closing connection: {ex}')
 
@@ -207,3 +363,102 @@ class PostgresDbConnection:
 
 class ReconnectError(Exception):
     pass
+
+
+_PLACEHOLDER = re.compile(r'%s(::[\w ]+\[\])?')
+
+
+@functools.lru_cache(maxsize=1024)
+def _prepared_form(sql: str):
+    # array casts are repeated in EXECUTE, as text arrays are not assignable to json[]
+    if '%%' in sql or '%(' in sql:
+        return None
+    casts = []
+
+    def number(match):
+        casts.append('%s' + (match.group(1) or ''))
+        return f'${len(casts)}' + (match.group(1) or '')
+
+    body = _PLACEHOLDER.sub(number, sql)
+    return body, f"({', '.join(casts)})" if len(casts) > 0 else ''
+
+
+def _chain_first(first, rest: Iterator):
+    yield first
+    yield from rest
+
+
+def _to_frame(batch) -> DataFrame:
+    return batch if isinstance(batch, DataFrame) else batch.to_pandas()
+
+
+def _encode_frames(batches: Iterable, chunk_size: int) -> Iterator[bytes]:
+    for batch in batches:
+        frame = _to_frame(batch)
+        for start in range(0, len(frame), chunk_size):
+            yield frame.iloc[start:start + chunk_size].to_csv(index=False, header=False).encode('utf8')
+
+
+def _array_element(value) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (list, tuple)):
+        return _array_literal(value)
+    if isinstance(value, dict):
+        value = json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _array_literal(values) -> str:
+    return '{' + ','.join(_array_element(value) for value in values) + '}'
+
+
+def _copy_value(value):
+    # the same types psycopg2 adapts for queries: lists are arrays, dicts are JSON
+    if isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, (list, tuple)):
+        return _array_literal(value)
+    return value
+
+
+def _encode_rows(rows: Iterable[tuple], chunk_size: int) -> Iterator[bytes]:
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    count = 0
+    for row in rows:
+        writer.writerow([_copy_value(value) for value in row])
+        count += 1
+        if count == chunk_size:
+            yield buffer.getvalue().encode('utf8')
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    if count > 0:
+        yield buffer.getvalue().encode('utf8')
+
+
+class _CopyStream:
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._chunk = b''
+        self._offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._offset = 0
+                if self._chunk is None:
+                    self._chunk = b''
+                    break
+            end = len(self._chunk) if size < 0 else self._offset + size
+            part = self._chunk[self._offset:end]
+            self._offset += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
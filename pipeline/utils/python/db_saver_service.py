@@ -1,117 +1,57 @@
+import uuid
 from copy import deepcopy
 
 from db_base import *
+from db_saver_utils import get_bulk_insert_on_conflict_sql_and_args, get_staging_upsert_sql_and_rows
 from finalizer_service import *
-
-
-class ObjectGeneration:
-    def __init__(self, retry_limit, delay):
-        super().__init__()
-        self.delay = delay
-        self.obj_limit = retry_limit
-        self.objects = {}
-        self.timer_started = False
-        self.timer = None
-        self.canceled = False
-
-    def update(self, data_id, data):
-        if data_id in self.objects:
-            self.objects[data_id]['data'] = data
-            return
-
-        self.objects[data_id] = {'data': data, 'counter': 0, 'processed': False}
-
-    def set_processed(self, data_id):
-        del self.objects[data_id]
-
-    def check_errors(self):
-        return not self.canceled and not self.timer_started and len(self.objects) > 0
-
-    def cancel(self):
-        if self.timer_started and self.timer is not None:
-            self.timer.cancel()
-            self.canceled = True
-            self.timer = None
-
-
-class GenerationList:
-    def __init__(self, generations: List[ObjectGeneration], db_save_method: classmethod, report_error: classmethod):
-        self.report_error = report_error
-        self.generations = generations
-        self.db_save_method = db_save_method
-        self.locker = threading.Lock()
-
-    def update(self, data_id, data):
-        for generation in self.generations:
-            if data_id in generation.objects:
-                generation.update(data_id, data)
-                return True
-
-        self.generations[0].update(data_id, data)
-        return False
-
-    def set_processed(self, data_id):
-        for generation in self.generations:
-            if data_id in generation.objects:
-                generation.set_processed(data_id)
-                return
-
-    def check_errors(self):
-        with self.locker:
-            for generation_num in range(len(self.generations)):
-                generation = self.generations[generation_num]
-                if generation.check_errors():
-                    generation.timer_started = True
-                    generation.timer = threading.Timer(generation.delay, self.process_errors, args=(generation_num,))
-                    generation.timer.start()
-
-    def process_errors(self, generation_num):
-        generation = self.generations[generation_num]
-        for data_id, data in reversed(list(generation.objects.items())):
-            status, exc = self.db_save_method(data_id, data['data'])
-            if status:
-                data['processed'] = True
-            else:
-                data['counter'] += 1
-                if data['counter'] >= generation.obj_limit and generation_num < len(self.generations) - 1:
-                    error_msg = f'Error occurred {data["counter"]} times in saving {data_id}:\n' \
-                                f'{BaseService.format_exception(exc)}'
-                    self.report_error(error_msg, cause=json.dumps(data['data']))
-                    data['processed'] = None
-
-        for data_id in list(generation.objects.keys()):
-            if generation.objects[data_id]['processed']:
-                generation.set_processed(data_id)
-            elif generation.objects[data_id]['processed'] is None:
-                self.generations[generation_num + 1].update(data_id, generation.objects[data_id]['data'])
-                generation.set_processed(data_id)
-
-        generation.timer_started = False
-        generation.timer = None
-        self.check_errors()
-
-    def stop(self):
-        for generation in self.generations:
-            generation.cancel()
+from retry_queue import RetryQueue
+import structural_diff
+from worker_pool import KeyedLocks
 
 
 class DbSaverService(FinalizerService):
-    def __init__(self, *args, db_property_group='db', close_after_save=False, **kwargs):
+    """
+    Failed saves are retried by the retry queue with backoff. Command `retry_inspect [limit]` adds waiting items
+    to the next heartbeat, `retry_flush [data_id ...]` retries them at once. Failed batches are saved one by one
+    """
+    STATE_MAPPING_KEYS = ('unprocessed_data',)
+    # the retry queue locks the state itself, `_save_to_db` has to lock the state it mutates
+    CONCURRENT_HANDLERS = True
+    BULK_COPY_THRESHOLD = 20000
+    RETRY_BASE_DELAY = 60
+    RETRY_MAX_DELAY = 24 * 60 * 60
+    RETRY_BATCH_SIZE = 100
+
+    def __init__(self, *args, db_property_group='db', close_after_save=False, prepare_statements=False,
+            db_pool_size: int = None, **kwargs):
+        """
+        :param prepare_statements: execute queries of `_execute_query` and `_execute_and_fetch` as statements
+        prepared on every connection
+        :param db_pool_size: max DB connections, `pool_max_size` of the DB config group or enough for every input
+        worker and the retry queue by default
+        """
         self.db_property_group = db_property_group
         self.close_after_query = close_after_save
+        self.prepare_statements = prepare_statements
+        self.db_pool_size = db_pool_size
+        self._retry_inspect_limit = 0
         super().__init__(*args, **kwargs)
 
     def _run(self):
-        self._db_service = PostgresDbConnection(config=self.config, db_property_group=self.db_property_group)
-        self.generation_list = GenerationList([
-            ObjectGeneration(retry_limit=10, delay=30 * 60),
-            ObjectGeneration(retry_limit=10, delay=3 * 60 * 60),
-            ObjectGeneration(retry_limit=0, delay=24 * 60 * 60)
-        ],
-            self.__save_to_db_locked,
-            self._report_error)
-
-        self._locker = threading.Lock()
+        pool_size = self.db_pool_size
+        if pool_size is None and not self.config.get_property_group(self.db_property_group).get('pool_max_size'):
+            pool_size = max(3, self.input.workers + 2)
+        self._db_service = PostgresDbConnection(config=self.config, db_property_group=self.db_property_group,
+            pool_max_size=pool_size)
+        self._id_locks = KeyedLocks()
+
+        self.retry_queue = RetryQueue(self.state, 'unprocessed_data', self.__save_to_db_locked, self._report_error,
+            base_delay=self.RETRY_BASE_DELAY, max_delay=self.RETRY_MAX_DELAY, batch_size=self.RETRY_BATCH_SIZE,
+            after_batch=self.__dump_state, name=f'{self.service_name}_retry')
+        self.retry_queue.load()
+        if len(self.retry_queue) > 0:
+            print(f'{len(self.retry_queue)} unprocessed data items are waiting for retry')
+        self.retry_queue.start()
         self._after_run()
         super()._run()
 
@@ -127,25 +67,82 @@ class DbSaverService(FinalizerService):
             self._handle_tagged_message(message, headers)
             return
 
-        data = json.loads(message)
-        data_id = self._get_id(data)
+        data_id, data = self.__resolve_data(message, headers)
+        if data is None:
+            return
         print(f'Received data with ID {data_id}')
-        exist = self.generation_list.update(data_id, data)
-        if exist:
-            print(f'Message with data_id={data_id} updated in errors_list')
+        if self.retry_queue.update(data_id, data):
+            print(f'Message with data_id={data_id} updated in retry queue')
             return
 
         status, exc = self.__save_to_db_locked(data_id, data)
+        if not status:
+            self.retry_queue.add(data_id, data, exc)
+
+    def _handle_batch(self, messages, headers_list):
+        items = []
+        for message, headers in zip(messages, headers_list):
+            try:
+                if headers and 'tag' in headers:
+                    print(f'Handling tagged message with headers {headers}')
+                    self._handle_tagged_message(message, headers)
+                    continue
+
+                data_id, data = self.__resolve_data(message, headers)
+            except Exception:
+                self._report_error(traceback.format_exc(), cause=message)
+                continue
+            if data is None:
+                continue
+            if self.retry_queue.update(data_id, data):
+                print(f'Message with data_id={data_id} updated in retry queue')
+                continue
+            items.append((data_id, data))
+
+        if len(items) == 0:
+            return
+        print(f'Received batch of {len(items)} data items')
+        status, _ = self.__save_batch_to_db_locked(items)
         if status:
-            self.generation_list.set_processed(data_id)
-        else:
-            self.generation_list.check_errors()
+            return
+        for data_id, data in items:
+            status, exc = self.__save_to_db_locked(data_id, data)
+            if not status:
+                self.retry_queue.add(data_id, data, exc)
 
     def _handle_tagged_message(self, message, headers):
         pass
 
+    def _get_message_key(self, message, headers):
+        if headers and 'tag' in headers:
+            return None
+        if headers and 'diff_format' in headers:
+            return headers['data_id']
+        return self._get_id(self.__load_data(message))
+
+    @staticmethod
+    def __load_data(message):
+        return json.loads(message) if isinstance(message, str) else message
+
+    def __resolve_data(self, message, headers):
+        data = self.__load_data(message)
+        if not headers or headers.get('diff_format', 'full') == 'full':
+            return self._get_id(data), data
+        data_id = headers['data_id']
+        if headers['diff_format'] != 'json-patch':
+            self._report_error(f'Unknown diff format {headers["diff_format"]} of data with ID {data_id}',
+                cause=message)
+            return data_id, None
+        waiting = self.retry_queue.get(data_id)
+        previous = waiting if waiting is not None else self._get_saved_data(data_id)
+        if previous is None:
+            self._report_error(f'Delta of data with ID {data_id} is skipped, there is no saved data to apply it to',
+                cause=message)
+            return data_id, None
+        return data_id, structural_diff.apply_patch(previous, data)
+
     def __save_to_db_locked(self, data_id, data):
-        with self._locker:
+        with self._id_locks.lock(data_id):
             try:
                 data_1 = deepcopy(data)
                 self._save_to_db(data_1)
@@ -161,6 +158,22 @@ class DbSaverService(FinalizerService):
                 if self.close_after_query:
                     self._db_service.close()
 
+    def __save_batch_to_db_locked(self, items):
+        with self._id_locks.lock_many(data_id for data_id, _ in items):
+            try:
+                self._save_batch_to_db([deepcopy(data) for _, data in items])
+                print(f'Batch of {len(items)} data items has been saved to DB')
+                return True, None
+            except Exception as ex:
+                print(f'==== ERROR in saving batch of {len(items)} data items, saving them one by one ====')
+                print(BaseService.format_exception(ex))
+                if hasattr(ex, 'pgerror'):
+                    print(ex.pgerror)
+                return False, ex
+            finally:
+                if self.close_after_query:
+                    self._db_service.close()
+
     def insert_or_update_data(self, check_sql, insert_sql, update_sql, check_args, insert_args, update_args,
             update_status=None):
         exists = self._execute_and_fetch(check_sql, check_args)
@@ -174,13 +187,67 @@ class DbSaverService(FinalizerService):
             result = self._execute_and_fetch(insert_sql, insert_args, with_commit=True)[0][0]
         return result
 
+    def __dump_state(self):
+        with self.state.write_lock:
+            self.state.dump(force=False)
+
+    def _create_heartbeat_message(self):
+        message = super()._create_heartbeat_message()
+        message['db_pool'] = self._db_service.pool_stats() if hasattr(self, '_db_service') else None
+        if hasattr(self, 'retry_queue'):
+            message['retry'] = self.retry_queue.summary()
+            if self._retry_inspect_limit > 0:
+                # items are added to the next heartbeat only
+                message['retry']['items'] = self.retry_queue.inspect(self._retry_inspect_limit)
+                self._retry_inspect_limit = 0
+        return message
+
+    def _handle_command(self, command, args):
+        super()._handle_command(command, args)
+
+        if command == 'retry_inspect':
+            self._retry_inspect_limit = int(args[0]) if len(args) > 0 and args[0] != '' else 20
+            if self._retry_inspect_limit > 0:
+                print(f'Waiting for retry: {json.dumps(self.retry_queue.inspect(self._retry_inspect_limit))}')
+
+        if command == 'retry_flush':
+            data_ids = [data_id for data_id in args if data_id]
+            print(f'{self.retry_queue.flush(data_ids or None)} unprocessed data items are scheduled for retry')
+
+    def _resume(self, args):
+        super()._resume(args)
+        # the state is reloaded on resume
+        self.retry_queue.load()
+
     def _hard_shutdown(self, args):
-        self.generation_list.stop()
+        self.retry_queue.stop()
         super()._hard_shutdown(args)
 
     def _save_to_db(self, data):
         raise NotImplementedError()
 
+    def _get_saved_data(self, data_id):
+        """
+        Required to receive DiffFinderService deltas, they are applied to the returned data
+        :return: data last saved with the id, None if there is none
+        """
+        raise NotImplementedError(f'{type(self).__name__} must override _get_saved_data to apply deltas '
+                                  f'of DiffFinderService delta_mode')
+
+    def _save_batch_to_db(self, list_of_data):
+        """
+        Saves a batch in a single transaction, by default item by item with `_save_to_db`
+        """
+        with self._transaction():
+            for data in list_of_data:
+                self._save_to_db(data)
+
+    def _transaction(self):
+        """
+        Context manager making queries of `_execute_*` helpers in the block a single transaction
+        """
+        return self._db_service.transaction()
+
     def _get_id(self, data) -> str:
         raise NotImplementedError()
 
@@ -190,7 +257,10 @@ class DbSaverService(FinalizerService):
         :param sql: SQL query with %s on args places
         :param args: tuple of arguments that would be placed into %s
         """
-        self._db_service.execute(sql, args)
+        if self.prepare_statements:
+            self._db_service.execute_prepared(sql, args)
+        else:
+            self._db_service.execute(sql, args)
 
     def _execute_and_fetch(self, sql: str, args: tuple = None, with_columns: bool = False, with_commit: bool = False):
         """
@@ -201,18 +271,48 @@ class DbSaverService(FinalizerService):
         """
         if not args:
             args = tuple()
+        if self.prepare_statements:
+            return self._db_service.execute_prepared(sql, args, True, with_columns, with_commit)
         return self._db_service.execute_and_fetch(sql, args, with_columns, with_commit)
 
+    def _bulk_upsert(self, table_name: str, list_of_dicts: List[dict], key_slice: list, constraint_name=None,
+            returning=None, do_nothing=False, chunk_size: int = None, copy_threshold: int = None):
+        """
+        Insert or update dicts with the same fields in one transaction, big batches are copied via a staging table
+        :return: returned rows if `returning` is set
+        """
+        if len(list_of_dicts) == 0:
+            return [] if returning else None
+        if len(list_of_dicts) >= (copy_threshold or self.BULK_COPY_THRESHOLD):
+            staging_table = f'pipeline_staging_{uuid.uuid4().hex[:12]}'
+            create_sql, columns, rows, upsert_sql = get_staging_upsert_sql_and_rows(table_name, staging_table,
+                list_of_dicts, key_slice, constraint_name, returning, do_nothing)
+            with self._transaction():
+                self._db_service.execute(create_sql, None)
+                self._db_service.insert_data_from_df(staging_table, rows, columns, chunk_size)
+                if returning:
+                    return self._db_service.execute_and_fetch(upsert_sql, None, False, False)
+                self._db_service.execute(upsert_sql, None)
+                return None
+
+        statements = get_bulk_insert_on_conflict_sql_and_args(table_name, list_of_dicts, key_slice, constraint_name,
+            returning, do_nothing, chunk_size)
+        results = self._execute_many([sql for sql, _ in statements], [args for _, args in statements])
+        return [row for rows in results for row in rows] if returning else None
+
     def _execute_many(self, sql_list, args_list):
         return self._db_service.execute_many(sql_list, args_list)
 
-    def _insert_from_df(self, table_name: str, df: DataFrame):
+    def _insert_from_df(self, table_name: str, df: Union[DataFrame, Iterable], columns: List[str] = None,
+            chunk_size: int = None):
         """
-        Insert data from pandas DataFrame
+        Insert data from pandas DataFrame by streaming COPY
         :param table_name: [schema_name].[table_name]
-        :param df: Columns names must be same as in DB
+        :param df: Columns names must be same as in DB. Iterables of row tuples or of record batches are also accepted
+        :param columns: names of the columns of the table, required for row tuples not covering all of the columns
+        :param chunk_size: rows encoded at once
         """
-        self._db_service.insert_data_from_df(table_name, df)
+        self._db_service.insert_data_from_df(table_name, df, columns, chunk_size)
 
     def _get_df_from_query(self, sql, args=None):
         if not args:
@@ -223,3 +323,12 @@ class DbSaverService(FinalizerService):
         if not args:
             args = tuple()
         return self._db_service.get_list_of_dict_from_query(sql, args)
+
+    def _iter_df_chunks_from_query(self, sql, args=None, itersize: int = None):
+        """
+        Streams the result of the query by a server-side cursor as DataFrames of `itersize` rows
+        """
+        return self._db_service.iter_df_chunks(sql, args, itersize)
+
+    def _iter_dicts_from_query(self, sql, args=None, itersize: int = None):
+        return self._db_service.iter_dicts(sql, args, itersize)
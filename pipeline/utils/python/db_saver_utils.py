@@ -1,3 +1,4 @@
+import functools
 import json
 from typing import List
 from cast_utils import *
@@ -15,8 +16,26 @@ returning - the string you will return
 constraint_name - the name of constraint in get_insert_on_conflict_sql_and_args
 do_nothing - bool for do_nothing case in get_insert_on_conflict_sql_and_args
 =======================================
+SQL of every function is cached by the shape of the data: table, columns, key fields, type casts and mode,
+so for the same shape only args are collected from the dict
 '''
 
+STATEMENT_CACHE_SIZE = 1024
+
+
+def _types_key(dict_of_types: dict) -> tuple:
+    return tuple(sorted(dict_of_types.items())) if dict_of_types else ()
+
+
+def _args_of(full_dict: dict, arg_keys: tuple) -> tuple:
+    return tuple(map(full_dict.__getitem__, arg_keys))
+
+
+def _column_names(columns: tuple) -> dict:
+    # builders take args from the dict by column names, so building the statement from a dict mapping every
+    # column to its name gives the order of the args instead of their values
+    return {column: column for column in columns}
+
 
 def _prepare_dict_to_json(dictionary: dict):
     typing_result = {}
@@ -81,6 +100,11 @@ def _get_insert_sql_and_args(table_name: str, full_dict: dict, dict_of_types: di
     return sql_result, tuple(arg_result)
 
 
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _insert_statement(table_name: str, columns: tuple, types: tuple, returning: str):
+    return _get_insert_sql_and_args(table_name, _column_names(columns), dict(types), returning)
+
+
 def get_insert_sql_and_args(table_name: str, full_dict: dict, returning: str = None):
     """
     Function generate an insert sql sting and args in tuple for PostgresConnection
@@ -92,7 +116,8 @@ def get_insert_sql_and_args(table_name: str, full_dict: dict, returning: str = N
     # prepare dict
     typing_ = _prepare_dict_to_json(full_dict)
 
-    return _get_insert_sql_and_args(table_name, full_dict, typing_, returning)
+    sql, arg_keys = _insert_statement(table_name, tuple(full_dict), _types_key(typing_), returning)
+    return sql, _args_of(full_dict, arg_keys)
 
 
 def insert_on_new_data(table_name: str, full_dict: dict, entity_ids: List, excluded_keys: List, dict_of_types=None) -> tuple:
@@ -108,6 +133,24 @@ def insert_on_new_data(table_name: str, full_dict: dict, entity_ids: List, exclu
     :param dict_of_types: dict of specific types if needed
     :return: returns two strings containing sql query and data for it
     """
+    if dict_of_types is None:
+        dict_of_types = {}
+    typing_ = _prepare_dict_to_json(full_dict)
+
+    sql, arg_keys = _insert_on_new_data_statement(table_name, tuple(full_dict), tuple(entity_ids),
+        tuple(excluded_keys), _types_key(dict_of_types), _types_key(typing_))
+    return sql, _args_of(full_dict, arg_keys)
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _insert_on_new_data_statement(table_name: str, columns: tuple, entity_ids: tuple, excluded_keys: tuple,
+        types: tuple, json_types: tuple):
+    return _get_insert_on_new_data_sql_and_args(table_name, _column_names(columns), entity_ids, excluded_keys,
+        dict(types), dict(json_types))
+
+
+def _get_insert_on_new_data_sql_and_args(table_name: str, full_dict: dict, entity_ids, excluded_keys,
+        dict_of_types: dict, typing_: dict) -> tuple:
 
     def _get_update_set_sql_and_args(data_dict, excluded_keys, dict_of_types: dict) -> tuple:
         """
@@ -127,11 +170,8 @@ def insert_on_new_data(table_name: str, full_dict: dict, entity_ids: List, exclu
         result_sql = ' AND '.join(result_sql)
         return result_sql, result_args
 
-    if dict_of_types is None:
-        dict_of_types = {}
     sql_query = f"INSERT INTO {table_name} "
     sql_args = []
-    typing_ = _prepare_dict_to_json(full_dict)
 
     columns_sql_parts = []
     values_sql_parts = []
@@ -175,6 +215,16 @@ def get_update_sql_and_args(table_name, full_dict, key_slice):
     # prepare dict
     typing_ = _prepare_dict_to_json(full_dict)
 
+    sql, arg_keys = _update_statement(table_name, tuple(full_dict), tuple(key_slice), _types_key(typing_))
+    return sql, _args_of(full_dict, arg_keys)
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _update_statement(table_name: str, columns: tuple, key_slice: tuple, types: tuple):
+    return _get_update_sql_and_args(table_name, _column_names(columns), key_slice, dict(types))
+
+
+def _get_update_sql_and_args(table_name, full_dict, key_slice, typing_: dict):
     # first preparations
     sql_result = f'UPDATE {table_name} SET '
     arg_result = []
@@ -221,6 +271,20 @@ def get_insert_on_conflict_sql_and_args(
     # prepare dict
     typing_ = _prepare_dict_to_json(full_dict)
 
+    sql, arg_keys = _insert_on_conflict_statement(table_name, tuple(full_dict), tuple(key_slice),
+        _types_key(typing_), constraint_name, returning, do_nothing)
+    return sql, _args_of(full_dict, arg_keys)
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _insert_on_conflict_statement(table_name: str, columns: tuple, key_slice: tuple, types: tuple,
+        constraint_name: str, returning: str, do_nothing: bool):
+    return _get_insert_on_conflict_sql_and_args(table_name, _column_names(columns), key_slice, dict(types),
+        constraint_name, returning, do_nothing)
+
+
+def _get_insert_on_conflict_sql_and_args(table_name, full_dict, key_slice, typing_: dict, constraint_name,
+        returning, do_nothing):
     # add insert
     result_sql, result_args = _get_insert_sql_and_args(table_name, full_dict, typing_)
 
@@ -252,3 +316,102 @@ def get_insert_on_conflict_sql_and_args(
         result_sql += f'RETURNING {returning} '
 
     return result_sql, tuple(result_args)
+
+
+BULK_CHUNK_ROWS = 1000
+
+
+def _prepare_dicts_to_json(list_of_dicts: List[dict]) -> tuple:
+    columns = tuple(list_of_dicts[0])
+    column_set = set(columns)
+    typing_ = {}
+    for full_dict in list_of_dicts:
+        if full_dict.keys() != column_set:
+            raise ValueError(f'all dicts must have the same fields, {sorted(full_dict)} != {sorted(columns)}')
+        typing_.update(_prepare_dict_to_json(full_dict))
+    return columns, typing_
+
+
+def _deduplicate_by_key_fields(list_of_dicts: List[dict], key_slice) -> List[dict]:
+    # a row can't be updated twice by one INSERT ... ON CONFLICT, the last dict wins as it would if saved one by one
+    key_fields = [__clear_field_name(keyword) for keyword in key_slice]
+    unique = {}
+    for full_dict in list_of_dicts:
+        key = json.dumps([full_dict[field] for field in key_fields], sort_keys=True, default=str)
+        unique.pop(key, None)
+        unique[key] = full_dict
+    return list(unique.values())
+
+
+def _get_on_conflict_excluded_sql(columns: tuple, key_slice: tuple, constraint_name, returning, do_nothing):
+    # the same update set as in get_insert_on_conflict_sql_and_args, values are taken from the proposed rows
+    result_sql = 'ON CONFLICT '
+    if constraint_name:
+        result_sql += f'ON CONSTRAINT {constraint_name} '
+    else:
+        result_sql += f"({', '.join([str(word) for word in key_slice])}) "
+
+    excluded_fields = set(columns) - set(key_slice) if do_nothing else set(key_slice)
+    dynamic_fields = set(columns) - excluded_fields if len(set(columns) - excluded_fields) > 0 else set(columns)
+    result_sql += 'DO UPDATE SET '
+    result_sql += ', '.join(f'{field} = EXCLUDED.{field}' for field in sorted(dynamic_fields)) + ' '
+
+    if returning:
+        result_sql += f'RETURNING {returning} '
+    return result_sql
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _bulk_insert_on_conflict_statement(table_name: str, columns: tuple, rows: int, key_slice: tuple, types: tuple,
+        constraint_name: str, returning: str, do_nothing: bool):
+    dict_of_types = dict(types)
+    row_sql = '(' + ', '.join(f'%s::{dict_of_types[column]}' if column in dict_of_types else '%s'
+        for column in columns) + ')'
+    result_sql = f"INSERT INTO {table_name}({', '.join(columns)}) VALUES {', '.join([row_sql] * rows)} "
+    return result_sql + _get_on_conflict_excluded_sql(columns, key_slice, constraint_name, returning, do_nothing)
+
+
+def get_bulk_insert_on_conflict_sql_and_args(table_name, list_of_dicts: List[dict], key_slice: list,
+        constraint_name=None, returning=None, do_nothing=False, chunk_size: int = None) -> List[tuple]:
+    """
+    Function generate multi-row insert_on_conflict sql stings and args for PostgresConnection, one for every
+    chunk of dicts. Dicts with equal key fields are saved once, the last of them
+    :param list_of_dicts: dicts with the same fields, as `full_dict` of get_insert_on_conflict_sql_and_args
+    :param chunk_size: max rows of every statement, BULK_CHUNK_ROWS by default
+    :return: list of sql sting and args in tuple
+    """
+    if len(list_of_dicts) == 0:
+        return []
+    chunk_size = chunk_size or BULK_CHUNK_ROWS
+    for full_dict in list_of_dicts:
+        _assert_not_none_values_in_key_fields(full_dict, key_slice)
+    columns, typing_ = _prepare_dicts_to_json(list_of_dicts)
+    list_of_dicts = _deduplicate_by_key_fields(list_of_dicts, key_slice)
+
+    result = []
+    for start in range(0, len(list_of_dicts), chunk_size):
+        chunk = list_of_dicts[start:start + chunk_size]
+        sql = _bulk_insert_on_conflict_statement(table_name, columns, len(chunk), tuple(key_slice),
+            _types_key(typing_), constraint_name, returning, do_nothing)
+        result.append((sql, tuple(full_dict[column] for full_dict in chunk for column in columns)))
+    return result
+
+
+def get_staging_upsert_sql_and_rows(table_name, staging_table, list_of_dicts: List[dict], key_slice: list,
+        constraint_name=None, returning=None, do_nothing=False) -> tuple:
+    """
+    Function generate sql for a set-based insert_on_conflict of dicts loaded into a temp staging table by COPY.
+    The statements must be executed in one transaction, the staging table is dropped on commit
+    :param staging_table: name of the temp table
+    :return: sql creating the staging table, its columns, iterator of rows to COPY into it and sql of the upsert
+    """
+    for full_dict in list_of_dicts:
+        _assert_not_none_values_in_key_fields(full_dict, key_slice)
+    columns, _ = _prepare_dicts_to_json(list_of_dicts)
+    list_of_dicts = _deduplicate_by_key_fields(list_of_dicts, key_slice)
+
+    create_sql = f'CREATE TEMP TABLE {staging_table} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP'
+    upsert_sql = f"INSERT INTO {table_name}({', '.join(columns)}) SELECT {', '.join(columns)} FROM {staging_table} "
+    upsert_sql += _get_on_conflict_excluded_sql(columns, tuple(key_slice), constraint_name, returning, do_nothing)
+    rows = (tuple(full_dict[column] for column in columns) for full_dict in list_of_dicts)
+    return create_sql, list(columns), rows, upsert_sql
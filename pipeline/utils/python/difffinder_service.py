@@ -1,14 +1,67 @@
 from processor_service import *
 import hashlib
-from typing import Union
+from typing import Union, Iterable, Tuple, List
+
+import hashing
+import structural_diff
+from hash_index import HashIndex, StateHashIndex, CompactHashIndex
 
 
 class DiffFinderService(ProcessorService):
+    STATE_MAPPING_KEYS = ('data_state', 'delta_state')
+    HASH_INDEXES = ('compact', 'state')
+    HASH_INDEX_FILE = 'data_index.bin'
+    DIGEST_ALGORITHMS = ('blake2b', 'legacy')
+
+    def __init__(self, *args, hash_index: str = 'state', index_max_entries: int = None, index_ttl: float = None,
+            digest_algorithm: str = 'legacy', delta_mode: bool = False, delta_depth: int = 3,
+            resync_every: int = 100, **kwargs):
+        # hash_index: 'state' keeps hex digests in state.data_state, 'compact' keeps raw digests in a bounded index.
+        # The index is filled from data_state on its first start, data_state is kept to allow switching back
+        # digest_algorithm: 'blake2b' or 'legacy' `get_full_hash`, legacy digests are matched and replaced by new ones
+        # delta_mode: changed paths are sent as JSON Patch with diff_format and data_id headers, whole data is sent
+        # again after resync_every deltas. Consumers have to apply them, DbSaverService by `_get_saved_data`
+        super().__init__(*args, **kwargs)
+        if hash_index not in self.HASH_INDEXES:
+            raise ValueError(f'Unknown hash index {hash_index}, expected one of {self.HASH_INDEXES}')
+        if delta_mode and self.state_backend != 'sqlite':
+            # hash trees of all ids would be rewritten by every dump of a json state
+            raise ValueError("delta_mode requires state_backend='sqlite'")
+        if digest_algorithm not in self.DIGEST_ALGORITHMS:
+            raise ValueError(f'Unknown digest algorithm {digest_algorithm}, expected one of {self.DIGEST_ALGORITHMS}')
+        self.hash_index_type = hash_index
+        self.digest_algorithm = digest_algorithm
+        self.delta_mode = delta_mode
+        self.delta_depth = delta_depth
+        self.resync_every = resync_every
+        self.index_max_entries = index_max_entries
+        self.index_ttl = index_ttl
+        self.hash_index: HashIndex = None
+
     def _init_state(self):
         self.state.data_state = {}
+        self.state.delta_state = {}
+
+    def load_state(self):
+        super().load_state()
+        self.hash_index = self._create_hash_index()
+        self.state.attach(self.hash_index)
+
+    def _create_hash_index(self) -> HashIndex:
+        if self.hash_index_type == 'state':
+            return StateHashIndex(self.state, 'data_state')
+        index = CompactHashIndex(self.state_path + '/' + self.HASH_INDEX_FILE, self.index_max_entries, self.index_ttl)
+        index.load()
+        if len(index) == 0 and len(self.state.data_state) > 0:
+            # digests of the state are copied into a new index
+            index.put_many((data_id, bytes.fromhex(hex_digest))
+                for data_id, hex_digest in self.state.data_state.items())
+            index.dump()
+        return index
 
     @staticmethod
     def get_full_hash(data: Union[dict, list]) -> str:
+        # keys and structure are ignored, so {"a": 1} and {"b": 1} collide
         def update_hash(data_to_hash):
             if isinstance(data_to_hash, dict):
                 for keyword in sorted(data_to_hash.keys()):
@@ -26,13 +79,55 @@ class DiffFinderService(ProcessorService):
         return hash_code.hexdigest()
 
     def _send_changes(self, data_id, data_to_send):
-        if self.check_data_not_processed(data_id, data_to_send):
-            self._send(json.dumps(data_to_send))
-            print(f"{data_id} sent")
+        if not self.check_data_not_processed(data_id, data_to_send):
+            return
+        if self.delta_mode:
+            self._send_delta(data_id, data_to_send)
+        else:
+            self._send(data_to_send)
+        print(f"{data_id} sent")
+
+    def _send_delta(self, data_id, data):
+        # hash trees are kept by string ids, the way json state keys are loaded
+        previous = self.state.delta_state.get(str(data_id))
+        resync = previous is None or previous['deltas'] >= self.resync_every
+        operations, tree = structural_diff.diff(None if resync else previous['tree'], data, self.delta_depth)
+        if resync:
+            self._send(data, {'diff_format': 'full', 'data_id': data_id})
+        elif len(operations) > 0:
+            self._send(operations, {'diff_format': 'json-patch', 'data_id': data_id})
+        self.state.delta_state[str(data_id)] = {'tree': tree, 'deltas': 0 if resync else previous['deltas'] + 1}
+
+    def _get_digest(self, data) -> bytes:
+        if self.digest_algorithm == 'legacy':
+            return bytes.fromhex(self.get_full_hash(data))
+        return hashing.digest(data)
+
+    def _get_digests(self, documents: List) -> List[bytes]:
+        if self.digest_algorithm == 'legacy':
+            return [bytes.fromhex(self.get_full_hash(data)) for data in documents]
+        return hashing.digest_many(documents)
 
     def check_data_not_processed(self, data_id, data):
-        if data_id not in self.state.data_state or self.state.data_state[data_id] != self.get_full_hash(data):
-            self.state.data_state[data_id] = self.get_full_hash(data)
+        if not self.__is_processed(data_id, data, self._get_digest(data)):
             return True
         # print(f"nothing new in {data_id}")  # TODO uncomment with debug mode logging when we finally invent logging
-        return False
\ No newline at end of file
+        return False
+
+    def __is_processed(self, data_id, data, digest: bytes) -> bool:
+        stored = self.hash_index.get(data_id)
+        if stored == digest:
+            return True
+        # legacy digests are longer, they are replaced by the current ones on the first check
+        processed = stored is not None and len(stored) != len(digest) and \
+            stored == bytes.fromhex(self.get_full_hash(data))
+        self.hash_index.put(data_id, digest)
+        return processed
+
+    def check_many_not_processed(self, items: Iterable[Tuple[object, object]]) -> List[bool]:
+        items = list(items)
+        digests = self._get_digests([data for _, data in items])
+        result = []
+        for (data_id, data), digest in zip(items, digests):
+            result.append(not self.__is_processed(data_id, data, digest))
+        return result
@@ -44,7 +44,10 @@ class FlaskApp:
                 pipelines_info_dict = {name: info.to_dict() for name, info in app_state.pipelines_info.items()}
                 pipelines_state_dict = {pipeline_name: {name: state.to_dict() for name, state in pipeline_state.items()}
                     for pipeline_name, pipeline_state in app_state.pipelines_state.items()}
-            return {'info': pipelines_info_dict, 'state': pipelines_state_dict}
+                latency_dict = {pipeline_name: {service: {predecessor: edge.to_dict()
+                    for predecessor, edge in edges.items()} for service, edges in pipeline_edges.items()}
+                    for pipeline_name, pipeline_edges in app_state.edges_latency.items()}
+            return {'info': pipelines_info_dict, 'state': pipelines_state_dict, 'latency': latency_dict}
 
     def run(self):
         self.app.run(host='0.0.0.0', port=8090)
@@ -0,0 +1,222 @@
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+
+class HashIndex:
+    """
+    Index of the last seen digest of every data id, used by DiffFinderService to skip unchanged data
+    """
+    def get(self, data_id) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    def put(self, data_id, digest: bytes):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def load(self):
+        pass
+
+    def dump(self):
+        pass
+
+
+class StateHashIndex(HashIndex):
+    """
+    Keeps hex digests in a mapping key of the state, the format DiffFinderService used before the index
+    """
+    def __init__(self, state, key: str):
+        self.state = state
+        self.key = key
+
+    def get(self, data_id) -> Optional[bytes]:
+        hex_digest = getattr(self.state, self.key).get(data_id)
+        return None if hex_digest is None else bytes.fromhex(hex_digest)
+
+    def put(self, data_id, digest: bytes):
+        getattr(self.state, self.key)[data_id] = digest.hex()
+
+    def __len__(self):
+        return len(getattr(self.state, self.key))
+
+
+class CompactHashIndex(HashIndex):
+    """
+    Raw digests in least recently seen order, evicted after `max_entries` or `ttl`. The file is append-only:
+    MAGIC, VERSION, then records of key type (1 byte), key length (2 bytes), key, entry length (1 byte), entry,
+    where later records replace earlier ones and empty entries remove the key
+    """
+    MAGIC = b'PHIX'
+    VERSION = 2
+    KEY_STR = 0
+    KEY_INT = 1
+    COMPACT_RATIO = 2
+    COMPACT_MIN_RECORDS = 10000
+    TOUCH_INTERVAL = 60 * 60
+    __HEADER = struct.Struct('<4sB')
+    __KEY_HEADER = struct.Struct('<BH')
+    __TIMESTAMP = struct.Struct('<d')
+
+    def __init__(self, path: str, max_entries: int = None, ttl: float = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = self.TOUCH_INTERVAL if ttl is None else min(self.TOUCH_INTERVAL, ttl / 2)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # file writes are serialized separately, so lookups are not blocked by them
+        self._file_lock = threading.Lock()
+        # entries changed since the previous dump, None for removed ones
+        self._changes = {}
+        # records in the file, None if the file has to be rewritten
+        self._file_records = None
+
+    def get(self, data_id) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(data_id)
+            if entry is None:
+                return None
+            now = time.time()
+            seen = self.__TIMESTAMP.unpack_from(entry)[0]
+            if self.ttl is not None and seen < now - self.ttl:
+                del self._entries[data_id]
+                self._changes[data_id] = None
+                return None
+            self._entries.move_to_end(data_id)
+            if now - seen >= self.touch_interval:
+                entry = self.__TIMESTAMP.pack(now) + entry[self.__TIMESTAMP.size:]
+                self._entries[data_id] = entry
+                self._changes[data_id] = entry
+            return entry[self.__TIMESTAMP.size:]
+
+    def put(self, data_id, digest: bytes):
+        with self._lock:
+            now = time.time()
+            entry = self.__TIMESTAMP.pack(now) + digest
+            self._entries[data_id] = entry
+            self._entries.move_to_end(data_id)
+            self._changes[data_id] = entry
+            self.__evict(now)
+
+    def put_many(self, items: Iterable[Tuple[object, bytes]]):
+        with self._lock:
+            now = time.time()
+            timestamp = self.__TIMESTAMP.pack(now)
+            for data_id, digest in items:
+                entry = timestamp + digest
+                self._entries[data_id] = entry
+                self._entries.move_to_end(data_id)
+                self._changes[data_id] = entry
+            self.__evict(now)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __evict(self, now: float):
+        if self.max_entries is not None:
+            while len(self._entries) > self.max_entries:
+                self._changes[self._entries.popitem(last=False)[0]] = None
+        if self.ttl is not None:
+            expired_before = now - self.ttl
+            while len(self._entries) > 0:
+                data_id, oldest = next(iter(self._entries.items()))
+                if self.__TIMESTAMP.unpack_from(oldest)[0] >= expired_before:
+                    break
+                del self._entries[data_id]
+                self._changes[data_id] = None
+
+    def load(self):
+        with self._file_lock, self._lock:
+            self._entries = OrderedDict()
+            self._changes = {}
+            self._file_records = None
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, 'rb') as index_file:
+                data = memoryview(index_file.read())
+            if len(data) < self.__HEADER.size:
+                return
+            magic, version = self.__HEADER.unpack_from(data)
+            if magic != self.MAGIC or version not in (1, self.VERSION):
+                raise ValueError(f'{self.path} is not a hash index of version {self.VERSION}')
+            offset = self.__HEADER.size
+            records = 0
+            while offset < len(data):
+                if offset + self.__KEY_HEADER.size > len(data):
+                    break
+                key_type, key_length = self.__KEY_HEADER.unpack_from(data, offset)
+                key_end = offset + self.__KEY_HEADER.size + key_length
+                if key_end >= len(data) or key_end + 1 + data[key_end] > len(data):
+                    # the last record was not written completely
+                    break
+                key = str(data[offset + self.__KEY_HEADER.size:key_end], 'utf8')
+                data_id = int(key) if key_type == self.KEY_INT else key
+                entry_length = data[key_end]
+                if entry_length == 0:
+                    self._entries.pop(data_id, None)
+                else:
+                    self._entries[data_id] = bytes(data[key_end + 1:key_end + 1 + entry_length])
+                    self._entries.move_to_end(data_id)
+                offset = key_end + 1 + entry_length
+                records += 1
+            # files of the previous version and files with a broken tail are rewritten by the next dump
+            if version == self.VERSION and offset == len(data):
+                self._file_records = records
+            self.__evict(time.time())
+
+    def dump(self):
+        """
+        Writes entries changed since the previous dump. Safe to call from a thread other than the one using the
+        index, e.g. from the state checkpointer
+        """
+        with self._file_lock:
+            with self._lock:
+                if len(self._changes) == 0 and self._file_records is not None:
+                    return
+                changes, self._changes = self._changes, {}
+                compact = self._file_records is None or self._file_records + len(changes) > \
+                    self.COMPACT_RATIO * len(self._entries) + self.COMPACT_MIN_RECORDS
+                records = list(self._entries.items()) if compact else list(changes.items())
+            try:
+                if compact:
+                    self.__rewrite(records)
+                    self._file_records = len(records)
+                else:
+                    self.__append(records)
+                    self._file_records += len(records)
+            except Exception:
+                # the tail of the file could be partially written
+                self._file_records = None
+                with self._lock:
+                    # changes made since are newer
+                    for data_id, entry in changes.items():
+                        self._changes.setdefault(data_id, entry)
+                raise
+
+    def __encode(self, records) -> bytes:
+        chunks = []
+        for data_id, entry in records:
+            key = str(data_id).encode('utf8')
+            chunks.append(self.__KEY_HEADER.pack(self.KEY_INT if type(data_id) is int else self.KEY_STR, len(key)))
+            chunks.append(key)
+            chunks.append(bytes((0 if entry is None else len(entry),)))
+            if entry is not None:
+                chunks.append(entry)
+        return b''.join(chunks)
+
+    def __rewrite(self, records):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as index_file:
+            index_file.write(self.__HEADER.pack(self.MAGIC, self.VERSION))
+            index_file.write(self.__encode(records))
+        os.replace(temp_path, self.path)
+
+    def __append(self, records):
+        with open(self.path, 'ab') as index_file:
+            index_file.write(self.__encode(records))
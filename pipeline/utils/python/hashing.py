@@ -0,0 +1,51 @@
+import hashlib
+import json
+from typing import Iterable, List
+
+DIGEST_SIZE = 16
+
+
+def _canonical_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': bytes(value).hex()}
+    return {'__' + type(value).__name__ + '__': str(value)}
+
+
+# keys are sorted and whitespace is omitted, so equal documents are always serialized into the same bytes,
+# while strings, numbers, booleans, nulls, keys and nesting keep JSON distinctions between them
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False, check_circular=False,
+    default=_canonical_default)
+
+
+def _stringify_keys(data):
+    if isinstance(data, dict):
+        return {str(key): _stringify_keys(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_stringify_keys(value) for value in data]
+    return data
+
+
+def canonical_bytes(data) -> bytes:
+    try:
+        return _encoder.encode(data).encode('utf8')
+    except TypeError:
+        # keys of different types can't be sorted, JSON turns them into strings anyway
+        return _encoder.encode(_stringify_keys(data)).encode('utf8')
+
+
+def digest(data, digest_size: int = DIGEST_SIZE) -> bytes:
+    """
+    blake2b digest of the canonical serialization, computed by the C JSON encoder and fed to the hash at once
+    """
+    return hashlib.blake2b(canonical_bytes(data), digest_size=digest_size).digest()
+
+
+def hexdigest(data, digest_size: int = DIGEST_SIZE) -> str:
+    return digest(data, digest_size).hex()
+
+
+def digest_many(documents: Iterable, digest_size: int = DIGEST_SIZE) -> List[bytes]:
+    blake2b = hashlib.blake2b
+    return [blake2b(canonical_bytes(document), digest_size=digest_size).digest() for document in documents]
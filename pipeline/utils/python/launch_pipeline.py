@@ -0,0 +1,8 @@
+import sys
+
+from base_service import ServiceUtils
+
+if __name__ == '__main__':
+    threads = ServiceUtils.start_pipeline(sys.argv[1] if len(sys.argv) > 1 else None)
+    for thread in threads:
+        thread.join()
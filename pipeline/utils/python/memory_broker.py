@@ -0,0 +1,338 @@
+import heapq
+import itertools
+import queue
+import re
+import threading
+import time
+from collections import deque
+
+from pika import BasicProperties
+from pika.exceptions import ChannelClosedByBroker
+from pika.frame import Method
+from pika.spec import Basic, Confirm
+
+import pika_utils
+
+
+class InMemoryBroker:
+    """
+    Process-local stand-in for RabbitMQ, brokers are identified by host name
+    """
+    _brokers = {}
+    _brokers_lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self.queues = {}
+        self.exchanges = {}
+
+    @classmethod
+    def get(cls, name) -> 'InMemoryBroker':
+        with cls._brokers_lock:
+            if name not in cls._brokers:
+                cls._brokers[name] = InMemoryBroker(name)
+            return cls._brokers[name]
+
+    @classmethod
+    def reset(cls):
+        with cls._brokers_lock:
+            cls._brokers.clear()
+
+    def declare_queue(self, name):
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = _InMemoryQueue(name, self.lock)
+
+    def declare_exchange(self, name, exchange_type):
+        with self.lock:
+            if name not in self.exchanges:
+                self.exchanges[name] = (exchange_type, [])
+
+    def bind(self, queue_name, exchange_name, routing_key):
+        with self.lock:
+            self.__get_exchange(exchange_name)[1].append((queue_name, routing_key or ''))
+
+    def publish(self, exchange_name, routing_key, body, properties):
+        with self.lock:
+            if exchange_name == '':
+                queue_names = [routing_key]
+            else:
+                exchange_type, bindings = self.__get_exchange(exchange_name)
+                queue_names = {queue_name for queue_name, binding_key in bindings
+                    if self.__matches(exchange_type, binding_key, routing_key)}
+            for queue_name in queue_names:
+                target = self.queues.get(queue_name)
+                if target is not None:
+                    target.put((exchange_name, routing_key, body, properties))
+
+    def __get_exchange(self, name):
+        if name not in self.exchanges:
+            raise ChannelClosedByBroker(404, f"NOT_FOUND - no exchange '{name}' in in-memory broker {self.name}")
+        return self.exchanges[name]
+
+    @staticmethod
+    def __matches(exchange_type, binding_key, routing_key):
+        if exchange_type == pika_utils.FANOUT:
+            return True
+        if exchange_type == pika_utils.TOPIC:
+            return _topic_pattern(binding_key).fullmatch('.' + routing_key) is not None
+        return binding_key == routing_key
+
+
+def _topic_pattern(binding_key):
+    # the pattern is matched against the routing key prefixed by a dot, so every word of it starts with a dot
+    # and `#` matches zero or more words together with their dots
+    parts = []
+    for word in binding_key.split('.'):
+        parts.append(r'\.[^.]*' if word == '*' else r'(?:\.[^.]*)*' if word == '#' else r'\.' + re.escape(word))
+    return re.compile(''.join(parts))
+
+
+class _InMemoryQueue:
+    def __init__(self, name, lock):
+        self.name = name
+        self.lock = lock
+        # (message, redelivered)
+        self.messages = deque()
+        self.consumers = []
+        self._next_consumer = 0
+
+    def put(self, message):
+        with self.lock:
+            self.messages.append((message, False))
+            self.dispatch()
+
+    def requeue(self, message):
+        with self.lock:
+            self.messages.appendleft((message, True))
+            self.dispatch()
+
+    def dispatch(self):
+        with self.lock:
+            while len(self.messages) > 0:
+                consumer = self.__next_ready_consumer()
+                if consumer is None:
+                    return
+                consumer.deliver(self, *self.messages.popleft())
+
+    def __next_ready_consumer(self):
+        for i in range(len(self.consumers)):
+            consumer = self.consumers[(self._next_consumer + i) % len(self.consumers)]
+            if consumer.is_ready():
+                self._next_consumer = (self._next_consumer + i + 1) % len(self.consumers)
+                return consumer
+        return None
+
+
+class _InMemoryConsumer:
+    def __init__(self, channel, consumer_tag, callback, auto_ack):
+        self.channel = channel
+        self.consumer_tag = consumer_tag
+        self.callback = callback
+        self.auto_ack = auto_ack
+
+    def is_ready(self):
+        return self.auto_ack or self.channel.prefetch_count <= 0 \
+            or len(self.channel.unacked) < self.channel.prefetch_count
+
+    def deliver(self, source_queue, message, redelivered=False):
+        exchange_name, routing_key, body, properties = message
+        delivery_tag = self.channel.next_delivery_tag()
+        if not self.auto_ack:
+            self.channel.unacked[delivery_tag] = (source_queue, message)
+        method = Basic.Deliver(consumer_tag=self.consumer_tag, delivery_tag=delivery_tag, redelivered=redelivered,
+            exchange=exchange_name, routing_key=routing_key)
+        self.channel.connection.add_callback_threadsafe(
+            lambda: self.callback(self.channel, method, properties, body))
+
+
+class InMemoryConnection:
+    """
+    Mirrors `pika.BlockingConnection`: deliveries, timers and thread-safe callbacks are dispatched only inside
+    `process_data_events` and `BlockingChannel.start_consuming` of the thread using the connection.
+    """
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        self.is_open = True
+        self._events = queue.Queue()
+        self._timers = []
+        self._cancelled_timers = set()
+        self._timer_ids = itertools.count(1)
+        self._channel_numbers = itertools.count(1)
+        self._channels = []
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self):
+        channel = InMemoryChannel(self, next(self._channel_numbers))
+        self._channels.append(channel)
+        return channel
+
+    def call_later(self, delay, callback):
+        timer_id = next(self._timer_ids)
+        heapq.heappush(self._timers, (time.monotonic() + delay, timer_id, callback))
+        return timer_id
+
+    def remove_timeout(self, timeout_id):
+        self._cancelled_timers.add(timeout_id)
+
+    def add_callback_threadsafe(self, callback):
+        self._events.put(callback)
+
+    def process_data_events(self, time_limit=0):
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        while True:
+            if self.__run_due_timers():
+                return
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if len(self._timers) > 0:
+                until_timer = max(0.0, self._timers[0][0] - time.monotonic())
+                timeout = until_timer if timeout is None else min(timeout, until_timer)
+            try:
+                callback = self._events.get(timeout=timeout) if timeout != 0 else self._events.get_nowait()
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                continue
+            callback()
+            while not self._events.empty():
+                self._events.get_nowait()()
+            return
+
+    def __run_due_timers(self):
+        executed = False
+        while len(self._timers) > 0 and self._timers[0][0] <= time.monotonic():
+            _, timer_id, callback = heapq.heappop(self._timers)
+            if timer_id in self._cancelled_timers:
+                self._cancelled_timers.discard(timer_id)
+                continue
+            callback()
+            executed = True
+        return executed
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        for channel in list(self._channels):
+            channel.close()
+        self.is_open = False
+
+
+class InMemoryChannel:
+    """
+    Mirrors the part of `pika.adapters.blocking_connection.BlockingChannel` used by the services. It is also its
+    own `_impl`, so `pika_utils.ConfirmedPublisher` works on top of it: every publish is confirmed at once.
+    """
+    def __init__(self, connection: InMemoryConnection, channel_number):
+        self._connection = connection
+        self._impl = self
+        self.channel_number = channel_number
+        self.is_open = True
+        self.prefetch_count = 0
+        self.unacked = {}
+        self._consumers = {}
+        self._consumer_tags = itertools.count(1)
+        self._delivery_tags = itertools.count(1)
+        self._publish_tags = itertools.count(1)
+        self._confirm_callback = None
+        self._consuming = False
+
+    @property
+    def connection(self):
+        return self._connection
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    @property
+    def broker(self):
+        return self._connection.broker
+
+    def next_delivery_tag(self):
+        return next(self._delivery_tags)
+
+    def queue_declare(self, queue, passive=False, durable=False, exclusive=False, auto_delete=False, arguments=None):
+        self.broker.declare_queue(queue)
+
+    def exchange_declare(self, exchange, exchange_type=pika_utils.DIRECT, passive=False, durable=False,
+            auto_delete=False, internal=False, arguments=None):
+        self.broker.declare_exchange(exchange, exchange_type)
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        self.broker.bind(queue, exchange, routing_key)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, exclusive=False, consumer_tag=None,
+            arguments=None):
+        with self.broker.lock:
+            consumer_tag = consumer_tag or f'ctag{self.channel_number}.{next(self._consumer_tags)}'
+            consumer = _InMemoryConsumer(self, consumer_tag, on_message_callback, auto_ack)
+            target = self.broker.queues[queue]
+            self._consumers[consumer_tag] = (target, consumer)
+            target.consumers.append(consumer)
+            target.dispatch()
+            return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        with self.broker.lock:
+            if consumer_tag in self._consumers:
+                target, consumer = self._consumers.pop(consumer_tag)
+                target.consumers.remove(consumer)
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and len(self._consumers) > 0 and self.is_open:
+            self._connection.process_data_events(time_limit=0.1)
+
+    def stop_consuming(self, consumer_tag=None):
+        for tag in [consumer_tag] if consumer_tag else list(self._consumers):
+            self.basic_cancel(tag)
+        self._consuming = False
+
+    def confirm_delivery(self, ack_nack_callback=None, callback=None):
+        self._confirm_callback = ack_nack_callback
+        if callback is not None:
+            callback(Method(self.channel_number, Confirm.SelectOk()))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if not self.is_open:
+            raise ChannelClosedByBroker(504, 'CHANNEL_ERROR - channel is closed')
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        self.broker.publish(exchange, routing_key, body, properties or BasicProperties())
+        if self._confirm_callback is not None:
+            self._confirm_callback(Method(self.channel_number, Basic.Ack(delivery_tag=next(self._publish_tags))))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.__settle(delivery_tag, multiple, requeue=False)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.__settle(delivery_tag, multiple, requeue)
+
+    def __settle(self, delivery_tag, multiple, requeue):
+        with self.broker.lock:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+            sources = set()
+            for tag in tags:
+                source_queue, message = self.unacked.pop(tag, (None, None))
+                if source_queue is None:
+                    continue
+                if requeue:
+                    source_queue.requeue(message)
+                sources.add(source_queue)
+            for source_queue in sources:
+                source_queue.dispatch()
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        if not self.is_open:
+            return
+        self.stop_consuming()
+        with self.broker.lock:
+            unacked, self.unacked = self.unacked, {}
+            for source_queue, message in unacked.values():
+                source_queue.requeue(message)
+        self.is_open = False
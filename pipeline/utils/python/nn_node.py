@@ -32,14 +32,17 @@ class NNNode(BaseService):
         time.sleep(0.1)
 
     def _process_unfinished_task(self):
-        if self.state._current_message is not None:
-            print('There is unfinished task in the state. Processing started')
+        records = self.journal.recover()
+        if len(records) > 0:
+            print(f'There are {len(records)} unfinished tasks in the journal. Processing started')
+        for record in records:
             try:
-                self._handle_message(self.state._current_message)
+                self._handle_message(record['message'], record['headers'] or {})
             except AMQPError:
                 self.__handle_rmq_disconnect()
             except Exception:
                 self.__handle_processing_error()
+            self.journal.commit(record['id'])
 
     def _run(self):
         super()._run()
@@ -1,17 +1,23 @@
+import threading
+from collections import OrderedDict
+
+from pika.spec import Basic
+
 DIRECT = 'direct'
 FANOUT = 'fanout'
 TOPIC = 'topic'
 HEADERS = 'headers'
 
+AMQP_TRANSPORT = 'amqp'
+MEMORY_TRANSPORT = 'memory'
+
 
 class Blocking:
     @staticmethod
     def queue(queue_name, callback=None, exchange_name=None, routing_key=None, exchange_type=DIRECT, host='localhost',
-            port=None, username='guest', password='guest', prefetch_count=0, durable=False):
+            port=None, username='guest', password='guest', prefetch_count=0, durable=False, scope=None):
         from pika.adapters.blocking_connection import BlockingChannel
-        connection = Blocking.create_connection(host, port, username, password)
-
-        channel: BlockingChannel = connection.channel()
+        channel: BlockingChannel = connection_manager.channel(host, port, username, password, scope)
         channel.queue_declare(queue=queue_name, durable=durable)
         if exchange_name is not None:
             channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type)
@@ -27,11 +33,9 @@ class Blocking:
 
     @staticmethod
     def exchange(name, exchange_type=DIRECT, host='localhost', port=None, username='guest', password='guest',
-            durable=False):
+            durable=False, scope=None):
         from pika.adapters.blocking_connection import BlockingChannel
-        connection = Blocking.create_connection(host, port, username, password)
-
-        channel: BlockingChannel = connection.channel()
+        channel: BlockingChannel = connection_manager.channel(host, port, username, password, scope)
         channel.exchange_declare(exchange=name, exchange_type=exchange_type, durable=durable)
         return channel
 
@@ -46,3 +50,201 @@ class Blocking:
             connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port, heartbeat=0,
                 credentials=credentials))
         return connection
+
+
+# one blocking connection per broker profile and scope, the current thread by default
+class ConnectionManager:
+    def __init__(self, transport=AMQP_TRANSPORT):
+        self.transport = transport
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get_connection(self, host, port, username, password, scope=None):
+        key = (host, port, username, password, threading.get_ident() if scope is None else scope)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None or not connection.is_open:
+                connection = self.__create_connection(host, port, username, password)
+                self._connections[key] = connection
+            return connection
+
+    def __create_connection(self, host, port, username, password):
+        if self.transport == MEMORY_TRANSPORT:
+            from memory_broker import InMemoryBroker, InMemoryConnection
+            return InMemoryConnection(InMemoryBroker.get(host))
+        return Blocking.create_connection(host, port, username, password)
+
+    def channel(self, host, port, username, password, scope=None):
+        return self.get_connection(host, port, username, password, scope).channel()
+
+    def close_all(self):
+        with self._lock:
+            for connection in self._connections.values():
+                try:
+                    if connection.is_open:
+                        connection.close()
+                except Exception as ex:
+                    print(f'Exception while closing connection: {ex}')
+            self._connections.clear()
+
+
+connection_manager = ConnectionManager()
+
+
+class Asyncio:
+    RPC_TIMEOUT = 30
+
+    @staticmethod
+    async def create_connection(host, port, username, password, on_close_callback=None):
+        import asyncio
+        import pika
+        from pika.adapters.asyncio_connection import AsyncioConnection
+        from pika.exceptions import AMQPConnectionError
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def on_open_error(connection, error):
+            if not future.done():
+                future.set_exception(error if isinstance(error, Exception) else AMQPConnectionError(error))
+
+        credentials = pika.PlainCredentials(username, password)
+        if port is None:
+            parameters = pika.ConnectionParameters(host=host, heartbeat=0, credentials=credentials)
+        else:
+            parameters = pika.ConnectionParameters(host=host, port=port, heartbeat=0, credentials=credentials)
+        AsyncioConnection(parameters, on_open_callback=future.set_result, on_open_error_callback=on_open_error,
+            on_close_callback=on_close_callback, custom_ioloop=loop)
+        return await asyncio.wait_for(future, Asyncio.RPC_TIMEOUT)
+
+    @staticmethod
+    async def channel(connection):
+        import asyncio
+        future = asyncio.get_event_loop().create_future()
+        connection.channel(on_open_callback=future.set_result)
+        return await asyncio.wait_for(future, Asyncio.RPC_TIMEOUT)
+
+    @staticmethod
+    async def call(method, *args, **kwargs):
+        import asyncio
+        future = asyncio.get_event_loop().create_future()
+
+        def callback(result):
+            if not future.done():
+                future.set_result(result)
+
+        method(*args, callback=callback, **kwargs)
+        return await asyncio.wait_for(future, Asyncio.RPC_TIMEOUT)
+
+    @staticmethod
+    async def queue(channel, queue_name, exchange_name=None, routing_key=None, exchange_type=DIRECT,
+            prefetch_count=0, durable=False):
+        await Asyncio.call(channel.queue_declare, queue=queue_name, durable=durable)
+        if exchange_name is not None:
+            await Asyncio.call(channel.exchange_declare, exchange=exchange_name, exchange_type=exchange_type)
+            key_words = (routing_key or queue_name).split('.')
+            for i in range(1, len(key_words) + 1):
+                key = '.'.join(key_words[:i])
+                await Asyncio.call(channel.queue_bind, queue_name, exchange_name, routing_key=key)
+        if prefetch_count > 0:
+            await Asyncio.call(channel.basic_qos, prefetch_count=prefetch_count)
+
+    @staticmethod
+    async def exchange(channel, name, exchange_type=DIRECT, durable=False):
+        await Asyncio.call(channel.exchange_declare, exchange=name, exchange_type=exchange_type, durable=durable)
+
+
+# publishing blocks only when confirm_window messages are unconfirmed, nacked messages are published again.
+# Published messages are numbered, so callers can wait for the confirmation of the messages they published
+class ConfirmedPublisher:
+    def __init__(self, channel, confirm_window: int = 0):
+        self.channel = channel
+        self.confirm_window = confirm_window
+        self.published = 0
+        self._unconfirmed = OrderedDict()
+        self._nacked = []
+        self._next_delivery_tag = 1
+        self._impl = getattr(channel, '_impl', None)
+        if confirm_window > 0 and self._impl is None:
+            channel.confirm_delivery()
+            self.confirm_window = 0
+        elif confirm_window > 0:
+            # BlockingChannel.confirm_delivery makes every publish wait for its confirmation,
+            # so confirms are tracked on the underlying asynchronous channel
+            select_ok = []
+            self._impl.confirm_delivery(ack_nack_callback=self.__on_confirmation, callback=select_ok.append)
+            while len(select_ok) == 0:
+                channel.connection.process_data_events(time_limit=1)
+
+    @property
+    def unconfirmed_messages(self) -> list:
+        return [message for _, message in self._nacked + list(self._unconfirmed.values())]
+
+    @property
+    def confirmed(self) -> int:
+        # number of the last message confirmed together with all messages before it
+        numbers = [number for number, _ in self._nacked] + [number for number, _ in self._unconfirmed.values()]
+        return min(numbers) - 1 if len(numbers) > 0 else self.published
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        self.published += 1
+        self.__send(self.published, (exchange, routing_key, body, properties))
+
+    def take_over(self, previous: 'ConfirmedPublisher'):
+        # messages left unconfirmed on a lost channel are published again with their numbers
+        self.published = previous.published
+        for number, message in sorted(previous._nacked + list(previous._unconfirmed.values()),
+                key=lambda item: item[0]):
+            self.__send(number, message)
+
+    def process_confirms(self):
+        if self.confirm_window > 0:
+            self.channel.connection.process_data_events(time_limit=0)
+            self.__republish_nacked()
+
+    def wait_for_confirms(self):
+        while len(self._unconfirmed) > 0 or len(self._nacked) > 0:
+            self.__republish_nacked()
+            self.channel.connection.process_data_events(time_limit=1)
+
+    def __send(self, number, message):
+        if self.confirm_window <= 0:
+            exchange, routing_key, body, properties = message
+            self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+            return
+        self.__republish_nacked()
+        while len(self._unconfirmed) >= self.confirm_window:
+            self.channel.connection.process_data_events(time_limit=1)
+            self.__republish_nacked()
+        self.__publish(number, message)
+        self.channel.connection.process_data_events(time_limit=0)
+
+    def __publish(self, number, message):
+        exchange, routing_key, body, properties = message
+        delivery_tag = self._next_delivery_tag
+        self._unconfirmed[delivery_tag] = (number, message)
+        try:
+            self._impl.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                properties=properties)
+        except Exception:
+            del self._unconfirmed[delivery_tag]
+            raise
+        self._next_delivery_tag += 1
+
+    def __republish_nacked(self):
+        nacked, self._nacked = self._nacked, []
+        for number, message in nacked:
+            self.__publish(number, message)
+
+    def __on_confirmation(self, frame):
+        method = frame.method
+        nacked = isinstance(method, Basic.Nack)
+        if method.multiple:
+            while len(self._unconfirmed) > 0 and next(iter(self._unconfirmed)) <= method.delivery_tag:
+                _, item = self._unconfirmed.popitem(last=False)
+                if nacked:
+                    self._nacked.append(item)
+        else:
+            item = self._unconfirmed.pop(method.delivery_tag, None)
+            if nacked and item is not None:
+                self._nacked.append(item)
@@ -13,6 +13,8 @@ class ProcessorService(BaseService):
     def _resume(self, args):
         if not self.suspended:
             return
+        # only snapshots changed while the service was suspended are read again
+        self.state.flush()
         self.state.load()
         super()._resume(args)
 
@@ -32,15 +34,18 @@ class ProcessorService(BaseService):
         time.sleep(0.1)
 
     def _process_unfinished_task(self):
-        if self.state._current_message is not None:
-            print('There is unfinished task in the state. Processing started')
+        records = self.journal.recover()
+        if len(records) > 0:
+            print(f'There are {len(records)} unfinished tasks in the journal. Processing started')
+        for record in records:
             try:
-                headers = self.state._current_headers or {}
-                self._handle_message(self.state._current_message, headers)
+                headers = record['headers'] or {}
+                self._handle_message(record['message'], headers)
             except (AMQPError, AMQPConnectorException):
                 self.__handle_rmq_disconnect()
             except Exception:
                 self.__handle_processing_error()
+            self.journal.commit(record['id'])
 
     def _run(self):
         super()._run()
@@ -0,0 +1,207 @@
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+
+
+class RetryQueue:
+    """
+    Failed saves kept in a mapping key of the state and retried with exponential backoff and jitter.
+    The state write lock is taken before the lock of the queue
+    """
+    def __init__(self, state, key: str, retry_method: Callable, report_error: Callable, base_delay: float = 60,
+            max_delay: float = 24 * 60 * 60, multiplier: float = 2, jitter: float = 0.2, batch_size: int = 100,
+            report_every: int = 10, after_batch: Callable = None, name: str = 'retry_queue'):
+        """
+        :param retry_method: called with data id and data, returns (status, exception)
+        """
+        self.state = state
+        self.key = key
+        self.retry_method = retry_method
+        self.report_error = report_error
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.report_every = report_every
+        self.after_batch = after_batch
+        self.name = name
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._in_progress = set()
+        self._stopped = False
+        self._thread = None
+        self._stats = {'retried': 0, 'succeeded': 0, 'failed': 0}
+
+    @property
+    def _store(self):
+        return getattr(self.state, self.key)
+
+    def load(self):
+        """
+        Schedules items of the store, call it after the state is loaded
+        """
+        with self._condition:
+            self._heap = [(entry['next_attempt'], next(self._sequence), item_key)
+                for item_key, entry in self._store.items()]
+            heapq.heapify(self._heap)
+            self._condition.notify()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.__work, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def __len__(self):
+        return len(self._store)
+
+    def _delay(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempts - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def __schedule(self, item_key: str, entry: dict):
+        self._store[item_key] = entry
+        heapq.heappush(self._heap, (entry['next_attempt'], next(self._sequence), item_key))
+        self._condition.notify()
+
+    def get(self, data_id):
+        """
+        :return: data of the waiting item, None if there is no item with the id
+        """
+        with self._condition:
+            entry = self._store.get(str(data_id))
+            return None if entry is None else entry['data']
+
+    def update(self, data_id, data) -> bool:
+        """
+        Replaces data of a waiting item
+        :return: False if there is no item with the id
+        """
+        item_key = str(data_id)
+        with self.state.write_lock, self._condition:
+            entry = self._store.get(item_key)
+            if entry is None:
+                return False
+            entry = dict(entry, data=data, version=entry['version'] + 1)
+            self._store[item_key] = entry
+            return True
+
+    def add(self, data_id, data, exception: Optional[BaseException] = None):
+        """
+        Schedules the first retry of data which failed to be saved, or replaces data of a waiting item
+        """
+        now = time.time()
+        with self.state.write_lock, self._condition:
+            if self.update(data_id, data):
+                return
+            self.__schedule(str(data_id), {'data_id': data_id, 'data': data, 'attempts': 1,
+                'next_attempt': now + self._delay(1), 'first_failed': now, 'version': 0,
+                'last_error': self.__describe(exception)})
+
+    @staticmethod
+    def __describe(exception: Optional[BaseException]) -> Optional[str]:
+        if exception is None:
+            return None
+        return ''.join(traceback.format_exception_only(type(exception), exception)).strip()
+
+    def flush(self, data_ids: List = None) -> int:
+        """
+        Makes waiting items due at once, all items if data_ids is None
+        """
+        now = time.time()
+        with self.state.write_lock, self._condition:
+            item_keys = list(self._store.keys()) if data_ids is None else [str(data_id) for data_id in data_ids]
+            scheduled = 0
+            for item_key in item_keys:
+                entry = self._store.get(item_key)
+                if entry is not None:
+                    self.__schedule(item_key, dict(entry, next_attempt=now))
+                    scheduled += 1
+            return scheduled
+
+    def __take_due(self) -> list:
+        now = time.time()
+        due = []
+        while len(self._heap) > 0 and len(due) < self.batch_size and self._heap[0][0] <= now:
+            next_attempt, _, item_key = heapq.heappop(self._heap)
+            entry = self._store.get(item_key)
+            # heap entries of removed and rescheduled items are skipped
+            if entry is None or entry['next_attempt'] != next_attempt or item_key in self._in_progress:
+                continue
+            self._in_progress.add(item_key)
+            due.append((item_key, entry))
+        return due
+
+    def __work(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    due = self.__take_due()
+                    if len(due) > 0:
+                        break
+                    timeout = max(0.0, self._heap[0][0] - time.time()) if len(self._heap) > 0 else None
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+            for item_key, entry in due:
+                try:
+                    self.__retry(item_key, entry)
+                except Exception:
+                    print(f'Exception in {self.name}:', traceback.format_exc())
+                finally:
+                    with self._condition:
+                        self._in_progress.discard(item_key)
+            if self.after_batch is not None:
+                try:
+                    self.after_batch()
+                except Exception:
+                    print(f'Exception in {self.name}:', traceback.format_exc())
+
+    def __retry(self, item_key: str, entry: dict):
+        status, exception = self.retry_method(entry['data_id'], entry['data'])
+        with self.state.write_lock, self._condition:
+            self._stats['retried'] += 1
+            current = self._store.get(item_key)
+            if current is None:
+                return
+            if status:
+                self._stats['succeeded'] += 1
+                if current['version'] == entry['version']:
+                    del self._store[item_key]
+                else:
+                    # data updated while it was saved is saved by the next wake-up
+                    self.__schedule(item_key, dict(current, next_attempt=time.time()))
+                return
+            self._stats['failed'] += 1
+            attempts = current['attempts'] + 1
+            delay = self._delay(attempts)
+            self.__schedule(item_key, dict(current, attempts=attempts, next_attempt=time.time() + delay,
+                last_error=self.__describe(exception)))
+        if attempts % self.report_every == 0:
+            self.report_error(f'Error occurred {attempts} times in saving {entry["data_id"]}, next attempt in '
+                              f'{round(delay)} seconds:\n{self.__describe(exception)}',
+                cause=json.dumps(current['data'], default=str))
+
+    def summary(self) -> dict:
+        with self._condition:
+            return dict(self._stats, pending=len(self._store), in_progress=len(self._in_progress),
+                next_attempt=self._heap[0][0] if len(self._heap) > 0 else None)
+
+    def inspect(self, limit: int = 20) -> List[dict]:
+        """
+        :return: up to `limit` waiting items in the order they are retried, without their data
+        """
+        with self._condition:
+            entries = sorted(self._store.values(), key=lambda entry: entry['next_attempt'])[:limit]
+        return [{'data_id': entry['data_id'], 'attempts': entry['attempts'], 'next_attempt': entry['next_attempt'],
+            'first_failed': entry['first_failed'], 'last_error': entry['last_error']} for entry in entries]
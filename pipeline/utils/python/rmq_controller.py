@@ -48,6 +48,10 @@ class RmqController:
             last_received_message_datetime = message.get('last_received_message_datetime')
             last_sent_message_datetime = message.get('last_sent_message_datetime')
             last_heartbeat_datetime = message.get('last_heartbeat_datetime')
+            latency = message.get('latency')
+            checkpoint = message.get('checkpoint')
+            db_pool = message.get('db_pool')
+            retry = message.get('retry')
             with app_state.lock:
                 if pipeline not in app_state.pipelines_state or service not in app_state.pipelines_state[pipeline]:
                     return
@@ -56,6 +60,11 @@ class RmqController:
                 service_state.last_sent_message_datetime = last_sent_message_datetime
                 service_state.last_heartbeat_datetime = last_heartbeat_datetime
                 service_state.suspended = state == 'suspended'
+                service_state.checkpoint = checkpoint
+                service_state.db_pool = db_pool
+                service_state.retry = retry
+                if latency:
+                    app_state.add_latency_samples(pipeline, service, latency)
         except Exception:
             print('Error on hearbeat processing:', traceback.format_exc())
 
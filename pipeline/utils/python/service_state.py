@@ -7,6 +7,9 @@ class ServiceState():
         self.last_received_message_datetime = last_received_message_datetime
         self.last_sent_message_datetime = last_sent_message_datetime
         self.suspended = suspended
+        self.checkpoint = None
+        self.db_pool = None
+        self.retry = None
 
     def to_dict(self):
         state = 'down'
@@ -15,4 +18,5 @@ class ServiceState():
             state = 'suspended' if self.suspended else 'up'
         return {'pipeline_state': state, 'last_heartbeat_datetime': self.last_heartbeat_datetime,
             'last_received_message_datetime': self.last_received_message_datetime,
-            'last_sent_message_datetime': self.last_sent_message_datetime}
+            'last_sent_message_datetime': self.last_sent_message_datetime, 'checkpoint': self.checkpoint,
+            'db_pool': self.db_pool, 'retry': self.retry}
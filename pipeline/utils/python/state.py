@@ -1,57 +1,893 @@
+import base64
+import gzip
+import io
 import json
 import os
+import re
+import sqlite3
+import threading
+import time
+import traceback
+import zlib
+from collections.abc import MutableMapping
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Tuple
 
 from readerwriterlock import rwlock
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SNAPSHOT_FORMATS = ('json', 'json.gz', 'json.zst', 'msgpack', 'msgpack.gz', 'msgpack.zst')
+SNAPSHOT_CHUNK_SIZE = 1024 * 1024
+
+
+def _check_snapshot_format(snapshot_format: str):
+    if snapshot_format not in SNAPSHOT_FORMATS:
+        raise ValueError(f'Unknown snapshot format {snapshot_format}, expected one of {SNAPSHOT_FORMATS}')
+    encoding, _, compression = snapshot_format.partition('.')
+    if encoding == 'msgpack' and msgpack is None:
+        raise ValueError(f'msgpack package is required for {snapshot_format} snapshots')
+    if compression == 'zst' and zstandard is None:
+        raise ValueError(f'zstandard package is required for {snapshot_format} snapshots')
+
+
+def _write_snapshot(output_file, value, snapshot_format: str):
+    encoding, _, compression = snapshot_format.partition('.')
+    # one-shot encoding by the C encoders is much faster than json.dump, which encodes in python
+    body = json.dumps(value).encode('utf8') if encoding == 'json' else msgpack.packb(value, use_bin_type=True)
+    if compression == '':
+        output_file.write(body)
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compression == 'gz' \
+        else zstandard.ZstdCompressor().compressobj()
+    body = memoryview(body)
+    for offset in range(0, len(body), SNAPSHOT_CHUNK_SIZE):
+        output_file.write(compressor.compress(body[offset:offset + SNAPSHOT_CHUNK_SIZE]))
+    output_file.write(compressor.flush())
+
+
+def _read_snapshot(input_file, snapshot_format: str):
+    encoding, _, compression = snapshot_format.partition('.')
+    stream = input_file if compression == '' \
+        else gzip.GzipFile(fileobj=input_file, mode='rb') if compression == 'gz' \
+        else zstandard.ZstdDecompressor().stream_reader(input_file)
+    if encoding == 'msgpack':
+        # the unpacker reads the stream by chunks instead of buffering the whole snapshot
+        return msgpack.Unpacker(stream, raw=False, strict_map_key=False, max_buffer_size=0).unpack()
+    return _JsonStreamReader(stream).read()
+
+
+class _JsonStreamReader:
+    # items of the top-level dict or list are decoded one by one from chunks of the text, so the whole text is
+    # not kept in memory together with the decoded value
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    COLON = re.compile(r'[ \t\n\r]*:[ \t\n\r]*')
+    COMMA = re.compile(r'[ \t\n\r]*,[ \t\n\r]*')
+
+    def __init__(self, stream):
+        self._reader = io.TextIOWrapper(stream, encoding='utf8')
+        self._scan = json.JSONDecoder().scan_once
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    def read(self):
+        value = self.__read_value()
+        if self.__next_char() != '':
+            raise json.JSONDecodeError('Extra data', self._buffer, self._position)
+        return value
+
+    def __read_value(self):
+        first = self.__next_char()
+        if first not in ('{', '['):
+            return self.__value()
+        self._position += 1
+        is_dict = first == '{'
+        closing = '}' if is_dict else ']'
+        result = {} if is_dict else []
+        if self.__next_char() == closing:
+            self._position += 1
+            return result
+        scan, colon, comma = self._scan, self.COLON.match, self.COMMA.match
+        while True:
+            buffer, position = self._buffer, self._position
+            # items which are entirely in the buffer and followed by a comma are decoded without leaving the loop
+            try:
+                while True:
+                    if is_dict:
+                        key, position = scan(buffer, position)
+                        match = colon(buffer, position)
+                        if match is None or type(key) is not str:
+                            break
+                        value, position = scan(buffer, match.end())
+                    else:
+                        value, position = scan(buffer, position)
+                    match = comma(buffer, position)
+                    if match is None or match.end() == len(buffer):
+                        break
+                    if is_dict:
+                        result[key] = value
+                    else:
+                        result.append(value)
+                    self._position = position = match.end()
+            except (StopIteration, json.JSONDecodeError):
+                pass
+            # the item continues in the next chunk, ends the container or is invalid
+            self.__read_item(result, is_dict)
+            delimiter = self.__next_char()
+            self._position += 1
+            if delimiter == closing:
+                return result
+            if delimiter != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", self._buffer, self._position - 1)
+            self.__next_char()
+
+    def __read_item(self, result, is_dict: bool):
+        if is_dict:
+            key = self.__value()
+            if type(key) is not str:
+                raise json.JSONDecodeError('Expecting property name enclosed in double quotes', self._buffer,
+                    self._position)
+            if self.__next_char() != ':':
+                raise json.JSONDecodeError("Expecting ':' delimiter", self._buffer, self._position)
+            self._position += 1
+            self.__next_char()
+            result[key] = self.__value()
+        else:
+            result.append(self.__value())
+
+    def __fill(self):
+        # reads at least as much as is buffered, so values spanning many chunks are decoded in linear time
+        chunk = self._reader.read(max(SNAPSHOT_CHUNK_SIZE, len(self._buffer) - self._position))
+        self._eof = chunk == ''
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+
+    def __next_char(self) -> str:
+        while True:
+            self._position = self.WHITESPACE.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer) or self._eof:
+                return self._buffer[self._position:self._position + 1]
+            self.__fill()
+
+    def __value(self):
+        while True:
+            try:
+                value, end = self._scan(self._buffer, self._position)
+                # a value at the end of the buffer, e.g. a number, could continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            except StopIteration as ex:
+                if self._eof:
+                    raise json.JSONDecodeError('Expecting value', self._buffer, ex.value) from None
+            except json.JSONDecodeError:
+                # nested values cut by the end of the buffer
+                if self._eof:
+                    raise
+            self.__fill()
+
+
+# containers of the state mark their key dirty on in-place mutation, nested values are not tracked
+class TrackedDict(dict):
+    __slots__ = ('_owner', '_key')
+
+    def __init__(self, owner: dict, key: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._owner = owner
+        self._key = key
+
+    def _mark_dirty(self):
+        self._owner['dirty_keys'].add(self._key)
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        self._mark_dirty()
+
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        self._mark_dirty()
+
+    def pop(self, *args):
+        self._mark_dirty()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._mark_dirty()
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._mark_dirty()
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return dict.__getitem__(self, k)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._mark_dirty()
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class TrackedList(list):
+    __slots__ = ('_owner', '_key')
+
+    def __init__(self, owner: dict, key: str, iterable=()):
+        super().__init__(iterable)
+        self._owner = owner
+        self._key = key
+
+    def _mark_dirty(self):
+        self._owner['dirty_keys'].add(self._key)
+
+    def __setitem__(self, i, v):
+        list.__setitem__(self, i, v)
+        self._mark_dirty()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self._mark_dirty()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._mark_dirty()
+        return self
+
+    def append(self, v):
+        list.append(self, v)
+        self._mark_dirty()
+
+    def extend(self, iterable):
+        list.extend(self, iterable)
+        self._mark_dirty()
+
+    def insert(self, i, v):
+        list.insert(self, i, v)
+        self._mark_dirty()
+
+    def pop(self, *args):
+        self._mark_dirty()
+        return list.pop(self, *args)
+
+    def remove(self, v):
+        list.remove(self, v)
+        self._mark_dirty()
+
+    def clear(self):
+        list.clear(self)
+        self._mark_dirty()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._mark_dirty()
+
+    def reverse(self):
+        list.reverse(self)
+        self._mark_dirty()
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def _track(value, owner: dict, key: str):
+    if isinstance(value, (TrackedDict, TrackedList)) and value._owner is owner and value._key == key:
+        return value
+    if isinstance(value, dict):
+        return TrackedDict(owner, key, value)
+    if isinstance(value, list):
+        return TrackedList(owner, key, value)
+    return value
+
+
+# write lock which the thread holding it can enter again, e.g. from a handler running under the lock
+class _ReentrantWriteLock:
+    def __init__(self, lock: rwlock.RWLockWrite):
+        self._lock = lock
+        self._held = None
+        self._owner = None
+        self._depth = 0
+
+    def __enter__(self):
+        if self._owner == threading.get_ident():
+            self._depth += 1
+            return self
+        held = self._lock.gen_wlock()
+        held.acquire()
+        self._held = held
+        self._owner = threading.get_ident()
+        self._depth = 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if self._depth == 0:
+            held, self._held = self._held, None
+            self._owner = None
+            held.release()
+
 
 class State:
-    def __init__(self, path, dump_interval = 1):
+    def __init__(self, path, dump_interval = 1, dump_period: float = None, snapshot_format: str = 'json'):
+        _check_snapshot_format(snapshot_format)
+        if dump_period is not None and dump_interval == 1:
+            # dumping on every call would make the period useless, so the default count limit is dropped
+            dump_interval = None
         self.__dict__['state_internal'] = dict()
+        self.__dict__['dirty_keys'] = set()
         self.__dict__['rwlock'] = rwlock.RWLockWrite()
+        self.__dict__['reentrant_write_lock'] = _ReentrantWriteLock(self.__dict__['rwlock'])
         self.__dict__['path'] = path
         self.__dict__['dump_interval'] = dump_interval
+        self.__dict__['dump_period'] = dump_period
         self.__dict__['dump_counter'] = 0
+        self.__dict__['last_dump_time'] = time.monotonic()
+        self.__dict__['checkpointer'] = None
+        self.__dict__['components'] = []
+        self.__dict__['snapshot_format'] = snapshot_format
+        # (file name, mtime, size) of the snapshot of every key last written or read, the key is up to date if
+        # the file is still the same
+        self.__dict__['snapshot_stats'] = {}
+        self.__dict__['cleaned_keys'] = set()
 
     def __setattr__(self, key, value):
-        self.__dict__['state_internal'][str(key)] = value
+        # dicts and lists are copied shallowly, so keep using the value read from the state
+        key = str(key)
+        self.__dict__['state_internal'][key] = _track(value, self.__dict__, key)
+        self.__dict__['dirty_keys'].add(key)
 
     def __getattr__(self, item):
         if item == 'read_lock':
             return self.__dict__['rwlock'].gen_rlock()
         if item == 'write_lock':
-            return self.__dict__['rwlock'].gen_wlock()
+            return self.__dict__['reentrant_write_lock']
         return self.__dict__['state_internal'].get(str(item))
 
     def __str__(self):
         return str(self.__dict__['state_internal'])
 
+    def mark_dirty(self, *keys):
+        # for in-place mutation of nested values, which are not tracked
+        self.__dict__['dirty_keys'].update(str(key) for key in keys)
+
     def load(self):
+        # snapshots which did not change since they were written or read by this state are skipped
+        snapshot_stats = self.__dict__['snapshot_stats']
+        for key, (file_name, snapshot_format) in self._find_snapshots().items():
+            file_path = self.__dict__['path'] + '/' + file_name
+            stat = os.stat(file_path)
+            snapshot_stat = (file_name, stat.st_mtime_ns, stat.st_size)
+            if snapshot_stats.get(key) == snapshot_stat and key in self.__dict__['state_internal']:
+                continue
+            with open(file_path, 'rb') as input_file:
+                self.__dict__['state_internal'][key] = _track(_read_snapshot(input_file, snapshot_format),
+                    self.__dict__, key)
+            snapshot_stats[key] = snapshot_stat
+            self.__dict__['dirty_keys'].discard(key)
+        for component in self.__dict__['components']:
+            component.load()
+
+    def _find_snapshots(self) -> Dict[str, Tuple[str, str]]:
         path = self.__dict__['path']
         if not os.path.exists(path):
-            return
-        for f in os.listdir(path):
-            if f.endswith('json'):
-                file_path = path + '/' + f
-                key = f.split('.')[0]
-                with open(file_path) as input_file:
-                    self.__dict__['state_internal'][key] = json.load(input_file)
+            return {}
+        snapshots = {}
+        for file_name in os.listdir(path):
+            key, _, snapshot_format = file_name.partition('.')
+            if snapshot_format not in SNAPSHOT_FORMATS:
+                continue
+            if key in snapshots:
+                # the format was changed and the previous snapshot was not removed yet
+                if os.path.getmtime(path + '/' + file_name) < os.path.getmtime(path + '/' + snapshots[key][0]):
+                    continue
+            snapshots[key] = (file_name, snapshot_format)
+        return snapshots
 
     def dump(self, keys: set = None, force: bool = True):
-        path = self.__dict__['path']
-
         if not force:
-            dump_interval = self.__dict__['dump_interval']
             dump_counter = self.__dict__['dump_counter'] + 1
-            if dump_counter < dump_interval:
+            dump_interval = self.__dict__['dump_interval']
+            dump_period = self.__dict__['dump_period']
+            if (dump_interval is None or dump_counter < dump_interval) and \
+                    (dump_period is None or time.monotonic() - self.__dict__['last_dump_time'] < dump_period):
                 self.__dict__['dump_counter'] = dump_counter
                 return
-            self.__dict__['dump_counter'] = 0
-
-        os.makedirs(self.__dict__['path'], exist_ok=True)
-        for k, v in self.__dict__['state_internal'].items():
-            if keys is None or k in keys:
-                temp_file_path = path + '/tmp_' + str(k)
-                file_path = path + '/' + str(k) + '.json'
-                with open(temp_file_path, 'w') as output_file:
-                    json.dump(v, output_file)
-                os.replace(temp_file_path, file_path)
+        self.__dict__['dump_counter'] = 0
+        self.__dict__['last_dump_time'] = time.monotonic()
+        self._write(keys)
+        checkpointer = self.__dict__['checkpointer']
+        for component in self.__dict__['components']:
+            if checkpointer is None:
+                component.dump()
+            else:
+                checkpointer.submit_dump(component)
+
+    def _write(self, keys: set = None):
+        dirty_keys = self.__dict__['dirty_keys']
+        state_internal = self.__dict__['state_internal']
+        keys_to_write = [k for k in (dirty_keys if keys is None else keys) if k in state_internal]
+        if len(keys_to_write) == 0:
+            return
+        checkpointer = self.__dict__['checkpointer']
+        if checkpointer is not None:
+            snapshot = {k: _snapshot(state_internal[k]) for k in keys_to_write}
+            dirty_keys.difference_update(keys_to_write)
+            checkpointer.submit(snapshot)
+            return
+        for k in keys_to_write:
+            # the key is cleaned before writing, so mutations made while it is written are not lost
+            dirty_keys.discard(k)
+            try:
+                self._write_key(k, state_internal[k])
+            except Exception:
+                dirty_keys.add(k)
+                raise
+
+    def _write_key(self, key: str, value):
+        path = self.__dict__['path']
+        snapshot_format = self.__dict__['snapshot_format']
+        os.makedirs(path, exist_ok=True)
+        temp_file_path = path + '/tmp_' + key
+        file_name = key + '.' + snapshot_format
+        with open(temp_file_path, 'wb') as output_file:
+            _write_snapshot(output_file, value, snapshot_format)
+        os.replace(temp_file_path, path + '/' + file_name)
+        stat = os.stat(path + '/' + file_name)
+        self.__dict__['snapshot_stats'][key] = (file_name, stat.st_mtime_ns, stat.st_size)
+        if key not in self.__dict__['cleaned_keys']:
+            # snapshots of other formats are removed once, so they are not loaded instead of the new one
+            for other_format in SNAPSHOT_FORMATS:
+                if other_format != snapshot_format and os.path.exists(path + '/' + key + '.' + other_format):
+                    os.remove(path + '/' + key + '.' + other_format)
+            self.__dict__['cleaned_keys'].add(key)
+
+    def attach(self, component):
+        # components with their own `dump` and `load` are persisted together with the state
+        self.__dict__['components'].append(component)
+
+    def start_checkpointer(self) -> 'StateCheckpointer':
+        if self.__dict__['checkpointer'] is None:
+            self.__dict__['checkpointer'] = StateCheckpointer(self._write_key, lambda keys: self.mark_dirty(*keys),
+                name='checkpointer-' + os.path.basename(self.__dict__['path']))
+        return self.__dict__['checkpointer']
+
+    def flush(self, timeout: float = None) -> bool:
+        checkpointer = self.__dict__['checkpointer']
+        return True if checkpointer is None else checkpointer.flush(timeout)
+
+    def checkpoint_metrics(self):
+        checkpointer = self.__dict__['checkpointer']
+        return None if checkpointer is None else checkpointer.metrics()
+
+
+_CONTAINER_TYPES = {dict, list, TrackedDict, TrackedList}
+
+
+def _snapshot(value):
+    # copies containers of json values, scalars are immutable and shared with the state. Flat containers, like
+    # mappings of ids to hashes, are copied without iterating in python
+    if isinstance(value, dict):
+        copied = dict(value)
+        if not _CONTAINER_TYPES.isdisjoint(map(type, copied.values())):
+            for k, v in copied.items():
+                if isinstance(v, (dict, list)):
+                    copied[k] = _snapshot(v)
+        return copied
+    if isinstance(value, list):
+        copied = list(value)
+        if not _CONTAINER_TYPES.isdisjoint(map(type, copied)):
+            copied = [_snapshot(v) if isinstance(v, (dict, list)) else v for v in copied]
+        return copied
+    return value
+
+
+# snapshots submitted while the previous one is written are merged, keys failed to be written go to on_failure
+class StateCheckpointer:
+    def __init__(self, write_key: Callable[[str, object], None], on_failure: Callable[[Iterable[str]], None],
+            name: str = 'checkpointer'):
+        self._write_key = write_key
+        self._on_failure = on_failure
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._pending_components = {}
+        self._pending_since = None
+        self._writing = False
+        self._stopped = False
+
+        self.checkpoints = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.last_lag = None
+
+        self._thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, snapshot: dict):
+        with self._condition:
+            if len(self._pending) > 0:
+                self.coalesced += 1
+            elif len(self._pending_components) == 0:
+                self._pending_since = time.monotonic()
+            self._pending.update(snapshot)
+            self._condition.notify_all()
+
+    def submit_dump(self, component):
+        with self._condition:
+            if len(self._pending_components) == 0 and len(self._pending) == 0:
+                self._pending_since = time.monotonic()
+            self._pending_components[id(component)] = component
+            self._condition.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self._pending) == 0 and len(self._pending_components) == 0
+                and not self._writing, timeout)
+
+    def stop(self, timeout: float = None):
+        self.flush(timeout)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def metrics(self) -> dict:
+        with self._condition:
+            pending_lag = None if len(self._pending) == 0 and len(self._pending_components) == 0 \
+                else time.monotonic() - self._pending_since
+            return {'checkpoints': self.checkpoints, 'coalesced': self.coalesced, 'errors': self.errors,
+                'pending_keys': len(self._pending),
+                'pending_lag_ms': None if pending_lag is None else round(pending_lag * 1000, 3),
+                'last_duration_ms': None if self.last_duration is None else round(self.last_duration * 1000, 3),
+                'max_duration_ms': round(self.max_duration * 1000, 3),
+                'last_lag_ms': None if self.last_lag is None else round(self.last_lag * 1000, 3)}
+
+    def __run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._pending) > 0 or len(self._pending_components) > 0
+                    or self._stopped)
+                if len(self._pending) == 0 and len(self._pending_components) == 0:
+                    return
+                snapshot, self._pending = self._pending, {}
+                components, self._pending_components = list(self._pending_components.values()), {}
+                requested = self._pending_since
+                self._writing = True
+
+            started = time.monotonic()
+            failed_keys = []
+            for key, value in snapshot.items():
+                try:
+                    self._write_key(key, value)
+                except Exception:
+                    print(f'Unable to write state key {key}:', traceback.format_exc())
+                    failed_keys.append(key)
+            if len(failed_keys) > 0:
+                self._on_failure(failed_keys)
+            failed = len(failed_keys) > 0
+            for component in components:
+                try:
+                    component.dump()
+                except Exception:
+                    # the component keeps its changes and writes them by the next dump
+                    print(f'Unable to dump {type(component).__name__}:', traceback.format_exc())
+                    failed = True
+
+            finished = time.monotonic()
+            with self._condition:
+                self._writing = False
+                self.checkpoints += 1
+                self.errors += 1 if failed else 0
+                self.last_duration = finished - started
+                self.max_duration = max(self.max_duration, self.last_duration)
+                self.last_lag = finished - requested
+                self._condition.notify_all()
+
+
+# values are read as copies, so a mutated value has to be assigned again
+class SqliteMapping(MutableMapping):
+    PAGE_SIZE = 1000
+
+    def __init__(self, connection: sqlite3.Connection, lock: threading.RLock, name: str):
+        self._connection = connection
+        self._lock = lock
+        self.name = name
+
+    def __getitem__(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM mappings WHERE name = ? AND key = ?',
+                (self.name, json.dumps(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO mappings (name, key, value) VALUES (?, ?, ?)',
+                (self.name, json.dumps(key), json.dumps(value)))
+
+    def __delitem__(self, key):
+        with self._lock:
+            cursor = self._connection.execute('DELETE FROM mappings WHERE name = ? AND key = ?',
+                (self.name, json.dumps(key)))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM mappings WHERE name = ? AND key = ?',
+                (self.name, json.dumps(key))).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM mappings WHERE name = ?', (self.name,)).fetchone()[0]
+
+    def __iter__(self):
+        for key, _ in self.__pages(with_values=False):
+            yield json.loads(key)
+
+    def items(self):
+        for key, value in self.__pages(with_values=True):
+            yield json.loads(key), json.loads(value)
+
+    def values(self):
+        for _, value in self.__pages(with_values=True):
+            yield json.loads(value)
+
+    def __pages(self, with_values: bool):
+        # pages are read by key ranges, so the mapping can be modified while iterating
+        sql = f'SELECT key, {"value" if with_values else "NULL"} FROM mappings WHERE name = ? AND key > ? ' \
+              f'ORDER BY key LIMIT {self.PAGE_SIZE}'
+        last_key = ''
+        while True:
+            with self._lock:
+                rows = self._connection.execute(sql, (self.name, last_key)).fetchall()
+            yield from rows
+            if len(rows) < self.PAGE_SIZE:
+                return
+            last_key = rows[-1][0]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM mappings WHERE name = ?', (self.name,))
+
+    def replace(self, items: dict):
+        if items is self:
+            return
+        with self._lock:
+            self.clear()
+            self._connection.executemany('INSERT INTO mappings (name, key, value) VALUES (?, ?, ?)',
+                ((self.name, json.dumps(key), json.dumps(value)) for key, value in items.items()))
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def __repr__(self):
+        return f'SqliteMapping({self.name}, {len(self)} items)'
+
+
+# mapping_keys are kept in sqlite and changed item by item, so they are neither read at startup nor rewritten
+class SqliteState(State):
+    DATABASE_FILE = 'state.sqlite'
+
+    def __init__(self, path, dump_interval = 1, dump_period: float = None, mapping_keys=(),
+            snapshot_format: str = 'json'):
+        super().__init__(path, dump_interval, dump_period, snapshot_format)
+        os.makedirs(path, exist_ok=True)
+        connection = sqlite3.connect(path + '/' + self.DATABASE_FILE, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS mappings (name TEXT NOT NULL, key TEXT NOT NULL, '
+                           'value TEXT NOT NULL, PRIMARY KEY (name, key)) WITHOUT ROWID')
+        connection.commit()
+        lock = threading.RLock()
+        self.__dict__['connection'] = connection
+        self.__dict__['db_lock'] = lock
+        self.__dict__['mappings'] = {str(key): SqliteMapping(connection, lock, str(key)) for key in mapping_keys}
+        self.__dict__['mapping_defaults'] = {}
+        self.__dict__['loaded'] = False
+
+    def __setattr__(self, key, value):
+        mapping = self.__dict__['mappings'].get(str(key))
+        if mapping is None:
+            super().__setattr__(key, value)
+        elif not self.__dict__['loaded']:
+            # values assigned before the first load are defaults, stored ones are not replaced by them
+            self.__dict__['mapping_defaults'][str(key)] = value
+        else:
+            mapping.replace(value)
+
+    def __getattr__(self, item):
+        mapping = self.__dict__['mappings'].get(str(item))
+        if mapping is not None:
+            return mapping
+        return super().__getattr__(item)
+
+    def load(self):
+        # the database is the stored state of mapping keys, so they are not read again. Changes made since the
+        # last dump, e.g. by threads running while the service was suspended, are kept
+        with self.__dict__['db_lock']:
+            connection = self.__dict__['connection']
+            defaults = self.__dict__['mapping_defaults']
+            snapshots = self._find_snapshots()
+            for key, mapping in self.__dict__['mappings'].items():
+                if key in snapshots:
+                    file_name, snapshot_format = snapshots[key]
+                    with open(self.__dict__['path'] + '/' + file_name, 'rb') as input_file:
+                        mapping.replace(_read_snapshot(input_file, snapshot_format))
+                    connection.commit()
+                    os.remove(self.__dict__['path'] + '/' + file_name)
+                elif key in defaults and len(mapping) == 0:
+                    mapping.replace(defaults[key])
+            defaults.clear()
+            self.__dict__['loaded'] = True
+            connection.commit()
+        super().load()
+
+    def _write(self, keys: set = None):
+        super()._write(keys)
+        with self.__dict__['db_lock']:
+            if self.__dict__['connection'].in_transaction:
+                self.__dict__['connection'].commit()
+
+    def close(self):
+        with self.__dict__['db_lock']:
+            self.__dict__['connection'].close()
+
+
+def _journal_default(value):
+    # messages of binary codecs may contain bytes, other values are kept as their text
+    if isinstance(value, (bytes, bytearray)):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    return str(value)
+
+
+def _journal_object_hook(value: dict):
+    if len(value) == 1 and '$bytes' in value:
+        return base64.b64decode(value['$bytes'])
+    return value
+
+
+# log of in-flight messages, begin records without commit are the messages interrupted by a crash
+class Journal:
+    SEGMENT_PREFIX = 'segment_'
+    SEGMENT_SUFFIX = '.log'
+
+    def __init__(self, path, sync_interval: float = 1.0, sync_bytes: int = 64 * 1024,
+            segment_size: int = 4 * 1024 * 1024):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+
+        self._pending = {}
+        self._last_id = 0
+        self._segment_number = 0
+        self._segment_file = None
+        self._segment_bytes = 0
+        self._compacted_bytes = 0
+        self._unsynced_bytes = 0
+        self._last_sync_time = time.time()
+        self._closed = threading.Event()
+
+        os.makedirs(path, exist_ok=True)
+        self.__read_segments()
+        self._sync_thread = threading.Thread(target=self.__sync_periodically, name='journal-sync', daemon=True)
+        self._sync_thread.start()
+
+    def recover(self) -> list:
+        with self.lock:
+            return [self._pending[record_id] for record_id in sorted(self._pending)]
+
+    def begin(self, message, headers=None) -> int:
+        with self.lock:
+            record = {'op': 'begin', 'id': self._last_id + 1, 'datetime': str(datetime.now()), 'message': message,
+                'headers': headers}
+            # the record is pending only once it is written, so records which can't be written don't break
+            # compactions
+            self.__append(self.__encode(record))
+            self._last_id += 1
+            self._pending[self._last_id] = record
+            return self._last_id
+
+    def commit(self, record_id: int):
+        with self.lock:
+            if self._pending.pop(record_id, None) is None:
+                return
+            self.__append(self.__encode({'op': 'commit', 'id': record_id}))
+
+    def sync(self):
+        with self.lock:
+            self.__sync()
+
+    def close(self):
+        self._closed.set()
+        with self.lock:
+            if self._segment_file is not None:
+                self.__sync()
+                self._segment_file.close()
+                self._segment_file = None
+
+    def __segment_path(self, number):
+        return f'{self.path}/{self.SEGMENT_PREFIX}{number:010d}{self.SEGMENT_SUFFIX}'
+
+    def __segment_numbers(self):
+        return sorted(int(f[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]) for f in os.listdir(self.path)
+            if f.startswith(self.SEGMENT_PREFIX) and f.endswith(self.SEGMENT_SUFFIX))
+
+    def __read_segments(self):
+        numbers = self.__segment_numbers()
+        for number in numbers:
+            with open(self.__segment_path(number), encoding='utf8') as segment:
+                for line in segment:
+                    try:
+                        record = json.loads(line, object_hook=_journal_object_hook)
+                    except ValueError:
+                        # the tail of the last segment could be partially written
+                        continue
+                    self._last_id = max(self._last_id, record['id'])
+                    if record['op'] == 'begin':
+                        self._pending[record['id']] = record
+                    else:
+                        self._pending.pop(record['id'], None)
+        self._segment_number = numbers[-1] if len(numbers) > 0 else 0
+        self.__roll()
+
+    def __roll(self):
+        old_numbers = self.__segment_numbers()
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment_number += 1
+        self._segment_file = open(self.__segment_path(self._segment_number), 'a', encoding='utf8')
+        self._segment_bytes = 0
+        for record_id in sorted(self._pending):
+            self.__write(self.__encode(self._pending[record_id]))
+        self._compacted_bytes = self._segment_bytes
+        self.__sync()
+        for number in old_numbers:
+            os.remove(self.__segment_path(number))
+
+    @staticmethod
+    def __encode(record) -> str:
+        return json.dumps(record, default=_journal_default) + '\n'
+
+    def __write(self, line: str):
+        self._segment_file.write(line)
+        self._segment_bytes += len(line)
+        self._unsynced_bytes += len(line)
+
+    def __append(self, line: str):
+        self.__write(line)
+        self._segment_file.flush()
+        if self._unsynced_bytes >= self.sync_bytes or time.time() - self._last_sync_time >= self.sync_interval:
+            self.__sync()
+        if self._segment_bytes - self._compacted_bytes >= self.segment_size:
+            self.__roll()
+
+    def __sync_periodically(self):
+        while not self._closed.wait(self.sync_interval):
+            with self.lock:
+                if self._segment_file is not None and self._unsynced_bytes > 0 and \
+                        time.time() - self._last_sync_time >= self.sync_interval:
+                    self.__sync()
+
+    def __sync(self):
+        self._segment_file.flush()
+        os.fsync(self._segment_file.fileno())
+        self._unsynced_bytes = 0
+        self._last_sync_time = time.time()
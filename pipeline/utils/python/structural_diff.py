@@ -0,0 +1,84 @@
+"""
+JSON Patch diff of documents against per-subtree hash trees: {'h': digest} with 'd' or 'l' child nodes
+"""
+import copy
+from typing import List, Optional, Tuple
+
+import hashing
+
+
+def _escape(key) -> str:
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token: str) -> str:
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def hash_tree(data, depth: int) -> dict:
+    node = {'h': hashing.hexdigest(data)}
+    if depth > 0:
+        if isinstance(data, dict):
+            node['d'] = {str(key): hash_tree(value, depth - 1) for key, value in data.items()}
+        elif isinstance(data, list):
+            node['l'] = [hash_tree(value, depth - 1) for value in data]
+    return node
+
+
+def diff(old_node: Optional[dict], data, depth: int, path: str = '') -> Tuple[List[dict], dict]:
+    """
+    :param old_node: hash tree of the previous version, None if there is none
+    :return: patch operations and hash tree of the new version
+    """
+    digest = hashing.hexdigest(data)
+    if old_node is None:
+        return [{'op': 'add', 'path': path, 'value': data}], hash_tree(data, depth)
+    if old_node['h'] == digest:
+        return [], old_node
+
+    if depth > 0 and isinstance(data, dict) and 'd' in old_node:
+        operations = []
+        children = {}
+        old_children = old_node['d']
+        data_keys = {str(key) for key in data}
+        for key in old_children:
+            if key not in data_keys:
+                operations.append({'op': 'remove', 'path': path + '/' + _escape(key)})
+        for key, value in data.items():
+            child_operations, children[str(key)] = diff(old_children.get(str(key)), value, depth - 1,
+                path + '/' + _escape(key))
+            operations.extend(child_operations)
+        return operations, {'h': digest, 'd': children}
+
+    if depth > 0 and isinstance(data, list) and 'l' in old_node and len(old_node['l']) == len(data):
+        operations = []
+        children = []
+        for i, (old_child, value) in enumerate(zip(old_node['l'], data)):
+            child_operations, child = diff(old_child, value, depth - 1, path + '/' + str(i))
+            operations.extend(child_operations)
+            children.append(child)
+        return operations, {'h': digest, 'l': children}
+
+    return [{'op': 'replace', 'path': path, 'value': data}], hash_tree(data, depth)
+
+
+def apply_patch(document, operations: List[dict]):
+    """
+    Applies operations produced by `diff` to the previous version of a document
+    :return: new version of the document, the passed one is not modified
+    """
+    document = copy.deepcopy(document)
+    for operation in operations:
+        if operation['path'] == '':
+            document = copy.deepcopy(operation['value'])
+            continue
+        tokens = [_unescape(token) for token in operation['path'].split('/')[1:]]
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        key = int(tokens[-1]) if isinstance(parent, list) else tokens[-1]
+        if operation['op'] == 'remove':
+            del parent[key]
+        else:
+            parent[key] = copy.deepcopy(operation['value'])
+    return document
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of the services are imported by their names, the way the services import them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,130 @@
+import threading
+import time
+
+import psycopg2.extensions
+import pytest
+
+from connection_pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        if self.connection.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+
+
+class FakeInfo:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.info = FakeInfo()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class Connector:
+    def __init__(self):
+        self.connections = []
+
+    def __call__(self):
+        connection = FakeConnection()
+        self.connections.append(connection)
+        return connection
+
+
+def test_acquire_times_out_when_all_connections_are_in_use():
+    pool = ConnectionPool(Connector(), min_size=0, max_size=2, timeout=0.1)
+    pool.acquire()
+    pool.acquire()
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert time.monotonic() - started >= 0.1
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_waiting_acquire_gets_released_connection():
+    pool = ConnectionPool(Connector(), min_size=0, max_size=1, timeout=2)
+    connection = pool.acquire()
+    threading.Timer(0.05, pool.release, (connection,)).start()
+    assert pool.acquire() is connection
+    assert pool.stats()['waits'] == 1
+
+
+def test_size_never_exceeds_max_size_under_concurrency():
+    connector = Connector()
+    pool = ConnectionPool(connector, min_size=0, max_size=3, timeout=5)
+    in_use = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        for _ in range(20):
+            with pool.connection():
+                with lock:
+                    in_use.append(1)
+                    peak.append(len(in_use))
+                time.sleep(0.001)
+                with lock:
+                    in_use.pop()
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 3
+    assert len(connector.connections) <= 3
+
+
+def test_connections_older_than_max_lifetime_are_replaced():
+    connector = Connector()
+    pool = ConnectionPool(connector, min_size=1, max_size=1, max_lifetime=0.05)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    pool.release(first)
+
+    time.sleep(0.1)
+    second = pool.acquire()
+    assert second is not first
+    assert first.closed
+    assert pool.stats()['expired'] == 1
+
+
+def test_broken_idle_connection_is_replaced():
+    connector = Connector()
+    pool = ConnectionPool(connector, min_size=1, max_size=1, health_check_interval=0)
+    first = pool.acquire()
+    pool.release(first)
+    first.broken = True
+    second = pool.acquire()
+    assert second is not first
+    assert pool.stats()['health_check_failures'] == 1
+
+
+def test_discarded_connection_frees_its_slot():
+    pool = ConnectionPool(Connector(), min_size=0, max_size=1, timeout=0.1)
+    connection = pool.acquire()
+    pool.release(connection, discard=True)
+    assert pool.acquire() is not connection
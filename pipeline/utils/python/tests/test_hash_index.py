@@ -0,0 +1,87 @@
+import os
+import time
+
+from hash_index import CompactHashIndex
+
+
+class SmallIndex(CompactHashIndex):
+    COMPACT_MIN_RECORDS = 4
+
+
+def digest(n: int) -> bytes:
+    return n.to_bytes(4, 'big') * 4
+
+
+def reloaded(index: CompactHashIndex) -> CompactHashIndex:
+    other = SmallIndex(index.path, index.max_entries, index.ttl)
+    other.load()
+    return other
+
+
+def test_reload_after_appends(tmp_path):
+    index = SmallIndex(str(tmp_path / 'index.bin'))
+    index.put('a', digest(1))
+    index.put(2, digest(2))
+    index.dump()
+    index.put('a', digest(3))
+    index.dump()
+
+    other = reloaded(index)
+    assert other.get('a') == digest(3)
+    assert other.get(2) == digest(2)
+    assert other.get('2') is None
+
+
+def test_reload_after_compaction(tmp_path):
+    index = SmallIndex(str(tmp_path / 'index.bin'))
+    for round_number in range(10):
+        for data_id in range(3):
+            index.put(data_id, digest(round_number * 10 + data_id))
+        index.dump()
+    # the file is rewritten instead of growing by every dump
+    assert os.path.getsize(index.path) < 10 * 3 * 20
+
+    other = reloaded(index)
+    assert len(other) == 3
+    assert [other.get(data_id) for data_id in range(3)] == [digest(90 + data_id) for data_id in range(3)]
+
+    other.put(5, digest(5))
+    other.dump()
+    assert reloaded(other).get(5) == digest(5)
+
+
+def test_evicted_entries_stay_removed_after_reload(tmp_path):
+    index = SmallIndex(str(tmp_path / 'index.bin'), max_entries=2)
+    index.put('a', digest(1))
+    index.put('b', digest(2))
+    index.dump()
+    index.put('c', digest(3))
+    index.dump()
+
+    other = reloaded(index)
+    assert other.get('a') is None
+    assert other.get('b') == digest(2)
+    assert other.get('c') == digest(3)
+
+
+def test_expired_entries_are_not_returned(tmp_path):
+    index = SmallIndex(str(tmp_path / 'index.bin'), ttl=0.05)
+    index.put('a', digest(1))
+    time.sleep(0.1)
+    assert index.get('a') is None
+
+
+def test_broken_tail_is_ignored_and_rewritten(tmp_path):
+    index = SmallIndex(str(tmp_path / 'index.bin'))
+    index.put('a', digest(1))
+    index.dump()
+    with open(index.path, 'ab') as index_file:
+        index_file.write(b'\x00\x05\x00ab')
+
+    other = reloaded(index)
+    assert other.get('a') == digest(1)
+    other.put('b', digest(2))
+    other.dump()
+    again = reloaded(other)
+    assert again.get('a') == digest(1)
+    assert again.get('b') == digest(2)
@@ -0,0 +1,75 @@
+import os
+
+from state import Journal
+
+
+def segment_files(path):
+    return sorted(f for f in os.listdir(path) if f.startswith(Journal.SEGMENT_PREFIX))
+
+
+def test_recover_returns_uncommitted_messages_in_order(tmp_path):
+    journal = Journal(str(tmp_path))
+    first = journal.begin({'n': 1}, {'tag': 'a'})
+    second = journal.begin({'n': 2})
+    third = journal.begin({'n': 3})
+    journal.commit(second)
+    journal.close()
+
+    records = Journal(str(tmp_path)).recover()
+    assert [record['id'] for record in records] == [first, third]
+    assert [record['message'] for record in records] == [{'n': 1}, {'n': 3}]
+    assert records[0]['headers'] == {'tag': 'a'}
+
+
+def test_ids_continue_after_reopen(tmp_path):
+    journal = Journal(str(tmp_path))
+    last = journal.begin('a')
+    journal.close()
+    assert Journal(str(tmp_path)).begin('b') > last
+
+
+def test_compaction_keeps_only_pending_records(tmp_path):
+    journal = Journal(str(tmp_path), segment_size=512)
+    pending = journal.begin('pending')
+    for i in range(100):
+        journal.commit(journal.begin('x' * 50))
+    journal.close()
+
+    assert len(segment_files(tmp_path)) == 1
+    with open(os.path.join(tmp_path, segment_files(tmp_path)[0]), encoding='utf8') as segment:
+        assert len(segment.readlines()) < 10
+    assert [record['id'] for record in Journal(str(tmp_path)).recover()] == [pending]
+
+
+def test_partially_written_tail_is_ignored(tmp_path):
+    journal = Journal(str(tmp_path))
+    record_id = journal.begin('complete')
+    journal.close()
+    with open(os.path.join(tmp_path, segment_files(tmp_path)[-1]), 'a', encoding='utf8') as segment:
+        segment.write('{"op": "begin", "id": 99, "mess')
+
+    assert [record['id'] for record in Journal(str(tmp_path)).recover()] == [record_id]
+
+
+def test_binary_messages_are_restored(tmp_path):
+    journal = Journal(str(tmp_path), segment_size=256)
+    journal.begin(b'\x00\xffraw')
+    journal.begin({'payload': b'nested'})
+    for i in range(20):
+        journal.commit(journal.begin('y' * 30))
+    journal.close()
+
+    messages = [record['message'] for record in Journal(str(tmp_path)).recover()]
+    assert messages == [b'\x00\xffraw', {'payload': b'nested'}]
+
+
+def test_record_which_can_not_be_written_is_not_pending(tmp_path):
+    journal = Journal(str(tmp_path))
+    try:
+        journal.begin({1j: 'complex keys are not serializable'})
+    except TypeError:
+        pass
+    assert journal.recover() == []
+    journal.commit(journal.begin('next'))
+    journal.close()
+    assert Journal(str(tmp_path)).recover() == []
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from retry_queue import RetryQueue
+from state import State
+
+
+def wait_for(condition, timeout: float = 2):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'condition was not reached in time'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = State(str(tmp_path))
+    state.retry = {}
+    return state
+
+
+def make_queue(state, retry_method=None, **kwargs):
+    errors = []
+    queue = RetryQueue(state, 'retry', retry_method or (lambda data_id, data: (True, None)),
+        lambda message, cause=None: errors.append(message), **kwargs)
+    queue.errors = errors
+    return queue
+
+
+def test_delay_grows_exponentially_up_to_max_delay(state):
+    queue = make_queue(state, base_delay=10, multiplier=3, max_delay=200, jitter=0)
+    assert [queue._delay(attempts) for attempts in range(1, 6)] == [10, 30, 90, 200, 200]
+
+
+def test_jitter_stays_within_bounds(state):
+    queue = make_queue(state, base_delay=100, jitter=0.2)
+    delays = [queue._delay(1) for _ in range(200)]
+    assert all(80 <= delay <= 120 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_same_id_is_coalesced(state):
+    queue = make_queue(state, jitter=0)
+    queue.add(7, {'v': 1}, ValueError('first'))
+    next_attempt = state.retry['7']['next_attempt']
+    queue.add(7, {'v': 2}, ValueError('second'))
+
+    assert len(queue) == 1
+    entry = state.retry['7']
+    assert entry['data'] == {'v': 2}
+    assert entry['version'] == 1
+    assert entry['attempts'] == 1
+    assert entry['next_attempt'] == next_attempt
+    assert entry['last_error'] == 'ValueError: first'
+    assert queue.get(7) == {'v': 2}
+    assert queue.get(8) is None
+
+
+def test_update_only_replaces_waiting_items(state):
+    queue = make_queue(state)
+    assert not queue.update(1, 'data')
+    assert len(queue) == 0
+
+
+def test_flushed_items_are_retried_and_removed(state):
+    retried = []
+    queue = make_queue(state, lambda data_id, data: (retried.append((data_id, data)), (True, None))[1])
+    queue.add(1, 'a')
+    queue.add(2, 'b')
+    queue.start()
+    try:
+        time.sleep(0.05)
+        assert retried == []
+        assert queue.flush([2, 3]) == 1
+        wait_for(lambda: queue.get(2) is None)
+        assert retried == [(2, 'b')]
+        assert queue.get(1) == 'a'
+    finally:
+        queue.stop()
+
+
+def test_failed_retry_is_rescheduled_with_backoff(state):
+    queue = make_queue(state, lambda data_id, data: (False, RuntimeError('down')), base_delay=100, jitter=0,
+        report_every=2)
+    queue.add(1, 'a')
+    queue.start()
+    try:
+        queue.flush()
+        wait_for(lambda: state.retry['1']['attempts'] == 2)
+        entry = state.retry['1']
+        assert 199 < entry['next_attempt'] - time.time() <= 200
+        assert entry['last_error'] == 'RuntimeError: down'
+        wait_for(lambda: len(queue.errors) == 1)
+        assert 'Error occurred 2 times in saving 1' in queue.errors[0]
+    finally:
+        queue.stop()
+
+
+def test_data_updated_during_retry_is_saved_again(state):
+    saved = []
+    first_call = threading.Event()
+
+    def retry_method(data_id, data):
+        if not first_call.is_set():
+            first_call.set()
+            queue.add(data_id, 'newer')
+        saved.append(data)
+        return True, None
+
+    queue = make_queue(state, retry_method)
+    queue.add(1, 'older')
+    queue.start()
+    try:
+        queue.flush()
+        wait_for(lambda: queue.get(1) is None)
+        assert saved == ['older', 'newer']
+    finally:
+        queue.stop()
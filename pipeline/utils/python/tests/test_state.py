@@ -0,0 +1,124 @@
+import io
+import json
+import time
+
+import pytest
+
+import state as state_module
+from state import State
+
+
+class CountingState(State):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__dict__['written'] = []
+
+    def _write_key(self, key, value):
+        self.__dict__['written'].append(key)
+        super()._write_key(key, value)
+
+
+def test_only_dirty_keys_are_written(tmp_path):
+    state = CountingState(str(tmp_path))
+    state.big = {'a': 1}
+    state.small = 1
+    state.dump()
+    assert sorted(state.written) == ['big', 'small']
+
+    state.written.clear()
+    state.small = 2
+    state.dump()
+    assert state.written == ['small']
+
+    state.written.clear()
+    state.dump()
+    assert state.written == []
+
+
+def test_in_place_mutation_marks_the_key_dirty(tmp_path):
+    state = CountingState(str(tmp_path))
+    state.mapping = {}
+    state.items = []
+    state.dump()
+
+    state.written.clear()
+    state.mapping['a'] = 1
+    state.dump()
+    assert state.written == ['mapping']
+
+    state.written.clear()
+    state.items.append(1)
+    state.mapping.pop('a')
+    state.dump()
+    assert sorted(state.written) == ['items', 'mapping']
+
+
+def test_nested_mutation_needs_mark_dirty(tmp_path):
+    state = CountingState(str(tmp_path))
+    state.mapping = {'nested': {}}
+    state.dump()
+
+    state.written.clear()
+    state.mapping['nested']['a'] = 1
+    state.dump()
+    assert state.written == []
+
+    state.mark_dirty('mapping')
+    state.dump()
+    assert state.written == ['mapping']
+
+    reloaded = State(str(tmp_path))
+    reloaded.load()
+    assert reloaded.mapping == {'nested': {'a': 1}}
+
+
+def test_dump_interval_counts_calls(tmp_path):
+    state = CountingState(str(tmp_path), dump_interval=3)
+    state.key = 1
+    state.dump(force=False)
+    state.dump(force=False)
+    assert state.written == []
+    state.dump(force=False)
+    assert state.written == ['key']
+
+
+def test_dump_period_replaces_the_default_interval(tmp_path):
+    state = CountingState(str(tmp_path), dump_period=0.1)
+    state.key = 1
+    state.dump(force=False)
+    assert state.written == []
+    time.sleep(0.15)
+    state.dump(force=False)
+    assert state.written == ['key']
+
+
+def test_load_skips_unchanged_snapshots(tmp_path):
+    state = State(str(tmp_path))
+    state.key = {'a': 1}
+    state.dump()
+    loaded = state.key
+    state.load()
+    assert state.key is loaded
+
+    other = State(str(tmp_path))
+    other.key = {'a': 2}
+    other.dump()
+    state.load()
+    assert state.key == {'a': 2}
+
+
+@pytest.mark.parametrize('value', [
+    {}, [], {'a': 1, 'b': [1, 2.5, None, True], 'c': {'d': 'é'}}, [[1, [2]], {'x': -1e-3}], 12345678901234567890,
+    'text', {'s': 'x' * 100, 'n': list(range(40))},
+])
+def test_json_snapshots_are_read_by_chunks(monkeypatch, value):
+    monkeypatch.setattr(state_module, 'SNAPSHOT_CHUNK_SIZE', 5)
+    for text in (json.dumps(value), json.dumps(value, indent=2, ensure_ascii=False)):
+        assert state_module._read_snapshot(io.BytesIO(text.encode('utf8')), 'json') == value
+
+
+@pytest.mark.parametrize('text', ['{"a": 1', '{"a" 1}', '[1 2]', '{1: 2}', '[1,]', '[1] x'])
+def test_invalid_json_snapshots_raise(monkeypatch, text):
+    monkeypatch.setattr(state_module, 'SNAPSHOT_CHUNK_SIZE', 3)
+    with pytest.raises(ValueError):
+        state_module._read_snapshot(io.BytesIO(text.encode('utf8')), 'json')
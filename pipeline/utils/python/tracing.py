@@ -0,0 +1,142 @@
+import contextvars
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+TRACE_ID_HEADER = 'trace_id'
+TRACE_HOPS_HEADER = 'trace_hops'
+MAX_HOPS = 32
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """
+    Trace id shared by messages caused by the same root message and the hops they passed
+    {'seq', 'service', 'dequeued', 'enqueued'}, latency across hosts includes their clock skew
+    """
+    __slots__ = ('trace_id', 'hops', 'dequeued')
+
+    def __init__(self, trace_id: str, hops: List[dict], dequeued: Optional[float]):
+        self.trace_id = trace_id
+        self.hops = hops
+        self.dequeued = dequeued
+
+    @staticmethod
+    def received(headers: Optional[Dict[str, object]]) -> 'Trace':
+        """
+        Trace of a message taken from the input queue just now. Messages without trace headers start a new trace
+        """
+        dequeued = time.time()
+        trace_id = headers.get(TRACE_ID_HEADER) if headers else None
+        hops = headers.get(TRACE_HOPS_HEADER) if headers else None
+        if not isinstance(trace_id, (str, bytes)) or not isinstance(hops, list):
+            return Trace(uuid.uuid4().hex, [], dequeued)
+        if isinstance(trace_id, bytes):
+            trace_id = trace_id.decode('utf8')
+        return Trace(trace_id, [hop for hop in hops if isinstance(hop, dict)], dequeued)
+
+    @property
+    def last_hop(self) -> Optional[dict]:
+        return self.hops[-1] if len(self.hops) > 0 else None
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def handling(trace: Trace, collector: 'EdgeLatencyCollector'):
+    """
+    Makes the trace current for messages sent by the block and records latency of the edge the message came
+    through when the block exits. Context variables are local to threads and asyncio tasks
+    """
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        collector.record(trace, time.time())
+
+
+def outgoing_headers(headers: Optional[Dict[str, object]], service_name: str) -> Dict[str, object]:
+    """
+    :param headers: additional headers of the sent message, trace headers of forwarded messages are replaced
+    :return: headers with the current trace and a new hop of the service
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        trace = Trace(uuid.uuid4().hex, [], None)
+    last_hop = trace.last_hop
+    seq = last_hop.get('seq', len(trace.hops) - 1) + 1 if last_hop is not None else 0
+    hops = trace.hops[-(MAX_HOPS - 1):] + [{'seq': seq, 'service': service_name, 'dequeued': trace.dequeued,
+        'enqueued': time.time()}]
+    result = dict(headers) if headers else {}
+    result[TRACE_ID_HEADER] = trace.trace_id
+    result[TRACE_HOPS_HEADER] = hops
+    return result
+
+
+class EdgeLatencyCollector:
+    """
+    Latency samples of incoming edges of a service, keyed by the service which sent the message. Samples are
+    drained into every heartbeat, at most `max_samples` of the latest ones per edge.
+    """
+    def __init__(self, max_samples: int = 200):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._edges = {}
+
+    def record(self, trace: Trace, handled: float):
+        last_hop = trace.last_hop
+        if last_hop is None or not isinstance(last_hop.get('enqueued'), (int, float)):
+            return
+        source = last_hop.get('service')
+        if isinstance(source, bytes):
+            source = source.decode('utf8')
+        queue_wait = max(0.0, trace.dequeued - last_hop['enqueued'])
+        processing = handled - trace.dequeued
+        with self._lock:
+            edge = self._edges.get(source)
+            if edge is None:
+                edge = self._edges[source] = (deque(maxlen=self.max_samples), deque(maxlen=self.max_samples))
+            edge[0].append(round(queue_wait * 1000, 3))
+            edge[1].append(round(processing * 1000, 3))
+
+    def drain(self) -> Dict[str, Dict[str, List[float]]]:
+        """
+        :return: {source service: {'queue_wait': [ms], 'processing': [ms]}} recorded since the previous call
+        """
+        with self._lock:
+            edges, self._edges = self._edges, {}
+        return {source: {'queue_wait': list(queue_wait), 'processing': list(processing)}
+            for source, (queue_wait, processing) in edges.items()}
+
+
+class EdgeLatency:
+    """
+    Sliding window of latency samples of a pipeline edge aggregated by the hive
+    """
+    def __init__(self, window: int = 1000):
+        self.queue_wait = deque(maxlen=window)
+        self.processing = deque(maxlen=window)
+        self.last_update = None
+
+    def add(self, samples: Dict[str, List[float]]):
+        self.queue_wait.extend(samples.get('queue_wait', []))
+        self.processing.extend(samples.get('processing', []))
+        self.last_update = time.time()
+
+    @staticmethod
+    def _percentiles(samples) -> Optional[Dict[str, float]]:
+        if len(samples) == 0:
+            return None
+        ordered = sorted(samples)
+        return {f'p{p}': ordered[min(len(ordered) - 1, len(ordered) * p // 100)] for p in (50, 90, 99)}
+
+    def to_dict(self):
+        return {'count': len(self.processing), 'queue_wait_ms': self._percentiles(self.queue_wait),
+            'processing_ms': self._percentiles(self.processing), 'last_update': self.last_update}
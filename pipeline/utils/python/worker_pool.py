@@ -0,0 +1,77 @@
+import queue
+import threading
+import traceback
+from contextlib import ExitStack, contextmanager
+
+
+class KeyedWorkerPool:
+    """
+    Tasks with the same key run on the same thread in submission order, tasks without a key go round-robin
+    """
+    def __init__(self, workers_number: int, handler, name: str = 'worker'):
+        if workers_number <= 0:
+            raise ValueError('workers_number must be positive')
+        self.handler = handler
+        self._queues = [queue.Queue() for _ in range(workers_number)]
+        self._threads = [threading.Thread(target=self.__work, args=(tasks,), name=f'{name}_{i}', daemon=True)
+            for i, tasks in enumerate(self._queues)]
+        self._next_queue = 0
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, *args):
+        if key is None:
+            index = self._next_queue
+            self._next_queue = (self._next_queue + 1) % len(self._queues)
+        else:
+            index = hash(str(key)) % len(self._queues)
+        self._queues[index].put(args)
+
+    def join(self):
+        for tasks in self._queues:
+            tasks.join()
+
+    def __work(self, tasks: queue.Queue):
+        while True:
+            args = tasks.get()
+            try:
+                self.handler(*args)
+            except Exception:
+                print('Exception in worker thread:', traceback.format_exc())
+            finally:
+                tasks.task_done()
+
+
+class KeyedLocks:
+    """
+    Locks created on demand for keys and dropped once no thread holds or waits for them, so threads working with
+    the same key are serialized while different keys don't block each other
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    @contextmanager
+    def lock_many(self, keys):
+        with ExitStack() as stack:
+            for key in sorted(set(keys), key=str):
+                stack.enter_context(self.lock(key))
+            yield